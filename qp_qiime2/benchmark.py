@@ -0,0 +1,500 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from os import makedirs
+from os.path import join, exists
+from json import load, loads
+from time import time
+from tempfile import mkdtemp
+
+import numpy as np
+from scipy.sparse import random as sparse_random
+from biom import Table
+from biom.util import biom_open
+
+from qiime2 import __version__ as qiime2_version
+
+from .manifest import get_commands
+from .local_qiita import LocalQiita, write_fixtures, run_job
+from .profiling import PROFILE_FILENAME
+from .executor import JobExecutor
+
+
+# the benchmarks: name: (Q2 plugin, Q2 method, values of the parameters by
+# their Q2 name). The inputs refer to the artifacts of the synthetic dataset
+# (see generate_dataset) and the values in brackets are filled from the
+# dataset
+BENCHMARKS = {
+    'rarefy': ('feature-table', 'rarefy', {
+        'table': '1', 'sampling_depth': '{depth}'}),
+    'alpha': ('diversity', 'alpha', {
+        'table': '1', 'metric': "Shannon's index"}),
+    'beta_phylogenetic': ('diversity', 'beta_phylogenetic', {
+        'table': '1', 'phylogeny': 'Artifact tree, if exists',
+        'metric': 'Unweighted UniFrac'}),
+    'filter_samples': ('feature-table', 'filter_samples', {
+        'table': '1', 'where': "env='soil'"}),
+    'beta_group_significance': ('diversity', 'beta_group_significance', {
+        'distance_matrix': '2', 'qp-hide-metadata-field': 'env',
+        'method': 'PERMANOVA'}),
+    'emperor_plot': ('emperor', 'plot', {'pcoa': '3'}),
+    'taxa_barplot': ('taxa', 'barplot', {'table': '1'}),
+}
+
+ENVIRONMENTS = ['soil', 'water', 'gut', 'skin']
+
+
+def generate_table(n_samples, n_features, density, seed=None):
+    """Generates a random BIOM table with taxonomy
+
+    Parameters
+    ----------
+    n_samples : int
+        The number of samples
+    n_features : int
+        The number of features
+    density : float
+        The fraction of non zero counts, between 0 and 1
+    seed : int, optional
+        The seed of the random number generator
+
+    Returns
+    -------
+    biom.Table
+        The table, with a taxonomy observation metadata category
+    """
+    rng = np.random.RandomState(seed)
+    data = sparse_random(n_features, n_samples, density=density,
+                         format='csr', random_state=rng)
+    data.data = np.ceil(data.data * 100)
+    # making sure that there are no empty samples
+    data = data.tolil()
+    for i in range(n_samples):
+        data[rng.randint(n_features), i] += 1
+    data = data.tocsr()
+
+    feature_ids = ['F%d' % i for i in range(n_features)]
+    sample_ids = ['S%d' % i for i in range(n_samples)]
+    taxonomy = [{'taxonomy': ['k__Bacteria', 'p__P%d' % (i % 10),
+                              'c__C%d' % (i % 50)]}
+                for i in range(n_features)]
+    return Table(data, feature_ids, sample_ids, taxonomy)
+
+
+def generate_tree(feature_ids, seed=None):
+    """Generates a random rooted binary tree in Newick format
+
+    Parameters
+    ----------
+    feature_ids : list of str
+        The tips of the tree
+    seed : int, optional
+        The seed of the random number generator
+
+    Returns
+    -------
+    str
+        The tree in Newick format
+    """
+    rng = np.random.RandomState(seed)
+    nodes = ['%s:%.4f' % (f, rng.uniform(0.01, 0.2)) for f in feature_ids]
+    rng.shuffle(nodes)
+    # joining pairs of consecutive nodes, level by level, keeps the depth of
+    # the tree logarithmic
+    while len(nodes) > 1:
+        joined = ['(%s,%s):%.4f' % (nodes[i], nodes[i + 1],
+                                    rng.uniform(0.01, 0.2))
+                  for i in range(0, len(nodes) - 1, 2)]
+        if len(nodes) % 2:
+            joined.append(nodes[-1])
+        nodes = joined
+    # the root has no branch length
+    return '%s;' % nodes[0].rsplit(':', 1)[0]
+
+
+def generate_distance_matrix(sample_ids, seed=None):
+    """Generates a random distance matrix in the Q2 TSV format
+
+    Parameters
+    ----------
+    sample_ids : list of str
+        The samples
+    seed : int, optional
+        The seed of the random number generator
+
+    Returns
+    -------
+    str
+        The distance matrix
+    """
+    rng = np.random.RandomState(seed)
+    n = len(sample_ids)
+    data = rng.uniform(size=(n, n))
+    data = (data + data.T) / 2
+    np.fill_diagonal(data, 0)
+    lines = ['\t' + '\t'.join(sample_ids)]
+    for sid, row in zip(sample_ids, data):
+        lines.append('%s\t%s' % (sid, '\t'.join('%.6f' % v for v in row)))
+    return '\n'.join(lines) + '\n'
+
+
+def generate_metadata(sample_ids, n_columns=10, seed=None):
+    """Generates random metadata
+
+    Parameters
+    ----------
+    sample_ids : list of str
+        The samples
+    n_columns : int, optional
+        The number of columns besides env, half numeric and half categorical
+    seed : int, optional
+        The seed of the random number generator
+
+    Returns
+    -------
+    dict of {str: dict of {str: str}}
+        The metadata, as returned by Qiita
+    """
+    rng = np.random.RandomState(seed)
+    metadata = {}
+    for i, sid in enumerate(sample_ids):
+        md = {'env': ENVIRONMENTS[i % len(ENVIRONMENTS)]}
+        for c in range(n_columns):
+            if c % 2:
+                md['numeric_%d' % c] = '%.3f' % rng.uniform(0, 100)
+            else:
+                md['categorical_%d' % c] = 'value_%d' % rng.randint(5)
+        metadata[sid] = md
+    return metadata
+
+
+def generate_dataset(out_dir, n_samples, n_features, density, seed=None):
+    """Generates a synthetic dataset and stores it in out_dir
+
+    Parameters
+    ----------
+    out_dir : str
+        Where to store the files
+    n_samples, n_features, density, seed
+        See generate_table
+
+    Returns
+    -------
+    dict
+        The folder of the dataset and the sampling depth to use for
+        rarefaction
+
+    Notes
+    -----
+    The dataset is stored as a LocalQiita fixture set with analysis 1 and 3
+    artifacts: 1, the BIOM table with its tree; 2, the distance matrix; and
+    3, the ordination.
+    """
+    makedirs(out_dir, exist_ok=True)
+    table = generate_table(n_samples, n_features, density, seed=seed)
+    sample_ids = list(table.ids())
+
+    table_fp = join(out_dir, 'table.biom')
+    with biom_open(table_fp, 'w') as f:
+        table.to_hdf5(f, 'qp-qiime2 benchmark')
+
+    tree_fp = join(out_dir, 'tree.tre')
+    with open(tree_fp, 'w') as f:
+        f.write(generate_tree(table.ids(axis='observation'), seed=seed))
+
+    dm = generate_distance_matrix(sample_ids, seed=seed)
+    dm_fp = join(out_dir, 'distance-matrix.tsv')
+    with open(dm_fp, 'w') as f:
+        f.write(dm)
+
+    ordination_fp = join(out_dir, 'ordination.txt')
+    _write_ordination(dm_fp, ordination_fp)
+
+    write_fixtures(out_dir, {
+        'artifacts': {
+            '1': {'type': 'BIOM', 'analysis': 1,
+                  'files': {'biom': ['table.biom'],
+                            'plain_text': ['tree.tre']}},
+            '2': {'type': 'distance_matrix', 'analysis': 1,
+                  'files': {'plain_text': ['distance-matrix.tsv']}},
+            '3': {'type': 'ordination_results', 'analysis': 1,
+                  'files': {'plain_text': ['ordination.txt']}}},
+        'analyses': {
+            '1': {'metadata': generate_metadata(sample_ids, seed=seed)}}})
+
+    return {'directory': out_dir,
+            'depth': int(np.median(table.sum(axis='sample')))}
+
+
+def _write_ordination(dm_fp, ordination_fp):
+    """Computes the PCoA of a distance matrix and writes it"""
+    from skbio import DistanceMatrix
+    from skbio.stats.ordination import pcoa
+
+    pcoa(DistanceMatrix.read(dm_fp)).write(ordination_fp)
+
+
+def build_parameters(command, values):
+    """Builds the parameters of a job, as Qiita would send them
+
+    Parameters
+    ----------
+    command : dict
+        The command, as stored in the manifest
+    values : dict
+        The value of the parameters, keyed by their Q2 name. The ones not
+        in values take their default
+
+    Returns
+    -------
+    dict
+        The parameters
+    """
+    params = {}
+    for group in (command['req_params'], command['opt_params']):
+        for ename, (data_type, default) in group.items():
+            if ename.startswith('qp-hide-param'):
+                params[ename] = default
+                pname = default
+                visible = ename[len('qp-hide-param'):]
+                if pname in values:
+                    params[visible] = values[pname]
+                else:
+                    default = group[visible][1]
+                    params[visible] = 'None' if default is None else default
+            elif ename.startswith('qp-hide-'):
+                params[ename] = default
+    return params
+
+
+def find_command(q2plugin, q2method, commands=None):
+    """Finds the Qiita command of a Q2 method
+
+    Parameters
+    ----------
+    q2plugin : str
+        The name of the Q2 plugin
+    q2method : str
+        The id of the Q2 method
+    commands : list of dict, optional
+        The commands, by default the ones in the manifest
+
+    Returns
+    -------
+    dict
+        The command
+
+    Raises
+    ------
+    ValueError
+        If there is no command for the method
+    """
+    if commands is None:
+        commands = get_commands()
+    for command in commands:
+        req = command['req_params']
+        if (req['qp-hide-plugin'][1] == q2plugin and
+                req['qp-hide-method'][1] == q2method and
+                'qp-hide-fanout' not in req):
+            return command
+    raise ValueError('There is no command for %s %s' % (q2plugin, q2method))
+
+
+def _create_job(qclient, name, dataset):
+    """Creates the job of one of the BENCHMARKS"""
+    q2plugin, q2method, values = BENCHMARKS[name]
+    values = {k: v.format(**dataset) for k, v in values.items()}
+    command = find_command(q2plugin, q2method)
+    return qclient.create_job(['qiime2', qiime2_version, command['name']],
+                              build_parameters(command, values))
+
+
+def _profile_phases(out_dir):
+    """Reads the wall time of each phase from the profile of a job"""
+    phases = {}
+    profile_fp = join(out_dir, PROFILE_FILENAME)
+    if exists(profile_fp):
+        with open(profile_fp) as f:
+            for record in load(f)['records']:
+                phases[record['name']] = record['wall_time']
+    return phases
+
+
+def run_benchmark(name, dataset, out_dir, latency=0):
+    """Runs one of the BENCHMARKS
+
+    Parameters
+    ----------
+    name : str
+        The name of the benchmark
+    dataset : dict
+        The dataset, as returned by generate_dataset
+    out_dir : str
+        Where to store the results of the job
+    latency : float, optional
+        Seconds added to each request to the Qiita API
+
+    Returns
+    -------
+    dict
+        The success, error message, total wall time, the wall time of each
+        phase of the job and the number of requests to the Qiita API and
+        the time spent on them
+    """
+    qclient = LocalQiita.from_directory(dataset['directory'],
+                                        latency=latency)
+    job_id = _create_job(qclient, name, dataset)
+
+    makedirs(out_dir, exist_ok=True)
+    start = time()
+    success, _, msg = run_job(qclient, job_id, out_dir)
+    wall_time = time() - start
+
+    return {'benchmark': name, 'success': success, 'error': msg,
+            'wall_time': wall_time, 'phases': _profile_phases(out_dir),
+            'requests': len(qclient.requests),
+            'request_time': sum(r[2] for r in qclient.requests)}
+
+
+def _load_test_job(args):
+    """Runs a job of a load test, see run_load_test"""
+    name, dataset, out_dir, latency = args
+    return run_benchmark(name, dataset, out_dir, latency=latency)
+
+
+def run_load_test(name, dataset, work_dir, n_jobs, concurrency, latency=0,
+                  threads=False):
+    """Runs many jobs of one of the BENCHMARKS at the same time
+
+    Parameters
+    ----------
+    name : str
+        The name of the benchmark
+    dataset : dict
+        The dataset, as returned by generate_dataset
+    work_dir : str
+        Where to store the results of the jobs
+    n_jobs : int
+        The number of jobs to run
+    concurrency : int
+        The number of jobs running at the same time
+    latency : float, optional
+        Seconds added to each request to the Qiita API
+    threads : bool, optional
+        Whether to run the jobs in threads of this process instead of each
+        in its own process, see executor.JobExecutor
+
+    Returns
+    -------
+    dict
+        The number of jobs and of failed jobs, the total wall time, the
+        throughput in jobs per second and the mean and maximum wall time of
+        the jobs
+    """
+    args = [(name, dataset, join(work_dir, '%s-%d' % (name, i)), latency)
+            for i in range(n_jobs)]
+    start = time()
+    with JobExecutor(concurrency, processes=not threads) as executor:
+        results = executor.map(_load_test_job, args)
+    wall_time = time() - start
+
+    times = [r['wall_time'] for r in results]
+    return {'benchmark': name, 'jobs': n_jobs, 'concurrency': concurrency,
+            'latency': latency, 'threads': threads,
+            'failed': sum(not r['success'] for r in results),
+            'wall_time': wall_time, 'throughput': n_jobs / wall_time,
+            'mean_job_time': sum(times) / n_jobs, 'max_job_time': max(times)}
+
+
+def run_benchmarks(names, n_samples, n_features, density, seed=0,
+                   work_dir=None, latency=0):
+    """Runs the benchmarks on a synthetic dataset
+
+    Parameters
+    ----------
+    names : list of str
+        The benchmarks to run, see BENCHMARKS
+    n_samples, n_features, density, seed
+        The size of the dataset, see generate_table
+    work_dir : str, optional
+        Where to store the dataset and the results, a temporary folder by
+        default
+    latency : float, optional
+        Seconds added to each request to the Qiita API
+
+    Returns
+    -------
+    list of dict
+        The results, see run_benchmark, with the size of the dataset, the
+        qiime2 version and the time of the run; see compare to compare them
+        with the previous runs
+    """
+    if work_dir is None:
+        work_dir = mkdtemp(prefix='qp-qiime2-benchmark-')
+    dataset = generate_dataset(join(work_dir, 'dataset'), n_samples,
+                               n_features, density, seed=seed)
+    timestamp = time()
+    results = []
+    for name in names:
+        result = run_benchmark(name, dataset, join(work_dir, name),
+                               latency=latency)
+        result.update({
+            'n_samples': n_samples, 'n_features': n_features,
+            'density': density, 'seed': seed, 'latency': latency,
+            'qiime2_version': qiime2_version, 'timestamp': timestamp})
+        results.append(result)
+    return results
+
+
+def _history_key(result):
+    """The benchmark and settings of a result, to compare between runs"""
+    return (result['benchmark'], result['n_samples'], result['n_features'],
+            result['density'], result['seed'], result.get('latency', 0))
+
+
+def compare(results, history_fp):
+    """Compares results with the previous run of the same benchmarks
+
+    Parameters
+    ----------
+    results : list of dict
+        The results, as returned by run_benchmarks
+    history_fp : str
+        The file with the previous results
+
+    Returns
+    -------
+    list of (str, float, float or None)
+        The name, wall time and the wall time in the most recent previous run
+        with the same dataset size and latency, if any, of each benchmark
+    """
+    previous = {}
+    if exists(history_fp):
+        with open(history_fp) as f:
+            for line in f:
+                try:
+                    r = loads(line)
+                except ValueError:
+                    continue
+                if not r.get('success'):
+                    continue
+                key = _history_key(r)
+                if (key not in previous or
+                        previous[key]['timestamp'] < r['timestamp']):
+                    previous[key] = r
+
+    comparison = []
+    for r in results:
+        key = _history_key(r)
+        prev = previous.get(key)
+        # the current results could be in the history already
+        if prev is not None and prev['timestamp'] >= r['timestamp']:
+            prev = None
+        comparison.append((r['benchmark'], r['wall_time'],
+                           prev['wall_time'] if prev is not None else None))
+    return comparison
@@ -0,0 +1,215 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from os import environ, makedirs, replace, remove, scandir, utime, walk
+from os.path import join, exists, isdir, getsize
+from shutil import rmtree
+from tempfile import mkdtemp
+from contextlib import contextmanager
+from hashlib import sha256
+from fcntl import flock, LOCK_EX, LOCK_SH, LOCK_UN
+
+
+DEFAULT_CACHE_SIZE = 10 * 1024 ** 3
+
+
+def hash_file(fp, block_size=2 ** 20):
+    """Computes the sha256 of the contents of a file
+
+    Parameters
+    ----------
+    fp : str
+        The filepath
+    block_size : int, optional
+        The number of bytes to read at a time
+
+    Returns
+    -------
+    str
+        The hex digest of the file contents
+    """
+    checksum = sha256()
+    with open(fp, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+def _entry_size(fp):
+    """Returns the size in bytes of a file or of all the files in a folder"""
+    if not isdir(fp):
+        return getsize(fp)
+    return sum(getsize(join(root, f))
+               for root, _, files in walk(fp) for f in files)
+
+
+class DiskCache(object):
+    """A size bounded, least recently used, on-disk cache
+
+    Parameters
+    ----------
+    directory : str
+        The folder where the entries are stored
+    max_size : int
+        The maximum size in bytes of all the entries together
+    suffix : str, optional
+        The suffix of the entries filenames, like '.qza'
+
+    Notes
+    -----
+    Several processes, even in different workers of the same node, can use
+    the same directory at the same time: the entries are written to a
+    temporary location and moved in place, and the moves and evictions are
+    serialized with a lock file in the directory. The last access time of an
+    entry is tracked by its modification time.
+    """
+    def __init__(self, directory, max_size, suffix=''):
+        makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_size = max_size
+        self.suffix = suffix
+        self._lock_fp = join(directory, '.lock')
+
+    @staticmethod
+    def key(*values):
+        """Generates a key from a list of values
+
+        Parameters
+        ----------
+        values : str
+            The values that identify the entry
+
+        Returns
+        -------
+        str
+            The key
+        """
+        return sha256('\t'.join(values).encode('utf-8')).hexdigest()
+
+    @contextmanager
+    def _lock(self, exclusive=True):
+        with open(self._lock_fp, 'a') as f:
+            flock(f, LOCK_EX if exclusive else LOCK_SH)
+            try:
+                yield
+            finally:
+                flock(f, LOCK_UN)
+
+    def _entry_fp(self, key):
+        return join(self.directory, key + self.suffix)
+
+    def get(self, key):
+        """Retrieves an entry
+
+        Parameters
+        ----------
+        key : str
+            The key of the entry
+
+        Returns
+        -------
+        str or None
+            The filepath of the entry, None if it is not cached
+
+        Notes
+        -----
+        Another process can evict the entry after it has been retrieved, so
+        callers should treat any error reading it as a cache miss.
+        """
+        fp = self._entry_fp(key)
+        with self._lock(exclusive=False):
+            try:
+                # marking it as recently used
+                utime(fp)
+            except FileNotFoundError:
+                return None
+        return fp
+
+    @contextmanager
+    def put(self, key, overwrite=False):
+        """Stores an entry
+
+        Parameters
+        ----------
+        key : str
+            The key of the entry
+        overwrite : bool, optional
+            Whether to replace the entry if it already exists, by default
+            the existing one is kept
+
+        Yields
+        ------
+        str
+            The temporary filepath where the caller has to write the entry,
+            either a file or a folder. Once the context exits without errors
+            the entry is moved to the cache and the least recently used
+            entries are evicted until the cache fits in max_size.
+        """
+        tmpdir = mkdtemp(prefix='.tmp', dir=self.directory)
+        try:
+            tmp_fp = join(tmpdir, key + self.suffix)
+            yield tmp_fp
+            with self._lock():
+                fp = self._entry_fp(key)
+                # another process could have stored the same entry while we
+                # were generating ours
+                if exists(fp) and not overwrite:
+                    utime(fp)
+                elif exists(tmp_fp):
+                    if isdir(fp):
+                        rmtree(fp, ignore_errors=True)
+                    replace(tmp_fp, fp)
+                self._evict()
+        finally:
+            rmtree(tmpdir, ignore_errors=True)
+
+    def _evict(self):
+        """Removes the least recently used entries, the lock must be held"""
+        entries = []
+        total = 0
+        for entry in scandir(self.directory):
+            # skipping the lock and the temporary folders
+            if entry.name.startswith('.'):
+                continue
+            size = _entry_size(entry.path)
+            entries.append((entry.stat().st_mtime, size, entry.path))
+            total += size
+
+        for _, size, fp in sorted(entries):
+            if total <= self.max_size:
+                break
+            if isdir(fp):
+                rmtree(fp, ignore_errors=True)
+            else:
+                remove(fp)
+            total -= size
+
+
+def get_cache(name, suffix=''):
+    """Returns one of the plugin caches, if caching is enabled
+
+    Parameters
+    ----------
+    name : str
+        The name of the cache, like 'artifacts'
+    suffix : str, optional
+        The suffix of the entries filenames
+
+    Returns
+    -------
+    DiskCache or None
+        The cache stored in the `name` folder of QP_QIIME2_CACHE_DIR, with the
+        size set in QP_QIIME2_<NAME>_CACHE_SIZE (in bytes). None if
+        QP_QIIME2_CACHE_DIR is not set.
+    """
+    base = environ.get('QP_QIIME2_CACHE_DIR')
+    if not base:
+        return None
+    max_size = int(environ.get(
+        'QP_QIIME2_%s_CACHE_SIZE' % name.upper(), DEFAULT_CACHE_SIZE))
+    return DiskCache(join(base, name), max_size, suffix=suffix)
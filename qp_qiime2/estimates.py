@@ -0,0 +1,382 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from os import environ, SEEK_END
+from os.path import isfile
+from json import loads
+
+from .profiling import get_process_model
+from .resources import get_memory_limit
+from .scratch import _format_bytes
+
+
+# the number of most recent runs of each action, and metric, used to
+# calibrate its estimates, see estimate_resources
+HISTORY_RUNS = 1000
+
+# the number of most recent jobs read from the history, which can grow
+# without bounds, see read_history
+HISTORY_JOBS = 50000
+
+
+def get_history_fp():
+    """Returns the filepath of the history of the jobs
+
+    Returns
+    -------
+    str or None
+        The value of the QP_QIIME2_JOB_HISTORY environment variable, if set;
+        otherwise the value of QP_QIIME2_METRICS_SINK if it is a filepath, as
+        it has the profile of every job, see profiling.JobProfile.emit
+    """
+    fp = environ.get('QP_QIIME2_JOB_HISTORY')
+    if fp:
+        return fp
+    sink = environ.get('QP_QIIME2_METRICS_SINK')
+    if sink and not sink.startswith('udp://'):
+        return sink
+    return None
+
+
+def get_time_limit():
+    """Returns the seconds the job can run
+
+    Returns
+    -------
+    float or None
+        The value of the QP_QIIME2_TIME_LIMIT environment variable, or None
+        if it is not set
+    """
+    limit = environ.get('QP_QIIME2_TIME_LIMIT')
+    return float(limit) if limit else None
+
+
+def count_tips(tree_fp, chunk_size=2 ** 20):
+    """Counts the tips of a newick tree without parsing it
+
+    Parameters
+    ----------
+    tree_fp : str
+        The filepath of the tree
+    chunk_size : int, optional
+        The bytes read at a time
+
+    Returns
+    -------
+    int
+        The number of tips: each node with n children has n - 1 commas, so
+        there is one comma less than tips
+    """
+    commas = 0
+    with open(tree_fp, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            commas += chunk.count(b',')
+    return commas + 1
+
+
+def input_dimensions(input_table, tree_fp=None):
+    """Returns the size of the inputs of a job
+
+    Parameters
+    ----------
+    input_table : tables.InputTable
+        The input table of the job
+    tree_fp : str, optional
+        The filepath of the input tree of the job
+
+    Returns
+    -------
+    dict of {str: int}
+        The samples, features and non zero values of the table, see
+        tables.InputTable.dimensions, and the tips of the tree, 0 if there
+        is no tree
+    """
+    dims = input_table.dimensions()
+    dims['tips'] = count_tips(tree_fp) if tree_fp and isfile(tree_fp) else 0
+    return dims
+
+
+def job_size(dims, pairwise):
+    """Returns the size of a job, the variable of the estimates
+
+    Parameters
+    ----------
+    dims : dict of {str: int}
+        The size of the inputs, see input_dimensions
+    pairwise : bool
+        Whether the action compares all the pairs of samples, like the beta
+        diversity methods
+
+    Returns
+    -------
+    int
+        The non zero values of the table plus the tips of the tree and, for
+        the pairwise actions, the samples times the samples and the tips,
+        the size of the distance matrix and of the tree of each sample
+    """
+    samples = dims.get('samples', 0)
+    tips = dims.get('tips', 0)
+    size = dims.get('nnz', 0) + tips
+    if pairwise:
+        size += samples * (samples + tips)
+    return size
+
+
+def _read_backwards(fp, block_size=2 ** 16):
+    """Yields the lines of a file from the last to the first"""
+    with open(fp, 'rb') as f:
+        position = f.seek(0, SEEK_END)
+        rest = b''
+        while position > 0:
+            size = min(block_size, position)
+            position -= size
+            f.seek(position)
+            lines = (f.read(size) + rest).split(b'\n')
+            # the first line can continue in the previous block
+            rest = lines.pop(0)
+            for line in reversed(lines):
+                yield line.decode('utf-8', 'replace')
+        yield rest.decode('utf-8', 'replace')
+
+
+def read_history(q2plugin, q2method, fp=None, process=None):
+    """Reads the resources used by the previous runs of an action
+
+    Parameters
+    ----------
+    q2plugin, q2method : str
+        The Q2 plugin and method
+    fp : str, optional
+        The filepath of the history, one job profile per line, defaults to
+        get_history_fp
+    process : str, optional
+        How the runs ran, see profiling.set_process_model, defaults to how
+        the jobs of this process run
+
+    Returns
+    -------
+    dict of {str or None: list of (dict, int, float)}
+        The size of the inputs, see input_dimensions, the peak RSS and the
+        wall time of the last HISTORY_RUNS successful runs of the action,
+        from the oldest to the newest, keyed by the value of its metric
+        parameter, None if it doesn't have one. The peak RSS is the one of
+        the job or, for the fan-out commands, whose runs are keyed by their
+        value, of the process of each run; see profiling.JobProfile
+
+    Notes
+    -----
+    The history is read from the end and only its last HISTORY_JOBS lines,
+    so the cost doesn't grow with the history. The lines that are not job
+    profiles of the action, like the ones of the jobs that ran before their
+    inputs were recorded, are ignored; so are the jobs that ran at the same
+    time as other jobs in the threads of a process, as their resources
+    include the ones of the other jobs, the jobs that ran in another process
+    model, as their peak RSS includes a different baseline, and the errors
+    reading the history, which only means there is nothing to estimate from.
+    The profiles without a process model ran standalone.
+    """
+    if fp is None:
+        fp = get_history_fp()
+    if process is None:
+        process = get_process_model()
+    history = {}
+    if fp is None:
+        return history
+
+    try:
+        jobs = 0
+        for line in _read_backwards(fp):
+            if not line.strip():
+                continue
+            jobs += 1
+            if jobs > HISTORY_JOBS:
+                break
+            # most lines are of other actions, which aren't parsed
+            if q2method not in line:
+                continue
+            try:
+                profile = loads(line)
+            except ValueError:
+                continue
+            if (not isinstance(profile, dict) or
+                    profile.get('plugin') != q2plugin or
+                    profile.get('method') != q2method or
+                    not profile.get('success') or
+                    profile.get('concurrent_jobs', 0) or
+                    profile.get('process', 'standalone') != process or
+                    'inputs' not in profile):
+                continue
+            for record in profile.get('records', []):
+                name = record.get('name', '')
+                # the runs of the fan-out commands have their own records,
+                # and the out of core filters don't run Q2
+                if name == 'run' and not (record.get('fanout') or
+                                          record.get('out_of_core')):
+                    metric = profile.get('metric')
+                    peak_rss = profile.get('peak_rss')
+                elif name.startswith('run:'):
+                    metric = name[len('run:'):]
+                    peak_rss = record.get('peak_rss')
+                else:
+                    continue
+                runs = history.setdefault(metric, [])
+                if (peak_rss is None or 'wall_time' not in record or
+                        len(runs) == HISTORY_RUNS):
+                    continue
+                runs.append((profile['inputs'], peak_rss,
+                             record['wall_time']))
+    except OSError:
+        pass
+    return {k: v[::-1] for k, v in history.items() if v}
+
+
+def _fit(points):
+    """Fits a line above a set of points
+
+    The intercept is the baseline of the runs, like the memory of the
+    interpreter and the plugins, and the slope how they grow with their
+    size, which can only be told from points with different x. So the slope
+    is the least squares one, but never negative, or 0 if all the points
+    have the same x, and the intercept is the smallest, but never negative,
+    that leaves all the points on or below the line; the estimates are
+    upper bounds of the history, and a single run, or runs of a single
+    size, estimate the same for any size.
+    """
+    xs = [x for x, _ in points]
+    slope = 0
+    if len(set(xs)) > 1:
+        mean_x = sum(xs) / len(xs)
+        mean_y = sum(y for _, y in points) / len(points)
+        slope = max(sum((x - mean_x) * (y - mean_y) for x, y in points) / sum(
+            (x - mean_x) ** 2 for x in xs), 0)
+    return max(max(y - slope * x for x, y in points), 0), slope
+
+
+def estimate_resources(q2plugin, q2method, metrics, dims, pairwise,
+                       processes=1, history=None):
+    """Estimates the peak RSS and wall time of a job
+
+    Parameters
+    ----------
+    q2plugin, q2method : str
+        The Q2 plugin and method
+    metrics : list of str or None
+        The metric of each run of the method in the job, None if the method
+        has no metric parameter
+    dims : dict of {str: int}
+        The size of the inputs, see input_dimensions
+    pairwise : bool
+        Whether the method compares all the pairs of samples, see job_size
+    processes : int, optional
+        The number of runs that run at the same time in their own processes
+    history : dict, optional
+        The history of the method, defaults to read_history
+
+    Returns
+    -------
+    dict or None
+        The estimated 'peak_rss', in bytes, 'wall_time', in seconds, and the
+        number of previous runs they were calibrated on, 'runs'; or None if
+        any of the metrics never ran before
+
+    Notes
+    -----
+    The peak RSS and the wall time of each metric are modeled as a line on
+    the size of the job, see job_size, fitted to its history so that all
+    the previous runs are below it; until it ran on inputs of different
+    sizes, the estimate is the largest of its previous runs. The runs that
+    share a process take the largest peak RSS and the sum of the times; the
+    ones in their own processes add their peaks and split the time.
+    """
+    if history is None:
+        history = read_history(q2plugin, q2method)
+    size = job_size(dims, pairwise)
+    peaks = []
+    times = []
+    runs = 0
+    for metric in metrics:
+        points = history.get(metric)
+        if not points:
+            return None
+        sizes = [job_size(d, pairwise) for d, _, _ in points]
+        intercept, slope = _fit([(x, p[1]) for x, p in zip(sizes, points)])
+        peaks.append(intercept + slope * size)
+        intercept, slope = _fit([(x, p[2]) for x, p in zip(sizes, points)])
+        times.append(intercept + slope * size)
+        runs += len(points)
+
+    if processes > 1:
+        peak = sum(sorted(peaks)[-processes:])
+        wall_time = max(max(times), sum(times) / processes)
+    else:
+        peak = max(peaks)
+        wall_time = sum(times)
+    return {'peak_rss': int(peak), 'wall_time': wall_time, 'runs': runs}
+
+
+def _format_time(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '%d:%02d:%02d' % (hours, minutes, seconds)
+
+
+def format_estimate(estimate):
+    """Describes an estimate, see estimate_resources
+
+    Parameters
+    ----------
+    estimate : dict
+        The estimate
+
+    Returns
+    -------
+    str
+        The estimate, like 'about 2.1 GiB of memory and 0:05:00'
+    """
+    return 'about %s of memory and %s' % (
+        _format_bytes(estimate['peak_rss']),
+        _format_time(estimate['wall_time']))
+
+
+def check_estimate(estimate, memory_limit=None, time_limit=None):
+    """Checks that a job has the resources it needs
+
+    Parameters
+    ----------
+    estimate : dict
+        The estimate of the job, see estimate_resources
+    memory_limit : int, optional
+        The memory the job can use, in bytes, defaults to
+        resources.get_memory_limit
+    time_limit : float, optional
+        The seconds the job can run, defaults to get_time_limit
+
+    Returns
+    -------
+    str
+        The error, if the job needs more memory or time than it has, or an
+        empty string
+    """
+    if memory_limit is None:
+        memory_limit = get_memory_limit()
+    if time_limit is None:
+        time_limit = get_time_limit()
+
+    needs = []
+    if memory_limit is not None and estimate['peak_rss'] > memory_limit:
+        needs.append('%s of memory but it can use %s' % (
+            _format_bytes(estimate['peak_rss']),
+            _format_bytes(memory_limit)))
+    if time_limit is not None and estimate['wall_time'] > time_limit:
+        needs.append('%s to run but it can run for %s' % (
+            _format_time(estimate['wall_time']), _format_time(time_limit)))
+    if not needs:
+        return ''
+    return ('The job needs about %s (estimated from %d previous runs); '
+            'please run it with a larger allocation or on a smaller '
+            'table' % (' and '.join(needs), estimate['runs']))
@@ -0,0 +1,131 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from multiprocessing import get_context
+from threading import BoundedSemaphore
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from .resources import get_cpu_count
+
+
+# whether the process runs jobs in threads, see threaded_jobs
+_THREADED_JOBS = False
+
+
+def threaded_jobs():
+    """Returns whether the process runs jobs in threads
+
+    Returns
+    -------
+    bool
+        Whether a JobExecutor has run jobs in threads of this process, so
+        other jobs can be running at any time
+    """
+    return _THREADED_JOBS
+
+
+class JobExecutor(object):
+    """Runs jobs concurrently in one warm interpreter
+
+    Parameters
+    ----------
+    max_jobs : int, optional
+        The maximum number of jobs running at the same time, defaults to the
+        number of CPUs the process can use
+    processes : bool, optional
+        Whether to run the jobs in processes forked from this one instead of
+        in threads of this process
+    max_pending : int, optional
+        The maximum number of jobs waiting to run, defaults to max_jobs; once
+        reached, submit blocks until a job finishes
+
+    Notes
+    -----
+    The threads are lighter but share the process, so the jobs must be
+    reentrant, like qp_qiime2.call_qiime2 and pipeline.call_pipeline, and
+    don't fork, see threaded_jobs. The processes are forked from this one,
+    so they start with the Q2 plugins already loaded if they were loaded
+    before the first job was submitted, but the function and arguments of
+    the jobs need to be picklable.
+    """
+    def __init__(self, max_jobs=None, processes=False, max_pending=None):
+        global _THREADED_JOBS
+        if max_jobs is None:
+            max_jobs = get_cpu_count()
+        if max_pending is None:
+            max_pending = max_jobs
+        self.max_jobs = max_jobs
+        self.processes = processes
+        if processes:
+            self._executor = ProcessPoolExecutor(
+                max_jobs, mp_context=get_context('fork'))
+        else:
+            _THREADED_JOBS = True
+            self._executor = ThreadPoolExecutor(max_jobs)
+        self._slots = BoundedSemaphore(max_jobs + max_pending)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+
+    def _release(self, future):
+        self._slots.release()
+
+    def submit(self, function, *args, **kwargs):
+        """Submits a job, blocking if there are too many waiting
+
+        Parameters
+        ----------
+        function : callable
+            The function that runs the job, like qp_qiime2.call_qiime2
+        args, kwargs
+            The arguments of function
+
+        Returns
+        -------
+        concurrent.futures.Future
+            The result of function
+        """
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(function, *args, **kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(self._release)
+        return future
+
+    def map(self, function, values):
+        """Runs function once per value and waits for the results
+
+        Parameters
+        ----------
+        function : callable
+            The function that runs the job
+        values : iterable
+            The argument of each job
+
+        Returns
+        -------
+        list
+            The results, in the order of values
+        """
+        futures = [self.submit(function, value) for value in values]
+        return [future.result() for future in futures]
+
+    def shutdown(self, wait=True):
+        """Releases the threads or processes
+
+        Parameters
+        ----------
+        wait : bool, optional
+            Whether to wait for the jobs to finish
+        """
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,300 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+import re
+from os.path import join, isabs
+from json import dump, load, loads
+from time import sleep, time
+from random import Random
+from threading import Lock
+from uuid import uuid4
+from traceback import format_exc
+
+
+FIXTURES_FILENAME = 'fixtures.json'
+
+
+def write_fixtures(directory, fixtures):
+    """Writes a fixture set
+
+    Parameters
+    ----------
+    directory : str
+        The folder of the fixture set
+    fixtures : dict
+        The fixtures, see LocalQiita
+    """
+    with open(join(directory, FIXTURES_FILENAME), 'w') as f:
+        dump(fixtures, f, indent=4)
+
+
+class LocalQiita(object):
+    """An in-process stand-in for the Qiita REST API
+
+    Implements the QiitaClient methods and the endpoints used by the plugin
+    so jobs can run without a Qiita server, for example to benchmark or load
+    test the plugin.
+
+    Parameters
+    ----------
+    fixtures : dict
+        The data to serve, with the keys:
+        - artifacts: {artifact id: {'files': {filepath type: [filepaths]},
+          'analysis': analysis id or None, 'type': artifact type}}
+        - analyses: {analysis id: {'metadata': {sample: {column: value}}}}
+        - jobs: {job id: {'command': [plugin, version, command name],
+          'parameters': {parameter: value}}}, optional
+    base_dir : str, optional
+        The folder against which the relative filepaths of the artifacts are
+        resolved
+    latency : float, optional
+        Seconds added to each request
+    jitter : float, optional
+        Maximum random seconds added to each request on top of latency
+    seed : int, optional
+        The seed of the jitter
+
+    Notes
+    -----
+    All the requests are recorded in `requests` as (method, url, seconds)
+    and the state of the jobs (steps and completion) in `jobs`. Instances
+    can be shared by several threads.
+    """
+    _server_url = 'local'
+
+    def __init__(self, fixtures, base_dir=None, latency=0, jitter=0,
+                 seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.requests = []
+        self.plugins = {}
+        self._random = Random(seed)
+        self._lock = Lock()
+
+        self.artifacts = {}
+        for aid, artifact in fixtures.get('artifacts', {}).items():
+            artifact = dict(artifact)
+            artifact['files'] = {
+                fpt: [fp if base_dir is None or isabs(fp)
+                      else join(base_dir, fp) for fp in fps]
+                for fpt, fps in artifact['files'].items()}
+            self.artifacts[str(aid)] = artifact
+        self.analyses = {str(k): v
+                         for k, v in fixtures.get('analyses', {}).items()}
+        self.jobs = {}
+        for jid, job in fixtures.get('jobs', {}).items():
+            self.create_job(job['command'], job['parameters'], job_id=jid)
+
+        self._routes = [
+            ('GET', r'/qiita_db/artifacts/([^/]+)/', self._get_artifact),
+            ('GET', r'/qiita_db/analysis/([^/]+)/metadata/',
+             self._get_metadata),
+            ('GET', r'/qiita_db/jobs/([^/]+)/', self._get_job),
+            ('POST', r'/qiita_db/jobs/([^/]+)/step/', self._post_step),
+            ('POST', r'/qiita_db/jobs/([^/]+)/heartbeat/', self._heartbeat),
+            ('POST', r'/qiita_db/jobs/([^/]+)/complete/', self._complete),
+            ('POST', r'/apitest/processing_job/', self._post_job),
+            ('GET', r'/qiita_db/plugins/([^/]+)/([^/]+)/', self._get_plugin),
+            ('POST', r'/qiita_db/plugins/([^/]+)/([^/]+)/commands/',
+             self._post_command)]
+
+    @classmethod
+    def from_directory(cls, directory, **kwargs):
+        """Loads a fixture set written with write_fixtures
+
+        Parameters
+        ----------
+        directory : str
+            The folder of the fixture set, the relative filepaths are
+            resolved against it
+        kwargs : dict, optional
+            The other parameters of LocalQiita
+
+        Returns
+        -------
+        LocalQiita
+        """
+        with open(join(directory, FIXTURES_FILENAME)) as f:
+            fixtures = load(f)
+        return cls(fixtures, base_dir=directory, **kwargs)
+
+    def _request(self, method, url, data=None):
+        start = time()
+        delay = self.latency
+        if self.jitter:
+            with self._lock:
+                delay += self._random.uniform(0, self.jitter)
+        if delay:
+            sleep(delay)
+
+        if isinstance(data, (str, bytes)):
+            data = loads(data)
+        # the trailing slash is optional, like in tornado
+        path = url.split('?')[0].rstrip('/') + '/'
+        try:
+            for rmethod, pattern, handler in self._routes:
+                match = re.fullmatch(pattern, path)
+                if rmethod == method and match is not None:
+                    with self._lock:
+                        return handler(data, *match.groups())
+            raise KeyError(url)
+        except KeyError:
+            raise RuntimeError(
+                "Request '%s %s' did not succeed. Status code: 404. "
+                "Message: Not found" % (method, url))
+        finally:
+            with self._lock:
+                self.requests.append((method, url, time() - start))
+
+    # QiitaClient interface
+    def get(self, url, **kwargs):
+        return self._request('GET', url)
+
+    def post(self, url, data=None, **kwargs):
+        return self._request('POST', url, data)
+
+    def patch(self, url, op, path, value=None, from_p=None, **kwargs):
+        raise RuntimeError(
+            "Request 'PATCH %s' did not succeed. Status code: 405. "
+            "Message: Not supported" % url)
+
+    def get_job_info(self, job_id):
+        return self.get('/qiita_db/jobs/%s/' % job_id)
+
+    def update_job_step(self, job_id, new_step, ignore_error=False):
+        try:
+            self.post('/qiita_db/jobs/%s/step/' % job_id,
+                      data={'step': new_step})
+        except RuntimeError:
+            if not ignore_error:
+                raise
+
+    def start_heartbeat(self, job_id):
+        self.post('/qiita_db/jobs/%s/heartbeat/' % job_id)
+
+    def complete_job(self, job_id, success, error_msg=None,
+                     artifacts_info=None):
+        if artifacts_info:
+            artifacts_info = {
+                a.output_name: {'filepaths': a.files,
+                                'artifact_type': a.artifact_type}
+                for a in artifacts_info}
+        self.post('/qiita_db/jobs/%s/complete/' % job_id,
+                  data={'success': success, 'error': error_msg,
+                        'artifacts': artifacts_info})
+
+    def create_job(self, command, parameters, job_id=None):
+        """Creates a job, like /apitest/processing_job/
+
+        Parameters
+        ----------
+        command : list of str
+            The plugin name, version and command name
+        parameters : dict
+            The parameters of the job
+        job_id : str, optional
+            The id of the job, a new uuid by default
+
+        Returns
+        -------
+        str
+            The id of the job
+        """
+        job_id = str(job_id) if job_id is not None else str(uuid4())
+        self.jobs[job_id] = {
+            'command': command, 'parameters': parameters,
+            'status': 'queued', 'msg': '', 'steps': [], 'heartbeats': 0,
+            'artifacts': None}
+        return job_id
+
+    # endpoints
+    def _get_artifact(self, data, aid):
+        artifact = self.artifacts[aid]
+        return {'name': artifact.get('name', 'artifact %s' % aid),
+                'type': artifact.get('type'),
+                'analysis': artifact.get('analysis'),
+                'study': None, 'prep_information': [],
+                'files': artifact['files']}
+
+    def _get_metadata(self, data, analysis_id):
+        return self.analyses[analysis_id]['metadata']
+
+    def _get_job(self, data, job_id):
+        job = self.jobs[job_id]
+        return {'command': job['command'], 'parameters': job['parameters'],
+                'status': job['status'], 'msg': job['msg']}
+
+    def _post_step(self, data, job_id):
+        job = self.jobs[job_id]
+        job['status'] = 'running'
+        job['steps'].append(data['step'])
+
+    def _heartbeat(self, data, job_id):
+        job = self.jobs[job_id]
+        job['status'] = 'running'
+        job['heartbeats'] += 1
+
+    def _complete(self, data, job_id):
+        job = self.jobs[job_id]
+        job['status'] = 'success' if data['success'] else 'error'
+        job['msg'] = data['error'] or ''
+        job['artifacts'] = data['artifacts']
+
+    def _post_job(self, data):
+        command = data['command']
+        parameters = data['parameters']
+        if isinstance(command, str):
+            command = loads(command)
+        if isinstance(parameters, str):
+            parameters = loads(parameters)
+        return {'job': self.create_job(command, parameters)}
+
+    def _get_plugin(self, data, name, version):
+        plugin = self.plugins.get((name, version), {})
+        return {'name': name, 'version': version,
+                'commands': list(plugin)}
+
+    def _post_command(self, data, name, version):
+        self.plugins.setdefault((name, version), {})[data['name']] = data
+
+
+def run_job(qclient, job_id, output_dir):
+    """Runs a job the way QiitaPlugin does
+
+    Parameters
+    ----------
+    qclient : LocalQiita or qiita_client.QiitaClient
+        The Qiita server client
+    job_id : str
+        The job id
+    output_dir : str
+        The output directory
+
+    Returns
+    -------
+    bool, list of ArtifactInfo, str
+        The result of the job, see call_qiime2
+    """
+    from .qp_qiime2 import call_qiime2
+    from .pipeline import PIPELINE_COMMAND, call_pipeline
+
+    job_info = qclient.get_job_info(job_id)
+    # QiitaPlugin finds the function of the job from its command name
+    command = job_info['command']
+    if not isinstance(command, str):
+        command = command[-1]
+    function = (call_pipeline if command == PIPELINE_COMMAND['name']
+                else call_qiime2)
+    qclient.start_heartbeat(job_id)
+    try:
+        success, ainfo, msg = function(
+            qclient, job_id, job_info['parameters'], output_dir)
+    except Exception:
+        success, ainfo, msg = False, None, format_exc()
+    qclient.complete_job(job_id, success, msg, ainfo)
+    return success, ainfo, msg
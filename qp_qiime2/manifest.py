@@ -0,0 +1,463 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from os import environ, makedirs, replace, remove
+from copy import deepcopy
+from os.path import join, expanduser, dirname, exists
+from json import dumps, load, dump
+from tempfile import NamedTemporaryFile
+
+try:
+    from importlib.metadata import distributions, version, PackageNotFoundError
+except ImportError:
+    # python < 3.8
+    from importlib_metadata import (
+        distributions, version, PackageNotFoundError)
+
+from qiime2 import __version__ as qiime2_version
+
+from .qp_qiime2 import (
+    QIITA_Q2_SEMANTIC_TYPE, Q2_QIITA_SEMANTIC_TYPE, Q2_ALLOWED_PLUGINS,
+    PRIMITIVE_TYPES, RENAME_COMMANDS, FANOUT_COMMANDS, PARALLELISM_PARAMETERS)
+
+
+# bump this number every time the way we translate the Q2 methods to Qiita
+# commands changes so old manifests are not reused
+MANIFEST_FORMAT = 3
+
+
+def get_manifest_fp():
+    """Returns the filepath of the command manifest
+
+    Returns
+    -------
+    str
+        The value of the QP_QIIME2_MANIFEST environment variable, if set, or
+        a file next to the plugin configuration in ~/.qiita_plugins/
+    """
+    fp = environ.get('QP_QIIME2_MANIFEST')
+    if not fp:
+        fp = join(expanduser('~'), '.qiita_plugins',
+                  'qp-qiime2_%s_manifest.json' % qiime2_version)
+    return fp
+
+
+def get_version(name):
+    """Returns the version of an installed distribution
+
+    Parameters
+    ----------
+    name : str
+        The name of the distribution, like qp-qiime2
+
+    Returns
+    -------
+    str or None
+        The version, None if the distribution is not installed
+    """
+    try:
+        return version(name)
+    except PackageNotFoundError:
+        return None
+
+
+def get_manifest_key():
+    """Returns the key that identifies the installation the manifest is for
+
+    Returns
+    -------
+    dict
+        The manifest format, the versions of qp-qiime2 and qiime2 and the
+        version of each of the installed Q2 plugins
+
+    Notes
+    -----
+    The plugin versions are read from the entry points metadata so none of
+    the plugins is actually imported.
+    """
+    # imported here as the manifest is generated while importing qp_qiime2
+    from qp_qiime2 import __version__
+
+    plugins = {
+        ep.name: dist.version
+        for dist in distributions() for ep in dist.entry_points
+        if ep.group == 'qiime2.plugins'}
+    return {'format': MANIFEST_FORMAT, 'qp-qiime2': __version__,
+            'qiime2': qiime2_version, 'plugins': plugins}
+
+
+def generate_commands():
+    """Translates the Q2 methods to Qiita commands
+
+    Returns
+    -------
+    list of dict
+        The name, description, req_params, opt_params and outputs of each
+        of the Qiita commands
+
+    Raises
+    ------
+    ValueError
+        If there is a new primitive type or an unexpected choice parameter
+        without default
+    """
+    from qiime2.sdk.util import actions_by_input_type
+
+    commands = []
+    # PLEASE READ:
+    # We are going loop over QIITA_Q2_SEMANTIC_TYPE (lookup table)
+    # so we can retrieve the q2plugin and their methods that work with that
+    # given Q2/Qiita semantic type. Then we will ignore any plugin not in
+    # Q2_ALLOWED_PLUGINS so we avoid adding plugins that we don't want; like
+    # deblur or dada2. Finally, we are going to loop over the different
+    # inputs, outputs and parameters from Q2 and convert them to QIITA's
+    # req_params, opt_params and outputs.
+    # Also, note that Qiita users like to have descriptions of the paramters
+    # (q2-description) vs. the parameter itself (q2-parameter) so to allow
+    # this we are going to store each parameter twice: one in the
+    # opt_params[q2-description]: value; and
+    # req_params['qp-hide-param' + q2-description]: q2-parameter
+    for q2_artifact in QIITA_Q2_SEMANTIC_TYPE.values():
+        for q2plugin, methods in actions_by_input_type(str(q2_artifact)):
+            if q2plugin.name not in Q2_ALLOWED_PLUGINS:
+                # This currently filters (which are processing commands):
+                # feature-classifier
+                # quality-control
+                # vsearch
+                # fragment-insertion
+                continue
+
+            for m in methods:
+                command = _translate_method(q2plugin.name, m)
+                if command is None:
+                    continue
+                commands.append(command)
+                if q2plugin.name != 'diversity':
+                    continue
+                for (mid, pname), atype in FANOUT_COMMANDS.items():
+                    if mid == m.id:
+                        commands.append(
+                            _fanout_command(command, mid, pname, atype))
+
+    return commands
+
+
+def _translate_method(qname, m):
+    """Translates a single Q2 method to a Qiita command
+
+    Parameters
+    ----------
+    qname : str
+        The name of the Q2 plugin the method belongs to
+    m : qiime2.sdk.Action
+        The Q2 method
+
+    Returns
+    -------
+    dict or None
+        The Qiita command or None if the method can't be used in Qiita
+    """
+    inputs = m.signature.inputs.copy()
+    outputs = m.signature.outputs.copy()
+    parameters = m.signature.parameters.copy()
+    add_method = True
+
+    # storing this information in req_params so we can use internally
+    # while calling call_qiime2
+    req_params = {'qp-hide-plugin': ('string', qname),
+                  'qp-hide-method': ('string', m.id)}
+    for pname, element in inputs.items():
+        if element.qiime_type not in Q2_QIITA_SEMANTIC_TYPE:
+            add_method = False
+            break
+        etype = Q2_QIITA_SEMANTIC_TYPE[element.qiime_type]
+        if etype.startswith('BIOM'):
+            etype = 'BIOM'
+
+        # these are special types as we can retrive internally
+        if etype == 'phylogeny':
+            ename = 'Phylogenetic tree'
+            req_params[ename] = (
+                'choice:["None", "Artifact tree, if exists"]', 'None')
+            # deleting so we don't count it as part of the inputs
+            del inputs[pname]
+        elif etype == 'taxonomy':
+            ename = 'qp-hide-%s' % etype
+            req_params[ename] = ('string', etype)
+            # deleting so we don't count it as part of the inputs
+            del inputs[pname]
+            # we are going to continue so we don't add this element
+            # twice
+            continue
+        else:
+            ename = element.description
+            req_params[ename] = ('artifact', [etype])
+        # we need to add the actual name of the parameter so we
+        # can retrieve later
+        req_params['qp-hide-param' + ename] = ('string', pname)
+
+    outputs_params = {}
+    for pname, element in outputs.items():
+        if element.qiime_type not in Q2_QIITA_SEMANTIC_TYPE:
+            add_method = False
+            break
+        else:
+            etype = Q2_QIITA_SEMANTIC_TYPE[element.qiime_type]
+            if etype.startswith('BIOM'):
+                etype = 'BIOM'
+            # this one is to "fix" the templates for phylogenetic
+            # methods, like phylogenetic_distance_matrix
+            elif etype.startswith('phylogenetic_'):
+                etype = etype[len('phylogenetic_'):]
+            outputs_params[pname] = etype
+
+    if len(inputs) != 1 or not add_method:
+        # This is currently filtering out:
+        # emperor procrustes_plot
+        # diversity procrustes_analysis
+        # diversity pcoa_biplot
+        # diversity mantel
+        # longitudinal first_distances
+        # sample-classifier classify_samples_from_dist
+        # diversity pcoa_biplot
+        # gneiss gradient_clustering
+        # feature-table summarize
+        # feature-table presence_absence
+        # longitudinal plot_feature_volatility
+        # longitudinal first_differences
+        # gneiss ilr_phylogenetic
+        # gneiss correlation_clustering
+        # gneiss assign_ids
+        # gneiss gradient_clustering
+        # gneiss dendrogram_heatmap
+        # gneiss balance_taxonomy
+        # gneiss ilr_hierarchical
+        # feature-table filter_seqs
+        # feature-table summarize
+        # feature-table presence_absence
+        # longitudinal maturity_index
+        # longitudinal feature_volatility
+        # phylogeny filter_table
+        # sample-classifier classify_samples
+        # sample-classifier predict_regression
+        # sample-classifier fit_regressor
+        # sample-classifier fit_classifier
+        # sample-classifier regress_samples_ncv
+        # sample-classifier regress_samples
+        # sample-classifier classify_samples_ncv
+        # sample-classifier predict_classification
+        # composition add_pseudocount
+        # feature-table summarize
+        return None
+
+    opt_params = {}
+    for pname, element in parameters.items():
+        # these are set by call_qiime2 to the CPUs of the job
+        if pname in PARALLELISM_PARAMETERS:
+            continue
+        tqt = type(element.qiime_type)
+        # there is a new primitive and we should raise an error
+        if tqt not in PRIMITIVE_TYPES:
+            raise ValueError(
+                'There is a new type: %s' % element.qiime_type)
+
+        # predicate are the options for each parameter, note that it
+        # can be a Choice/List or a Range (for Int/Floats). We ignore
+        # numeric because they are ranges and we don't support ranges
+        # in Qiita.
+        # Note, the correct way to retrieve the latter is:
+        # p.start, p.end, p.inclusive_start, p.inclusive_end
+        # but for simplicity we will only retrive the
+        predicate = element.qiime_type.predicate
+        data_type = PRIMITIVE_TYPES[tqt]
+        default = element.default
+        if (predicate is not None and PRIMITIVE_TYPES[tqt] not in (
+                                      'float', 'integer')):
+            vals = list(predicate.iter_boundaries())
+            data_type = 'choice:%s' % dumps(vals)
+            default = vals[0]
+
+        mid = m.id
+        # if we are in the diversity plugin, the method starts with
+        # alpha/beta, and the parameter is 'metric', we might want
+        # to replace the technical names for user friendly ones
+        value_pair = (mid, pname)
+        if qname == 'diversity' and value_pair in RENAME_COMMANDS:
+            # converting to list to the serialize doesn't complaint
+            vals = list(RENAME_COMMANDS[value_pair])
+            data_type = 'choice:%s' % dumps(vals)
+            default = vals[0]
+
+        # the diversity methods can have a choice param with no values
+        # so we need to fix so users can actually select things;
+        # however,we want to make sure that this is the only one,
+        # if not, raise an error
+        if data_type == 'choice' and default is None:
+            if qname == 'emperor' and mid == 'plot':
+                data_type = 'string'
+                default = ''
+            else:
+                error_msg = (
+                    "There is an unexpected method (%s %s) with a "
+                    "choice parameter (%s: %s), without default" % (
+                        qname, mid, pname, element.description))
+                raise ValueError(error_msg)
+
+        if pname == 'metadata':
+            # Q2 does some CLI magic when dealing with mapping
+            # files, if the method requires a column, the CLI will
+            # request the filepath, parse it and then pass as metadata
+            # column. For fun, both cases full/column metadata are
+            # called metadata. However, for Qiita we will need to make
+            # this difference more obvious.
+            if data_type == 'string':
+                # as this one needs input from the user, we will create
+                # as any other opt_params
+                name = "Metadata column to use"
+                opt_params[name] = ('string', '')
+                name = 'qp-hide-param' + name
+                opt_params[name] = ('string', 'qp-hide-metadata-field')
+            else:
+                opt_params['qp-hide-metadata'] = ('string', pname)
+        else:
+            ename = '%s (%s)' % (element.description, pname)
+            if element.has_default():
+                opt_params[ename] = (data_type, default)
+                # we need to add the actual name of the parameter so we
+                # can retrieve later
+                opt_params['qp-hide-param' + ename] = ('string', pname)
+            else:
+                default = (default if default is not element.NOVALUE
+                           else 'None')
+                req_params[ename] = (data_type, default)
+                # we need to add the actual name of the parameter so we
+                # can retrieve later
+                req_params['qp-hide-param' + ename] = ('string', pname)
+
+    return {'name': m.name, 'description': m.description,
+            'req_params': req_params, 'opt_params': opt_params,
+            'outputs': outputs_params}
+
+
+def _fanout_command(command, mid, pname, atype):
+    """Generates the multiple values (fan-out) version of a command
+
+    Parameters
+    ----------
+    command : dict
+        The command, as generated by _translate_method
+    mid : str
+        The id of the Q2 method
+    pname : str
+        The name of the parameter that will accept multiple values
+    atype : str
+        The Qiita semantic type of the outputs
+
+    Returns
+    -------
+    dict
+        The new command: pname becomes a multiple choice parameter and there
+        is an output per value, named <original output>_<value>
+    """
+    command = deepcopy(command)
+    command['name'] = '%s (multiple metrics)' % command['name']
+    command['description'] = '%s Computes several metrics at once.' % (
+        command['description'])
+
+    vals = list(RENAME_COMMANDS[(mid, pname)])
+    for params in (command['req_params'], command['opt_params']):
+        for ename, (data_type, default) in list(params.items()):
+            if params.get('qp-hide-param' + ename) == ('string', pname):
+                params[ename] = ('mchoice:%s' % dumps(vals), [vals[0]])
+    command['req_params']['qp-hide-fanout'] = ('string', pname)
+
+    output = list(command['outputs'])[0]
+    command['outputs'] = {
+        '%s_%s' % (output, value): atype
+        for value in RENAME_COMMANDS[(mid, pname)].values()}
+
+    return command
+
+
+def load_manifest(fp, key):
+    """Loads the commands stored in a manifest
+
+    Parameters
+    ----------
+    fp : str
+        The manifest filepath
+    key : dict
+        The expected key of the manifest, see get_manifest_key
+
+    Returns
+    -------
+    list of dict or None
+        The commands stored in the manifest, None if the manifest doesn't
+        exist, can't be read or was generated for a different installation
+    """
+    if not exists(fp):
+        return None
+    try:
+        with open(fp) as f:
+            manifest = load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(manifest, dict) or manifest.get('key') != key:
+        return None
+    return manifest.get('commands')
+
+
+def write_manifest(fp, key, commands):
+    """Writes the commands to a manifest
+
+    Parameters
+    ----------
+    fp : str
+        The manifest filepath
+    key : dict
+        The key of the manifest, see get_manifest_key
+    commands : list of dict
+        The commands to store, see generate_commands
+
+    Notes
+    -----
+    The manifest is written to a temporary file and then moved in place so
+    concurrent jobs never read a partially written manifest.
+    """
+    makedirs(dirname(fp), exist_ok=True)
+    with NamedTemporaryFile('w', dir=dirname(fp), delete=False,
+                            suffix='.tmp') as f:
+        dump({'key': key, 'commands': commands}, f)
+    try:
+        replace(f.name, fp)
+    except OSError:
+        remove(f.name)
+        raise
+
+
+def get_commands():
+    """Returns the Qiita commands, from the manifest if it is up to date
+
+    Returns
+    -------
+    list of dict
+        The name, description, req_params, opt_params and outputs of each
+        of the Qiita commands
+    """
+    fp = get_manifest_fp()
+    key = get_manifest_key()
+    commands = load_manifest(fp, key)
+    if commands is None:
+        commands = generate_commands()
+        try:
+            write_manifest(fp, key, commands)
+        except OSError:
+            # not being able to store the manifest only means that the next
+            # run will have to walk the Q2 methods again
+            pass
+    return commands
@@ -0,0 +1,194 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+import re
+from os import mkdir, environ
+from os.path import join
+from json import dumps, load, dump
+from hashlib import sha256
+from time import time
+
+import numpy as np
+import pandas as pd
+
+import qiime2
+
+from .cache import get_cache
+
+
+# this is the regular expression that qiime2.Metadata.load uses to decide if
+# a value is numeric, note that it doesn't accept values like nan or inf
+NUMERIC_REGEX = re.compile(r'^[+-]?(\d+(\.\d*)?|\.\d+)([eE][+-]?\d+)?$')
+
+# number of seconds we trust the cached metadata of an analysis before
+# checking with Qiita that it hasn't changed; by default it is always checked
+# as the metadata can be edited at any time
+DEFAULT_METADATA_CACHE_TTL = 0
+
+
+def _to_metadata_value(value):
+    """Converts a value to the string that qiime2 would read from a file"""
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return np.nan
+    value = str(value).strip()
+    return value if value else np.nan
+
+
+def _is_numeric(value):
+    return isinstance(value, float) or NUMERIC_REGEX.match(value) is not None
+
+
+def metadata_dataframe(metadata):
+    """Generates the DataFrame that qiime2.Metadata.load would generate
+
+    Parameters
+    ----------
+    metadata : dict of {str: dict of {str: object}}
+        The metadata as returned by Qiita: {sample_id: {column: value}}
+
+    Returns
+    -------
+    pd.DataFrame
+        The metadata with the types of the columns inferred as qiime2 does
+        when loading a metadata file: if all the non empty values of a column
+        are numbers the column is numeric, otherwise it is categorical
+
+    Notes
+    -----
+    Before, we wrote the metadata to a file and loaded it with
+    qiime2.Metadata.load so Qiime2 assigned the expected data types to the
+    columns; this is the same inference done in memory.
+    """
+    df = pd.DataFrame.from_dict(metadata, orient='index')
+    df.index = df.index.map(lambda x: str(x).strip())
+    df.index.name = '#SampleID'
+    df.columns = [str(c).strip() for c in df.columns]
+    df = df.astype(object).apply(lambda x: x.map(_to_metadata_value))
+    for column in df.columns:
+        series = df[column]
+        if series.apply(_is_numeric).all():
+            df[column] = pd.to_numeric(series, errors='raise')
+    return df
+
+
+def build_metadata(metadata):
+    """Generates a qiime2.Metadata from the Qiita metadata
+
+    Parameters
+    ----------
+    metadata : dict of {str: dict of {str: object}}
+        The metadata as returned by Qiita: {sample_id: {column: value}}
+
+    Returns
+    -------
+    qiime2.Metadata
+        The metadata
+    """
+    return qiime2.Metadata(metadata_dataframe(metadata))
+
+
+def _write_columns(fp, df):
+    """Stores each column of the metadata in its own file"""
+    mkdir(fp)
+    df.index.to_series().to_pickle(join(fp, 'index.pkl'))
+    columns = []
+    for i, column in enumerate(df.columns):
+        df[column].to_pickle(join(fp, '%d.pkl' % i))
+        columns.append(column)
+    with open(join(fp, 'columns.json'), 'w') as f:
+        dump(columns, f)
+
+
+def _read_columns(fp, columns=None):
+    """Loads the stored metadata, only reading the requested columns"""
+    with open(join(fp, 'columns.json')) as f:
+        stored = load(f)
+    index = pd.read_pickle(join(fp, 'index.pkl'))
+    df = pd.DataFrame(index=pd.Index(index.values, name=index.name))
+    for i, column in enumerate(stored):
+        if columns is None or column in columns:
+            df[column] = pd.read_pickle(join(fp, '%d.pkl' % i)).values
+    return df
+
+
+def get_analysis_metadata(qclient, analysis_id, columns=None):
+    """Retrieves the metadata of an analysis
+
+    Parameters
+    ----------
+    qclient : qiita_client.QiitaClient
+        The Qiita server client
+    analysis_id : int or str
+        The analysis id
+    columns : list of str, optional
+        The columns to load, all of them if None
+
+    Returns
+    -------
+    qiime2.Metadata
+        The metadata of the analysis
+
+    Notes
+    -----
+    If the 'metadata' cache is enabled (see cache.get_cache) the parsed
+    metadata is stored one column per file, keyed on the analysis id and
+    the fingerprint of the contents returned by Qiita, so the metadata is
+    always downloaded but not parsed again unless its contents have changed.
+    If QP_QIIME2_METADATA_CACHE_TTL is set to a number of seconds, the
+    fingerprint of an analysis is trusted for that long, during which the
+    metadata is not downloaded again, even if it changed in Qiita.
+    """
+    url = "/qiita_db/analysis/%s/metadata/" % str(analysis_id)
+    cache = get_cache('metadata')
+    if cache is None:
+        return build_metadata(qclient.get(url))
+
+    ttl = float(environ.get(
+        'QP_QIIME2_METADATA_CACHE_TTL', DEFAULT_METADATA_CACHE_TTL))
+    analysis_key = cache.key(
+        getattr(qclient, '_server_url', ''), str(analysis_id))
+
+    pointer_fp = cache.get(analysis_key) if ttl > 0 else None
+    if pointer_fp is not None:
+        try:
+            with open(pointer_fp) as f:
+                pointer = load(f)
+            if time() - pointer['timestamp'] < ttl:
+                entry_fp = cache.get(
+                    cache.key(analysis_key, pointer['fingerprint']))
+                if entry_fp is not None:
+                    return qiime2.Metadata(_read_columns(entry_fp, columns))
+        except Exception:
+            # the entry was evicted or is corrupted so we retrieve it again
+            pass
+
+    metadata = qclient.get(url)
+    fingerprint = sha256(
+        dumps(metadata, sort_keys=True).encode('utf-8')).hexdigest()
+    entry_key = cache.key(analysis_key, fingerprint)
+
+    df = None
+    entry_fp = cache.get(entry_key)
+    if entry_fp is not None:
+        try:
+            df = _read_columns(entry_fp, columns)
+        except Exception:
+            pass
+    if df is None:
+        df = metadata_dataframe(metadata)
+        with cache.put(entry_key) as fp:
+            _write_columns(fp, df)
+        if columns is not None:
+            df = df[[c for c in df.columns if c in columns]]
+
+    if ttl > 0:
+        with cache.put(analysis_key, overwrite=True) as fp:
+            with open(fp, 'w') as f:
+                dump({'fingerprint': fingerprint, 'timestamp': time()}, f)
+
+    return qiime2.Metadata(df)
@@ -0,0 +1,505 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from os import mkdir
+from os.path import join, exists
+from json import loads
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .resources import get_cpu_count
+from .profiling import JobProfile, PROFILE_FILENAME
+from .prefetch import QiitaPrefetcher
+from .scratch import JobScratch
+
+
+INPUT_PARAMETER = 'The feature table the pipeline starts from'
+PIPELINE_PARAMETER = 'The steps of the pipeline and its outputs, as JSON'
+
+# the Qiita types of the outputs of the pipeline: each output requested is
+# returned as the output named after its type, so there can only be one
+# output of each type
+PIPELINE_OUTPUTS = ['BIOM', 'distance_matrix', 'ordination_results',
+                    'alpha_vector', 'q2_visualization']
+
+PIPELINE_COMMAND = {
+    'name': 'Run a pipeline',
+    'description': (
+        'Runs several Qiime2 methods in a single job, passing the results of '
+        'each method to the next ones without storing them in Qiita. Only '
+        'the outputs listed in the pipeline are returned.'),
+    'req_params': {INPUT_PARAMETER: ('artifact', ['BIOM']),
+                   PIPELINE_PARAMETER: ('string', '')},
+    'opt_params': {},
+    'outputs': {atype: atype for atype in PIPELINE_OUTPUTS}}
+
+# the data of the input artifact that the steps can use, besides the outputs
+# of other steps; a metadata column is used as 'metadata:<column>'
+PIPELINE_SOURCES = ('table', 'tree', 'taxonomy', 'metadata')
+
+
+def _parse_source(source):
+    """Splits the source of a step input in (step, output)
+
+    The step is None for the PIPELINE_SOURCES
+    """
+    if not isinstance(source, str):
+        raise ValueError('Invalid source: %r' % (source, ))
+    if source in PIPELINE_SOURCES or source.startswith('metadata:'):
+        return None, source
+    step, sep, output = source.partition('.')
+    if not sep or not step or not output:
+        raise ValueError('Invalid source: "%s", it must be one of %s or '
+                         '"<step>.<output>"' % (
+                             source, ', '.join(PIPELINE_SOURCES)))
+    return step, output
+
+
+def parse_pipeline(pipeline):
+    """Validates a pipeline and finds the dependencies of its steps
+
+    Parameters
+    ----------
+    pipeline : str or dict
+        The pipeline, as a JSON object or string, with the keys:
+        - steps: {step name: {'action': '<Q2 plugin>.<Q2 method>',
+          'inputs': {name: source}, 'parameters': {name: value}}}, where
+          each source is one of PIPELINE_SOURCES, 'metadata:<column>' or
+          '<step>.<output>' to use the output of another step
+        - outputs: list of '<step>.<output>', the results to return
+
+    Returns
+    -------
+    dict, dict, list of (str, str)
+        The steps, {name: {'plugin', 'method', 'inputs', 'parameters'}},
+        their dependencies, {name: set of step names}, and the outputs as
+        (step, output). Only the steps needed to generate the outputs are
+        returned
+
+    Raises
+    ------
+    ValueError
+        If the pipeline is not valid: it has no steps or outputs, a step
+        uses a step that doesn't exist, or the steps depend on each other
+    """
+    if isinstance(pipeline, str):
+        try:
+            pipeline = loads(pipeline)
+        except ValueError:
+            raise ValueError('The pipeline is not valid JSON')
+    if not isinstance(pipeline, dict) or not pipeline.get('steps'):
+        raise ValueError('The pipeline has no steps')
+    if not pipeline.get('outputs'):
+        raise ValueError('The pipeline has no outputs')
+
+    steps = {}
+    dependencies = {}
+    for name, step in pipeline['steps'].items():
+        if name in PIPELINE_SOURCES or '.' in name or ':' in name:
+            raise ValueError('Invalid step name: "%s"' % name)
+        action = step.get('action') if isinstance(step, dict) else None
+        q2plugin, sep, q2method = (action or '').partition('.')
+        if not sep or not q2plugin or not q2method:
+            raise ValueError('Step "%s" has no valid action, it must be '
+                             '"<plugin>.<method>"' % name)
+        inputs = step.get('inputs', {})
+        parameters = step.get('parameters', {})
+        if not isinstance(inputs, dict) or not isinstance(parameters, dict):
+            raise ValueError('The inputs and parameters of step "%s" must be '
+                             'objects' % name)
+        steps[name] = {'plugin': q2plugin,
+                       'method': q2method.replace('-', '_'),
+                       'inputs': inputs, 'parameters': parameters}
+        dependencies[name] = set()
+        for source in inputs.values():
+            dependency, _ = _parse_source(source)
+            if dependency is not None:
+                dependencies[name].add(dependency)
+
+    for name, deps in dependencies.items():
+        for dependency in deps:
+            if dependency not in steps:
+                raise ValueError('Step "%s" uses "%s", which is not a step '
+                                 'of the pipeline' % (name, dependency))
+
+    outputs = []
+    for source in pipeline['outputs']:
+        step, output = _parse_source(source)
+        if step not in steps:
+            raise ValueError('The output "%s" is not the output of a step '
+                             'of the pipeline' % source)
+        outputs.append((step, output))
+
+    # the steps whose results are not used by the outputs are not run
+    needed = set()
+    stack = [step for step, _ in outputs]
+    while stack:
+        step = stack.pop()
+        if step not in needed:
+            needed.add(step)
+            stack.extend(dependencies[step])
+    steps = {k: v for k, v in steps.items() if k in needed}
+    dependencies = {k: v for k, v in dependencies.items() if k in needed}
+
+    # making sure there are no cycles, removing the steps that can run once
+    # their dependencies did until there is nothing left
+    remaining = dict(dependencies)
+    while remaining:
+        ready = {k for k, deps in remaining.items()
+                 if not deps.intersection(remaining)}
+        if not ready:
+            raise ValueError('The steps %s depend on each other' % ', '.join(
+                '"%s"' % k for k in sorted(remaining)))
+        remaining = {k: v for k, v in remaining.items() if k not in ready}
+
+    return steps, dependencies, outputs
+
+
+def run_dag(dependencies, run_step, max_workers=None):
+    """Runs each step of a DAG as soon as its dependencies finish
+
+    Parameters
+    ----------
+    dependencies : dict of {str: set of str}
+        The steps and the steps each of them depends on, without cycles
+    run_step : callable
+        Runs a step, called as run_step(step, results) where results are the
+        results of all the steps finished so far; returns the result of the
+        step
+    max_workers : int, optional
+        The maximum number of steps to run concurrently, defaults to the
+        number of CPUs the job can use
+
+    Returns
+    -------
+    dict of {str: object}
+        The result of each step
+
+    Notes
+    -----
+    The independent steps run concurrently in a thread pool. If a step
+    raises an exception, no other step is started and the exception is
+    raised once the running steps finish.
+    """
+    if max_workers is None:
+        max_workers = get_cpu_count()
+    results = {}
+    pending = dict(dependencies)
+    running = {}
+    with ThreadPoolExecutor(max_workers) as executor:
+        while pending or running:
+            for step in sorted(pending):
+                if pending[step].issubset(results):
+                    del pending[step]
+                    future = executor.submit(run_step, step, dict(results))
+                    running[future] = step
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+    return results
+
+
+def dag_width(dependencies):
+    """Returns the maximum number of steps of a DAG that can run at once
+
+    Parameters
+    ----------
+    dependencies : dict of {str: set of str}
+        The steps and the steps each of them depends on, without cycles
+
+    Returns
+    -------
+    int
+        The number of steps of the widest level of the DAG, where the level
+        of a step is the length of the longest chain of steps it depends on
+    """
+    levels = {}
+    remaining = dict(dependencies)
+    while remaining:
+        ready = [k for k, v in remaining.items() if v.issubset(levels)]
+        for step in ready:
+            levels[step] = 1 + max(
+                [levels[d] for d in remaining.pop(step)], default=-1)
+    counts = {}
+    for level in levels.values():
+        counts[level] = counts.get(level, 0) + 1
+    return max(counts.values(), default=1)
+
+
+def call_pipeline(qclient, job_id, parameters, out_dir):
+    """Runs a pipeline of Q2 methods, see PIPELINE_COMMAND
+
+    Parameters
+    ----------
+    qclient : qiita_client.QiitaClient
+        The Qiita server client
+    job_id : str
+        The job id
+    parameters : dict
+        The parameter values to process
+    out_dir : str
+        The path to the job's output directory
+
+    Returns
+    -------
+    boolean, list, str
+        The results of the job
+    """
+    profile = JobProfile(job_id)
+    scratch = JobScratch(job_id)
+    try:
+        with profile.phase('job'), QiitaPrefetcher(qclient) as prefetch, \
+                scratch:
+            try:
+                success, ainfo, msg = _call_pipeline(
+                    qclient, job_id, parameters, out_dir, profile, prefetch,
+                    scratch)
+            finally:
+                profile.stop()
+        profile.info['success'] = success
+        return success, ainfo, msg
+    finally:
+        profile.info['scratch_bytes'] = scratch.peak_bytes
+        # the profile is a record of the job so it should never make it fail
+        try:
+            profile.write(join(out_dir, PROFILE_FILENAME))
+        except OSError:
+            pass
+        profile.emit()
+
+
+def _call_pipeline(qclient, job_id, parameters, out_dir, profile, prefetch,
+                   scratch):
+    """Runs the pipeline, see call_pipeline and qp_qiime2._call_qiime2"""
+    # imported here so the pipelines can be validated without loading qiime2
+    import qiime2
+    from .qp_qiime2 import (
+        Q2_ALLOWED_PLUGINS, QIITA_Q2_SEMANTIC_TYPE, RENAME_COMMANDS,
+        lazy_plugins_enabled, load_action, import_artifact, import_tree,
+        qiita_type, export_result, set_parallelism, TAXONOMY_ERROR)
+    from .tables import InputTable
+
+    qclient.update_job_step(job_id, "Step 1 of 3: Collecting information")
+    profile.start('collect')
+    artifact_id = parameters[INPUT_PARAMETER]
+    prefetch.artifact(artifact_id)
+    try:
+        steps, dependencies, outputs = parse_pipeline(
+            parameters[PIPELINE_PARAMETER])
+    except ValueError as e:
+        return False, None, 'Error in the pipeline: %s' % str(e)
+    profile.info['steps'] = {
+        k: '%s.%s' % (v['plugin'], v['method']) for k, v in steps.items()}
+    if any(source.startswith('metadata') for step in steps.values()
+           for source in step['inputs'].values()):
+        prefetch.metadata(artifact_id)
+
+    # the lazy mode only loads the plugin of the first method, see
+    # load_action, so it is only used if all the steps use the same plugin
+    lazy = lazy_plugins_enabled() and len(
+        {step['plugin'] for step in steps.values()}) == 1
+    methods = {}
+    for name, step in steps.items():
+        if step['plugin'] not in Q2_ALLOWED_PLUGINS:
+            return False, None, (
+                'Error in the pipeline: step "%s" uses the plugin "%s", '
+                'which is not available' % (name, step['plugin']))
+        try:
+            methods[name] = load_action(step['plugin'], step['method'], lazy)
+        except KeyError:
+            return False, None, (
+                'Error in the pipeline: step "%s" uses the method "%s %s", '
+                'which does not exist' % (
+                    name, step['plugin'], step['method']))
+    msg = _check_signatures(steps, methods, outputs)
+    if msg:
+        return False, None, 'Error in the pipeline: %s' % msg
+
+    ainfo = prefetch.artifact(artifact_id).result()
+    if ainfo['analysis'] is None:
+        return False, None, (
+            'Artifact "%s" is not an analysis artifact.' % artifact_id)
+    biom_fp = ainfo['files']['biom'][0]
+    tree_fp = ainfo['files'].get('plain_text', [None])[0]
+    input_table = InputTable(biom_fp)
+    sources = {_parse_source(source) for step in steps.values()
+               for source in step['inputs'].values()}
+    if (None, 'taxonomy') in sources and not input_table.has_taxonomy():
+        return False, None, 'Error in the pipeline: %s' % TAXONOMY_ERROR
+    # the steps keep their results in the scratch space until the end, so
+    # the space is checked for each step
+    msg = scratch.check_space([biom_fp, tree_fp] * len(steps))
+    if msg:
+        return False, None, msg
+
+    # the data of the input artifact is imported once per semantic type, the
+    # first time a step needs it
+    imports = {}
+    imports_lock = Lock()
+
+    def _source(source, spec):
+        if source.startswith('metadata'):
+            metadata = prefetch.metadata(artifact_id).result()
+            if source.startswith('metadata:'):
+                return metadata.get_column(source[len('metadata:'):])
+            return metadata
+        if source == 'table':
+            semantic_type = spec.qiime_type
+        else:
+            semantic_type = QIITA_Q2_SEMANTIC_TYPE[source]
+        key = (source, str(semantic_type))
+        with imports_lock:
+            if key not in imports:
+                with profile.phase('import:%s' % source):
+                    if source == 'table':
+                        qza = import_artifact(semantic_type, biom_fp)
+                    elif source == 'tree':
+                        if tree_fp is None:
+                            raise ValueError('The input artifact has no tree')
+                        qza = import_tree(semantic_type, tree_fp,
+                                          input_table.feature_ids())
+                    else:
+                        qza = qiime2.Artifact.import_data(
+                            semantic_type, input_table.taxonomy())
+                scratch.track(qza)
+                imports[key] = qza
+            return imports[key]
+
+    # the CPUs of the job are split between the steps that can run at once
+    cpus = get_cpu_count()
+    max_workers = min(cpus, dag_width(dependencies))
+    step_cpus = max(1, cpus // max_workers)
+
+    def _run_step(name, results):
+        step = steps[name]
+        method = methods[name]
+        signature = method.signature
+        kwargs = {}
+        for key, val in step['parameters'].items():
+            try:
+                spec = signature.parameters[key]
+                # the diversity metrics can use the names shown in Qiita
+                rename = {}
+                if step['plugin'] == 'diversity':
+                    rename = RENAME_COMMANDS.get((step['method'], key), {})
+                if isinstance(val, list):
+                    val = [rename.get(v, v) for v in val]
+                else:
+                    val = rename.get(val, val)
+                if spec.view_type is set:
+                    val = set(val) if isinstance(val, list) else {val}
+                elif isinstance(val, str) and val not in spec.qiime_type:
+                    val = spec.qiime_type.decode(val)
+            except Exception as e:
+                raise RuntimeError(
+                    'Error in the parameter "%s" of step "%s": %s' % (
+                        key, name, str(e)))
+            kwargs[key] = val
+        set_parallelism(method, kwargs, step_cpus)
+        for key, source in step['inputs'].items():
+            dependency, output = _parse_source(source)
+            spec = signature.inputs.get(key, signature.parameters.get(key))
+            try:
+                if dependency is None:
+                    kwargs[key] = _source(output, spec)
+                else:
+                    kwargs[key] = results[dependency][output]
+            except Exception as e:
+                raise RuntimeError(
+                    'Error converting "%s" for step "%s": %s' % (
+                        source, name, str(e)))
+        try:
+            with profile.phase('run:%s' % name, action='%s.%s' % (
+                    step['plugin'], step['method'])):
+                step_results = method(**kwargs)
+        except Exception as e:
+            raise RuntimeError('Error running step "%s": %s' % (name, str(e)))
+        for result in step_results:
+            scratch.track(result)
+        return dict(zip(step_results._fields, step_results))
+
+    qclient.update_job_step(
+        job_id, "Step 2 of 3: Running the %d steps of the pipeline" % len(
+            steps))
+    profile.start('run')
+    try:
+        results = run_dag(dependencies, _run_step, max_workers)
+    except RuntimeError as e:
+        return False, None, str(e)
+    scratch.sample()
+
+    qclient.update_job_step(job_id, "Step 3 of 3: Processing results")
+    profile.start('post-process')
+    out_dir = join(out_dir, 'pipeline')
+    if not exists(out_dir):
+        mkdir(out_dir)
+    q2outputs = {}
+    for step, output in outputs:
+        q2artifact = results[step][output]
+        try:
+            atype = qiita_type(q2artifact)
+        except KeyError:
+            return False, None, (
+                'Error in the pipeline: the output "%s.%s" can not be stored '
+                'in Qiita' % (step, output))
+        if atype in q2outputs:
+            return False, None, (
+                'Error in the pipeline: only one output of each type can be '
+                'returned and there are several of type "%s"' % atype)
+        q2outputs[atype] = q2artifact
+
+    ainfo = []
+    for aname, q2artifact in q2outputs.items():
+        with profile.phase('export:%s' % aname):
+            success, ai, msg = export_result(
+                aname, q2artifact, out_dir, biom_fp, tree_fp, artifact_id)
+        if not success:
+            return False, None, msg
+        ainfo.append(ai)
+
+    return True, ainfo, ""
+
+
+def _check_signatures(steps, methods, outputs):
+    """Checks the steps against the signatures of their methods
+
+    Parameters
+    ----------
+    steps : dict
+        The steps, see parse_pipeline
+    methods : dict of {str: qiime2.sdk.Action}
+        The method of each step
+    outputs : list of (str, str)
+        The outputs of the pipeline
+
+    Returns
+    -------
+    str
+        The error, empty if the steps are valid
+    """
+    for name, step in steps.items():
+        signature = methods[name].signature
+        given = set(step['inputs']) | set(step['parameters'])
+        for key in given:
+            if key not in signature.inputs and key not in \
+                    signature.parameters:
+                return 'step "%s" has no input or parameter "%s"' % (
+                    name, key)
+        for key, spec in list(signature.inputs.items()) + list(
+                signature.parameters.items()):
+            if key not in given and not spec.has_default():
+                return 'step "%s" needs "%s"' % (name, key)
+        for key, source in step['inputs'].items():
+            dependency, output = _parse_source(source)
+            if (dependency is not None and
+                    output not in methods[dependency].signature.outputs):
+                return 'step "%s" has no output "%s"' % (dependency, output)
+    for step, output in outputs:
+        if output not in methods[step].signature.outputs:
+            return 'step "%s" has no output "%s"' % (step, output)
+    return ''
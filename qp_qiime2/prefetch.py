@@ -0,0 +1,166 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from os import environ
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+
+from .metadata import get_analysis_metadata
+
+
+DEFAULT_MAX_REQUESTS = 8
+
+
+class QiitaPrefetcher(object):
+    """Retrieves the information of a job from Qiita in background threads
+
+    Parameters
+    ----------
+    qclient : qiita_client.QiitaClient
+        The Qiita server client
+    max_workers : int, optional
+        The maximum number of concurrent requests, QP_QIIME2_MAX_REQUESTS or
+        DEFAULT_MAX_REQUESTS by default
+
+    Notes
+    -----
+    Each piece of information is requested once: asking for it again returns
+    the same future, so the job can request everything it will need as soon
+    as it knows it, and wait for the results only when it uses them.
+    """
+    def __init__(self, qclient, max_workers=None):
+        if max_workers is None:
+            max_workers = int(environ.get(
+                'QP_QIIME2_MAX_REQUESTS', DEFAULT_MAX_REQUESTS))
+        self.qclient = qclient
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._futures = {}
+        self._lock = Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _submit(self, key, fn, *args):
+        with self._lock:
+            if key not in self._futures:
+                self._futures[key] = self._executor.submit(fn, *args)
+            return self._futures[key]
+
+    def artifact(self, artifact_id):
+        """Retrieves the information of an artifact
+
+        Parameters
+        ----------
+        artifact_id : str
+            The artifact id
+
+        Returns
+        -------
+        concurrent.futures.Future
+            The future of the dict returned by /qiita_db/artifacts/<id>/
+        """
+        return self._submit(
+            ('artifact', str(artifact_id)), self.qclient.get,
+            "/qiita_db/artifacts/%s/" % artifact_id)
+
+    def metadata(self, artifact_id, column=None):
+        """Retrieves the metadata of the analysis of an artifact
+
+        Parameters
+        ----------
+        artifact_id : str
+            The artifact id
+        column : str, optional
+            The only column to load, all of them if not set
+
+        Returns
+        -------
+        concurrent.futures.Future
+            The future of the qiime2.Metadata, see
+            metadata.get_analysis_metadata
+        """
+        column = column or None
+        # the artifact is submitted first so, even with a single worker, it
+        # doesn't wait behind the metadata that needs it
+        self.artifact(artifact_id)
+        return self._submit(('metadata', str(artifact_id), column),
+                            self._metadata, artifact_id, column)
+
+    def _metadata(self, artifact_id, column):
+        analysis_id = self.artifact(artifact_id).result()['analysis']
+        return get_analysis_metadata(
+            self.qclient, analysis_id, [column] if column else None)
+
+    def close(self, wait=False):
+        """Cancels the pending requests and releases the threads
+
+        Parameters
+        ----------
+        wait : bool, optional
+            Whether to wait for the running requests to finish and their
+            threads to exit
+        """
+        with self._lock:
+            for future in self._futures.values():
+                future.cancel()
+        self._executor.shutdown(wait=wait)
+
+
+def job_requests(q2plugin, q2method, parameters):
+    """Finds what a job will request from Qiita from its parameters
+
+    Parameters
+    ----------
+    q2plugin, q2method : str
+        The Q2 plugin and method of the job
+    parameters : dict
+        The parameters of the job
+
+    Returns
+    -------
+    list of str, bool, str or None
+        The ids of the input artifacts, in the order they are processed by
+        call_qiime2, whether the job uses metadata and the column it uses,
+        if only one
+
+    Notes
+    -----
+    The artifact parameters are found in the manifest; if it doesn't exist
+    it is not generated, as that loads all the Q2 plugins, and no artifacts
+    are returned.
+    """
+    # imported here as the manifest imports qp_qiime2, which imports us
+    from .manifest import get_manifest_fp, get_manifest_key, load_manifest
+
+    label = 'qp-hide-param'
+    commands = load_manifest(get_manifest_fp(), get_manifest_key()) or []
+    artifact_params = set()
+    for command in commands:
+        req = command['req_params']
+        if (req['qp-hide-plugin'][1] == q2plugin and
+                req['qp-hide-method'][1].replace('-', '_') == q2method):
+            artifact_params = {k for k, (dt, _) in req.items()
+                               if dt == 'artifact'}
+            break
+
+    artifact_ids = []
+    column = None
+    uses_metadata = 'qp-hide-metadata' in parameters
+    for k, v in parameters.items():
+        if not k.startswith(label):
+            continue
+        ename = k[len(label):]
+        if ename in artifact_params:
+            artifact_ids.append(parameters[ename])
+        elif v == 'qp-hide-metadata-field':
+            uses_metadata = True
+            column = parameters.get(ename) or None
+    return artifact_ids, uses_metadata, column
@@ -0,0 +1,261 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+import sys
+from os import environ, times
+from json import dumps, dump
+from time import time
+from contextlib import contextmanager
+from threading import Lock
+from socket import socket, AF_INET, SOCK_DGRAM
+from fcntl import flock, LOCK_EX, LOCK_UN
+from resource import getrusage, RUSAGE_SELF, RUSAGE_CHILDREN
+
+
+PROFILE_FILENAME = 'qp-qiime2-profile.json'
+
+# how the jobs of the process run, see set_process_model
+_PROCESS_MODEL = 'standalone'
+
+
+def _cpu_time():
+    """CPU time (user + system) of the process and its finished children"""
+    t = times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+def _peak_rss():
+    """High-water mark of the RSS in bytes of the process or any of its
+    finished children, since they started"""
+    rss = max(getrusage(RUSAGE_SELF).ru_maxrss,
+              getrusage(RUSAGE_CHILDREN).ru_maxrss)
+    # linux reports kilobytes, macOS bytes
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def _io_bytes():
+    """Bytes read and written by the process
+
+    Uses /proc/self/io if available, which counts all the read/write calls,
+    or the block operations reported by getrusage otherwise.
+    """
+    try:
+        with open('/proc/self/io') as f:
+            io = dict(line.split(': ') for line in f.read().splitlines())
+        return int(io['rchar']), int(io['wchar'])
+    except (OSError, KeyError, ValueError):
+        usage = getrusage(RUSAGE_SELF)
+        return usage.ru_inblock * 512, usage.ru_oublock * 512
+
+
+def set_process_model(model):
+    """Sets how the jobs of the process run
+
+    Parameters
+    ----------
+    model : str
+        'standalone', if each job runs in its own interpreter; 'worker', if
+        they run in children forked from the worker; or 'threaded', if they
+        run in threads of the worker
+
+    Notes
+    -----
+    The peak RSS of a job forked from the worker includes the memory of the
+    worker, with every Q2 plugin loaded, and the one of a job in its threads
+    the memory of the jobs that ran before in the worker, so the profiles
+    of the models are not comparable: each profile records the model of its
+    process and the estimates are only calibrated on the runs of the same
+    model, see estimates.read_history. The forked children inherit it.
+    """
+    global _PROCESS_MODEL
+    _PROCESS_MODEL = model
+
+
+def get_process_model():
+    """Returns how the jobs of the process run, see set_process_model"""
+    return _PROCESS_MODEL
+
+
+class JobProfile(object):
+    """Records the resources used by each phase of a job
+
+    Parameters
+    ----------
+    job_id : str, optional
+        The job id, None for the profiles that are part of another job, like
+        the ones of the fan-out runs
+
+    Attributes
+    ----------
+    peak_rss : int or None
+        The high-water mark of the RSS of the process at the end of the last
+        phase, None if no phase has run
+    concurrent_jobs : int
+        The maximum number of other jobs that were running in the process at
+        the same time as this one
+    process : str
+        How the jobs of the process run, see set_process_model
+
+    Notes
+    -----
+    The resources are counters of the process: the jobs running at the same
+    time in the threads of a process share them, and the peak RSS is a
+    high-water mark since the process started, so it can't be attributed to
+    a phase. The records have the change of the counters during each phase,
+    which includes the other jobs running at the same time, and the profile
+    has the high-water mark and the number of those jobs.
+    """
+    # the profiles of the jobs with a phase running in the process
+    _lock = Lock()
+    _running = set()
+
+    def __init__(self, job_id=None):
+        self.job_id = job_id
+        self.records = []
+        self.info = {}
+        self.peak_rss = None
+        self.concurrent_jobs = 0
+        self.process = get_process_model()
+        self._current = None
+        self._depth = 0
+
+    def _enter(self):
+        with JobProfile._lock:
+            self._depth += 1
+            if self._depth > 1 or self.job_id is None:
+                return
+            running = JobProfile._running
+            for other in running:
+                other.concurrent_jobs = max(other.concurrent_jobs,
+                                            len(running))
+            self.concurrent_jobs = max(self.concurrent_jobs, len(running))
+            running.add(self)
+
+    def _exit(self, peak_rss):
+        with JobProfile._lock:
+            self._depth -= 1
+            self.peak_rss = peak_rss
+            if self._depth == 0:
+                JobProfile._running.discard(self)
+
+    @contextmanager
+    def phase(self, name, **info):
+        """Measures a phase of the job
+
+        Parameters
+        ----------
+        name : str
+            The name of the phase, like 'import' or 'import:table'
+        info : dict, optional
+            Extra information to store in the record, like the filepath
+
+        Notes
+        -----
+        The record has the wall time and the change of the CPU time, the
+        bytes read and written and the high-water mark of the RSS of the
+        process during the phase (rss_growth, 0 if the phase stayed below
+        the previous mark). The record is stored even if the phase raises an
+        exception.
+        """
+        self._enter()
+        start_wall = time()
+        start_cpu = _cpu_time()
+        start_peak = _peak_rss()
+        start_read, start_write = _io_bytes()
+        record = {'name': name, 'start': start_wall}
+        record.update(info)
+        try:
+            yield record
+        finally:
+            end_read, end_write = _io_bytes()
+            end_peak = _peak_rss()
+            record.update({
+                'wall_time': time() - start_wall,
+                'cpu_time': _cpu_time() - start_cpu,
+                'rss_growth': end_peak - start_peak,
+                'read_bytes': end_read - start_read,
+                'write_bytes': end_write - start_write})
+            self.records.append(record)
+            self._exit(end_peak)
+
+    def start(self, name, **info):
+        """Starts a phase that lasts until the next one starts
+
+        Parameters
+        ----------
+        name : str
+            The name of the phase
+        info : dict, optional
+            Extra information to store in the record
+        """
+        self.stop()
+        self._current = self.phase(name, **info)
+        self._current.__enter__()
+
+    def stop(self):
+        """Stops the phase started with start, if any"""
+        if self._current is not None:
+            current, self._current = self._current, None
+            current.__exit__(None, None, None)
+
+    def to_dict(self):
+        """Returns the profile as a JSON serializable dict"""
+        profile = {'job_id': self.job_id, 'records': self.records,
+                   'peak_rss': self.peak_rss,
+                   'concurrent_jobs': self.concurrent_jobs,
+                   'process': self.process}
+        profile.update(self.info)
+        return profile
+
+    def write(self, fp):
+        """Writes the profile as JSON
+
+        Parameters
+        ----------
+        fp : str
+            The filepath
+        """
+        with open(fp, 'w') as f:
+            dump(self.to_dict(), f, indent=4)
+
+    def emit(self, sink=None):
+        """Sends the profile to a metrics sink
+
+        Parameters
+        ----------
+        sink : str, optional
+            Either udp://host:port, to send the profile as a JSON datagram,
+            or a filepath, to append the profile as a JSON line. Defaults to
+            the value of QP_QIIME2_METRICS_SINK; if neither is set, nothing
+            is sent
+
+        Notes
+        -----
+        Metrics are best effort: errors sending them are ignored so they
+        never make a job fail.
+        """
+        if sink is None:
+            sink = environ.get('QP_QIIME2_METRICS_SINK')
+        if not sink:
+            return
+
+        line = dumps(self.to_dict()) + '\n'
+        try:
+            if sink.startswith('udp://'):
+                host, port = sink[len('udp://'):].rsplit(':', 1)
+                with socket(AF_INET, SOCK_DGRAM) as sock:
+                    sock.sendto(line.encode('utf-8'), (host, int(port)))
+            else:
+                with open(sink, 'a') as f:
+                    flock(f, LOCK_EX)
+                    try:
+                        f.write(line)
+                    finally:
+                        flock(f, LOCK_UN)
+        except (OSError, ValueError):
+            pass
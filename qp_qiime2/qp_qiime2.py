@@ -6,17 +6,41 @@
 # The full license is in the file LICENSE, distributed with this software.
 # -----------------------------------------------------------------------------
 
-from os import mkdir, listdir, chmod
-from os.path import join, exists, basename
-from shutil import copyfile
+from os import mkdir, listdir, chmod, environ
+from os.path import join, exists, basename, isfile
+from multiprocessing import get_context
+from threading import Lock
+from hashlib import sha256
 
-from biom import load_table
-from biom.util import biom_open
+import pandas as pd
 
 from qiita_client import ArtifactInfo
 
 import qiime2
-import pandas as pd
+from qiime2.core.type import Visualization
+from qiime2.plugin import Properties
+from qiime2.plugin.model import File
+from q2_types.feature_table import (
+    FeatureTable, Frequency, RelativeFrequency, PresenceAbsence,
+    BIOMV210Format)
+from q2_types.feature_data import FeatureData, Taxonomy
+from q2_types.distance_matrix import DistanceMatrix
+from q2_types.ordination import PCoAResults
+from q2_types.sample_data import SampleData, AlphaDiversity
+from q2_types.tree import Phylogeny, Rooted
+
+from .cache import get_cache, hash_file
+from .tables import InputTable, probe_table, copy_table, filter_table
+from .resources import get_cpu_count, thread_limits
+from .profiling import JobProfile, PROFILE_FILENAME
+from .executor import threaded_jobs
+from .staging import link_or_copy, save_uncompressed
+from .results import store_results, restore_results
+from .prefetch import QiitaPrefetcher, job_requests
+from .trees import prune_tree, feature_set_hash
+from .scratch import JobScratch, remove_data
+from .estimates import (
+    input_dimensions, estimate_resources, check_estimate, format_estimate)
 
 
 Q2_ALLOWED_PLUGINS = [
@@ -24,20 +48,31 @@ Q2_ALLOWED_PLUGINS = [
     'gneiss', 'diversity', 'longitudinal', 'emperor'
 ]
 
+# The Q2 plugins that need to be loaded when only loading the plugin of the
+# method to run (lazy mode, see load_action), as they provide the formats and
+# transformers that the method relies on; like q2plugin, these are the names
+# of the plugins, their entry points are q2-<name>
+Q2_LAZY_REQUIRED_PLUGINS = ['types']
+Q2_LAZY_PLUGIN_DEPENDENCIES = {
+    'longitudinal': ['sample-classifier'],
+}
+
+# Note that we build the semantic types directly from q2_types instead of
+# using qiime2.sdk.util.parse_type as the latter loads every installed plugin
 QIITA_Q2_SEMANTIC_TYPE = {
-    'BIOM-F': qiime2.sdk.util.parse_type('FeatureTable[Frequency]'),
-    'BIOM-RF': qiime2.sdk.util.parse_type('FeatureTable[RelativeFrequency]'),
-    'BIOM-PA': qiime2.sdk.util.parse_type('FeatureTable[PresenceAbsence]'),
-    'distance_matrix': qiime2.sdk.util.parse_type('DistanceMatrix'),
-    'ordination_results': qiime2.sdk.util.parse_type('PCoAResults'),
-    'q2_visualization': qiime2.sdk.util.parse_type('Visualization'),
-    'alpha_vector': qiime2.sdk.util.parse_type('SampleData[AlphaDiversity]'),
-    'phylogenetic_distance_matrix': qiime2.sdk.util.parse_type(
-        "DistanceMatrix % Properties(['phylogenetic'])"),
-    'phylogenetic_alpha_vector': qiime2.sdk.util.parse_type(
-        "SampleData[AlphaDiversity] % Properties(['phylogenetic'])"),
-    'phylogeny': qiime2.sdk.util.parse_type('Phylogeny[Rooted]'),
-    'taxonomy': qiime2.sdk.util.parse_type('FeatureData[Taxonomy]')
+    'BIOM-F': FeatureTable[Frequency],
+    'BIOM-RF': FeatureTable[RelativeFrequency],
+    'BIOM-PA': FeatureTable[PresenceAbsence],
+    'distance_matrix': DistanceMatrix,
+    'ordination_results': PCoAResults,
+    'q2_visualization': Visualization,
+    'alpha_vector': SampleData[AlphaDiversity],
+    'phylogenetic_distance_matrix': DistanceMatrix % Properties(
+        ['phylogenetic']),
+    'phylogenetic_alpha_vector': SampleData[AlphaDiversity] % Properties(
+        ['phylogenetic']),
+    'phylogeny': Phylogeny[Rooted],
+    'taxonomy': FeatureData[Taxonomy]
 }
 
 # for simplicity we are going to invert QIITA_Q2_SEMANTIC_TYPE so we can
@@ -150,6 +185,408 @@ RENAME_COMMANDS = {
     ('beta_group_significance', 'method'): BETA_GROUP_SIG_METHODS,
 }
 
+# the diversity methods that, besides the single metric command, also have a
+# command that accepts several metrics (fan-out), computed in parallel from
+# the same imported inputs; (method, parameter): output semantic type
+FANOUT_COMMANDS = {
+    ('alpha', 'metric'): 'alpha_vector',
+    ('beta', 'metric'): 'distance_matrix',
+    ('alpha_phylogenetic', 'metric'): 'alpha_vector',
+    ('beta_phylogenetic', 'metric'): 'distance_matrix',
+}
+
+# the error of the jobs that need the taxonomy of a table without it
+TAXONOMY_ERROR = ('Error generating taxonomy. Are you sure this artifact has '
+                  'taxonomy?')
+
+# the Q2 methods whose results depend on random numbers but don't have a
+# parameter to set the seed; their results are never cached. Methods with a
+# seed parameter (SEED_PARAMETERS) are only cached when the seed is set, see
+# _is_deterministic
+STOCHASTIC_METHODS = {
+    ('feature-table', 'rarefy'),
+    ('diversity', 'alpha_rarefaction'),
+    ('diversity', 'beta_rarefaction'),
+    ('diversity', 'beta_group_significance'),
+    ('diversity', 'beta_correlation'),
+    ('diversity', 'mantel'),
+    ('diversity', 'adonis'),
+    ('diversity', 'core_metrics'),
+    ('diversity', 'core_metrics_phylogenetic'),
+}
+SEED_PARAMETERS = ('random_state', 'random_seed', 'seed')
+
+# the parameters of the Q2 methods that set how many processes or threads
+# they use; they are not shown in Qiita but set to the CPUs of the job, see
+# set_parallelism
+PARALLELISM_PARAMETERS = ('n_jobs', 'threads', 'n_threads')
+
+# the feature-table methods that are run directly on the BIOM file, without
+# loading it, see _filter_out_of_core; method: (filtered axis, parameters with
+# the minimum and maximum number of non zero values of each id and parameter
+# to remove the ids of the other axis left empty)
+OUT_OF_CORE_FILTERS = {
+    'filter_samples': ('sample', 'min_features', 'max_features',
+                       'filter_empty_features'),
+    'filter_features': ('observation', 'min_samples', 'max_samples',
+                        'filter_empty_samples'),
+}
+OUT_OF_CORE_FILTER_PARAMETERS = {
+    'table', 'metadata', 'where', 'exclude_ids', 'min_frequency',
+    'max_frequency', 'allow_empty_table'}
+
+
+# the PluginManager is a singleton and load_action patches its class in lazy
+# mode, so its creation can't happen in several threads at the same time
+_PLUGIN_MANAGER_LOCK = Lock()
+# the plugins of the PluginManager if it was created in lazy mode, None if
+# it has every plugin or it doesn't exist yet, see load_action
+_LAZY_PLUGINS = None
+
+
+def lazy_plugins_enabled():
+    """Checks if the lazy mode of the Q2 plugins loading is enabled
+
+    Returns
+    -------
+    bool
+        Whether the QP_QIIME2_LAZY_PLUGINS environment variable is set to
+        a true value
+    """
+    return environ.get('QP_QIIME2_LAZY_PLUGINS', '').lower() in (
+        '1', 'true', 'yes')
+
+
+def results_cache_enabled():
+    """Checks if the results of the jobs are cached
+
+    Returns
+    -------
+    bool
+        Whether the QP_QIIME2_RESULTS_CACHE environment variable is set to a
+        true value; the cache also needs QP_QIIME2_CACHE_DIR, see
+        cache.get_cache
+    """
+    return environ.get('QP_QIIME2_RESULTS_CACHE', '').lower() in (
+        '1', 'true', 'yes')
+
+
+def _is_deterministic(q2plugin, q2method, method, q2params):
+    """Checks if a job always generates the same results from its inputs
+
+    Parameters
+    ----------
+    q2plugin, q2method : str
+        The Q2 plugin and method
+    method : qiime2.sdk.Action
+        The Q2 method
+    q2params : dict
+        The parameters of the job
+
+    Returns
+    -------
+    bool
+        False if the method is in STOCHASTIC_METHODS or if it has a seed
+        parameter that is not set, neither in the job nor by default
+    """
+    if (q2plugin, q2method) in STOCHASTIC_METHODS:
+        return False
+    for name, spec in method.signature.parameters.items():
+        if name in SEED_PARAMETERS and name not in q2params:
+            default = getattr(spec, 'default', None)
+            if default is None or default is spec.NOVALUE:
+                return False
+    return True
+
+
+def _results_key(cache, q2plugin, q2method, q2params, q2inputs, metadata):
+    """Generates the key of a job in the results cache
+
+    Parameters
+    ----------
+    cache : cache.DiskCache
+        The results cache
+    q2plugin, q2method : str
+        The Q2 plugin and method
+    q2params : dict
+        The parameters of the job, before importing the inputs
+    q2inputs : dict
+        The inputs of the job, {name: (filepath, semantic type)}
+    metadata : qiime2.Metadata or None
+        The metadata used by the job
+
+    Returns
+    -------
+    str
+        The key, from the method, the parameters, the contents of the input
+        files and metadata and the qiime2 version; the optional inputs that
+        are missing, like the phylogeny of a table without a tree, are
+        skipped
+    """
+    values = [q2plugin, q2method, qiime2.__version__]
+    for k, v in sorted(q2params.items()):
+        # the parallelism doesn't change the results
+        if k in PARALLELISM_PARAMETERS:
+            continue
+        if isinstance(v, set):
+            v = sorted(v)
+        values.append('%s=%r' % (k, v))
+    for k, (fpath, dt) in sorted(q2inputs.items()):
+        if k == 'metadata':
+            df = metadata.to_dataframe()
+            checksum = sha256(pd.util.hash_pandas_object(
+                df, index=True).values.tobytes())
+            values.append('%s=%s:%r:%r:%s' % (
+                k, fpath, list(df.columns), [str(t) for t in df.dtypes],
+                checksum.hexdigest()))
+        elif k == 'taxonomy':
+            # generated from the input table
+            values.append(k)
+        elif fpath in (None, '', 'None'):
+            continue
+        else:
+            values.append('%s=%s:%s' % (k, dt, hash_file(fpath)))
+    return cache.key(*values)
+
+
+def set_parallelism(method, q2params, cpus):
+    """Sets the parallelism parameters of a method to the CPUs it can use
+
+    Parameters
+    ----------
+    method : qiime2.sdk.Action
+        The Q2 method
+    q2params : dict
+        The parameters of the method, modified in place
+    cpus : int
+        The number of CPUs the method can use
+
+    Returns
+    -------
+    int
+        The threads each of the processes or threads of the method can use
+        for the numerical libraries: 1 if the method has a parallelism
+        parameter, so its workers use the CPUs, and cpus otherwise
+    """
+    names = [k for k in PARALLELISM_PARAMETERS
+             if k in method.signature.parameters]
+    for k in names:
+        q2params[k] = cpus
+    return 1 if names else cpus
+
+
+def load_action(q2plugin, q2method, lazy=None):
+    """Retrieves a Q2 action
+
+    Parameters
+    ----------
+    q2plugin : str
+        The name of the Q2 plugin
+    q2method : str
+        The id of the action within the plugin
+    lazy : bool, optional
+        If True, only load the entry point of q2plugin, and the plugins it
+        depends on, instead of every installed Q2 plugin. Defaults to the
+        value of lazy_plugins_enabled
+
+    Returns
+    -------
+    qiime2.sdk.Action
+        The Q2 action
+
+    Notes
+    -----
+    The qiime2.sdk.PluginManager is a singleton, so the lazy mode only has an
+    effect if it hasn't been created already in the current process. If it
+    was created in lazy mode for another plugin, like by a previous job of a
+    worker, it is replaced by one with every plugin; the actions retrieved
+    from the previous one keep working. So lazy mode only saves time in
+    processes that run a single job, or jobs of a single plugin.
+    """
+    global _LAZY_PLUGINS
+    if lazy is None:
+        lazy = lazy_plugins_enabled()
+
+    with _PLUGIN_MANAGER_LOCK:
+        pm_class = qiime2.sdk.PluginManager
+        if _LAZY_PLUGINS is not None and q2plugin not in _LAZY_PLUGINS:
+            # the next PluginManager() creates a new singleton
+            pm_class._PluginManager__instance = None
+            _LAZY_PLUGINS = None
+            lazy = False
+
+        if lazy and getattr(pm_class, '_PluginManager__instance', None) \
+                is None:
+            names = set(Q2_LAZY_REQUIRED_PLUGINS)
+            names.add(q2plugin)
+            names.update(Q2_LAZY_PLUGIN_DEPENDENCIES.get(q2plugin, []))
+            # the entry points are named after the package of the plugin,
+            # q2-<plugin name>, so the plugins are not imported to filter them
+            entry_points = {'q2-%s' % name for name in names}
+            original = vars(pm_class)['iter_entry_points']
+            iter_entry_points = pm_class.iter_entry_points
+
+            def _iter_entry_points(cls):
+                return (ep for ep in iter_entry_points()
+                        if ep.name in entry_points)
+
+            pm_class.iter_entry_points = classmethod(_iter_entry_points)
+            try:
+                pm = pm_class()
+            finally:
+                pm_class.iter_entry_points = original
+            _LAZY_PLUGINS = set(pm.plugins)
+        else:
+            pm = pm_class()
+
+    return pm.plugins[q2plugin].actions[q2method]
+
+
+def stage_artifact(semantic_type, fpath, hardlink=False):
+    """Imports a file as a Q2 artifact without copying it when possible
+
+    Parameters
+    ----------
+    semantic_type : str or qiime2 semantic type
+        The semantic type of the artifact
+    fpath : str
+        The filepath to import
+    hardlink : bool, optional
+        Whether fpath can be hardlinked into the artifact, only if it is a
+        file of the job that nothing else uses
+
+    Returns
+    -------
+    qiime2.Artifact
+        The imported artifact
+
+    Notes
+    -----
+    When the artifact data is a single file, like the BIOM table, tree or
+    distance matrix of Qiita, fpath is staged in the data folder with
+    staging.link_or_copy and the folder is moved into the artifact, instead
+    of letting qiime2 copy the file. Otherwise the file is imported with
+    qiime2.Artifact.import_data. The files stored by Qiita are never
+    hardlinked, only reflinked or copied, as a hardlink would share them
+    with the artifact data and anything that writes to it or changes its
+    permissions would change the file of Qiita.
+    """
+    pm = qiime2.sdk.PluginManager()
+    if isinstance(semantic_type, str):
+        semantic_type = qiime2.sdk.util.parse_type(semantic_type)
+    dir_fmt = pm.get_directory_format(semantic_type)
+    data_file = getattr(dir_fmt, 'file', None)
+    if not isinstance(data_file, File):
+        return qiime2.Artifact.import_data(semantic_type, fpath)
+
+    view = dir_fmt()
+    link_or_copy(fpath, join(str(view.path), data_file.pathspec),
+                 hardlink=hardlink)
+    return qiime2.Artifact.import_data(semantic_type, view)
+
+
+def import_artifact(semantic_type, fpath, view_type=None):
+    """Imports a file as a Q2 artifact, reusing previous imports if cached
+
+    Parameters
+    ----------
+    semantic_type : str or qiime2 semantic type
+        The semantic type of the artifact
+    fpath : str
+        The filepath to import
+    view_type : str, optional
+        The format of fpath
+
+    Returns
+    -------
+    qiime2.Artifact
+        The imported artifact
+
+    Notes
+    -----
+    The imports are cached in the 'artifacts' cache, see cache.get_cache,
+    keyed on the contents of fpath, the semantic and view types and the
+    qiime2 version. The cached archives are stored uncompressed as they never
+    leave the node.
+    """
+    cache = get_cache('artifacts', suffix='.qza')
+    if cache is None:
+        return _import(semantic_type, fpath, view_type)
+
+    key = cache.key(hash_file(fpath), str(semantic_type), str(view_type),
+                    qiime2.__version__)
+    cached_fp = cache.get(key)
+    if cached_fp is not None:
+        try:
+            return qiime2.Artifact.load(cached_fp)
+        except Exception:
+            # the entry was evicted or is corrupted so we import it again
+            pass
+
+    qza = _import(semantic_type, fpath, view_type)
+    with cache.put(key) as tmp_fp:
+        save_uncompressed(qza, tmp_fp)
+    return qza
+
+
+def _import(semantic_type, fpath, view_type):
+    """Imports fpath staging it if the view type is not given"""
+    if view_type is None:
+        return stage_artifact(semantic_type, fpath)
+    return qiime2.Artifact.import_data(semantic_type, fpath, view_type)
+
+
+def import_tree(semantic_type, tree_fp, feature_ids):
+    """Imports a tree pruned to the features of a table
+
+    Parameters
+    ----------
+    semantic_type : qiime2 semantic type
+        The semantic type of the tree artifact
+    tree_fp : str
+        The filepath of the tree
+    feature_ids : list of str
+        The features of the table the tree is used with
+
+    Returns
+    -------
+    qiime2.Artifact
+        The imported tree
+
+    Notes
+    -----
+    The pruned trees are cached in the 'trees' cache, see cache.get_cache,
+    keyed on the contents of the tree and the set of features, so the jobs
+    on the same table reuse the pruned tree instead of parsing and pruning
+    the full tree again; see trees.prune_tree. If the cache is not enabled,
+    or the tree doesn't have all the features, the full tree is imported.
+    """
+    cache = get_cache('trees', suffix='.qza')
+    if cache is None:
+        return import_artifact(semantic_type, tree_fp)
+
+    key = cache.key(hash_file(tree_fp), feature_set_hash(feature_ids),
+                    str(semantic_type), qiime2.__version__)
+    cached_fp = cache.get(key)
+    if cached_fp is not None:
+        try:
+            return qiime2.Artifact.load(cached_fp)
+        except Exception:
+            # the entry was evicted or is corrupted so we prune it again
+            pass
+
+    tree = prune_tree(tree_fp, feature_ids)
+    if tree is None:
+        return import_artifact(semantic_type, tree_fp)
+
+    with cache.put(key) as tmp_fp:
+        newick_fp = tmp_fp + '.nwk'
+        tree.write(newick_fp, format='newick')
+        # the pruned tree is a new file that is removed with tmp_fp
+        qza = stage_artifact(semantic_type, newick_fp, hardlink=True)
+        save_uncompressed(qza, tmp_fp)
+    return qza
+
 
 def call_qiime2(qclient, job_id, parameters, out_dir):
     """helper method to call Qiime2
@@ -169,12 +606,65 @@ def call_qiime2(qclient, job_id, parameters, out_dir):
     -------
     boolean, list, str
         The results of the job
+
+    Notes
+    -----
+    The function is reentrant: parameters is not modified and all the state
+    of the job is local to the call, so several jobs can run at the same time
+    in the threads of a process, see executor.JobExecutor. The exception is
+    the lazy mode, as the Q2 plugins are loaded once per process, see
+    load_action.
+    """
+    profile = JobProfile(job_id)
+    scratch = JobScratch(job_id)
+    try:
+        with profile.phase('job'), QiitaPrefetcher(qclient) as prefetch, \
+                scratch:
+            try:
+                success, ainfo, msg = _call_qiime2(
+                    qclient, job_id, parameters, out_dir, profile, prefetch,
+                    scratch)
+            finally:
+                profile.stop()
+        profile.info['success'] = success
+        return success, ainfo, msg
+    finally:
+        profile.info['scratch_bytes'] = scratch.peak_bytes
+        # the profile is a record of the job so it should never make it fail
+        try:
+            profile.write(join(out_dir, PROFILE_FILENAME))
+        except OSError:
+            pass
+        profile.emit()
+
+
+def _call_qiime2(qclient, job_id, parameters, out_dir, profile, prefetch,
+                 scratch):
+    """Runs the job, see call_qiime2
+
+    profile is the profiling.JobProfile of the job, prefetch the
+    prefetch.QiitaPrefetcher used for all the requests to Qiita and scratch
+    the scratch.JobScratch where the temporary files are written
     """
     qclient.update_job_step(job_id, "Step 1 of 4: Collecting information")
+    profile.start('collect')
+    # the parameters are consumed while translated to the Q2 ones, so we use
+    # a copy to leave the caller's untouched
+    parameters = dict(parameters)
     q2plugin = parameters.pop('qp-hide-plugin')
     q2method = parameters.pop('qp-hide-method').replace('-', '_')
-    pm = qiime2.sdk.PluginManager()
-    method = pm.plugins[q2plugin].actions[q2method]
+    profile.info.update({'plugin': q2plugin, 'method': q2method})
+    # the parameter that has a list of values, one per run of the method
+    fanout = parameters.pop('qp-hide-fanout', None)
+    # the information of the input artifacts and the metadata of their
+    # analysis are requested concurrently while the Q2 plugin loads
+    artifact_ids, uses_metadata, column = job_requests(
+        q2plugin, q2method, parameters)
+    for aid in artifact_ids:
+        prefetch.artifact(aid)
+    if artifact_ids and uses_metadata:
+        prefetch.metadata(artifact_ids[-1], column)
+    method = load_action(q2plugin, q2method)
 
     out_dir = join(out_dir, q2method)
 
@@ -192,8 +682,8 @@ def call_qiime2(qclient, job_id, parameters, out_dir):
     method_inputs = method.signature.inputs.copy()
     method_params = method.signature.parameters.copy()
     artifact_id = None
-    analysis_id = None
     biom_fp = None
+    input_table = None
     tree_fp = None
     tree_fp_check = False
     for k in list(parameters):
@@ -212,16 +702,14 @@ def call_qiime2(qclient, job_id, parameters, out_dir):
                     artifact_method = QIITA_Q2_SEMANTIC_TYPE[key]
                 else:
                     # this is going to be an artifact so let's collect the
-                    # filepath here, this will also allow us to collect the
-                    # analysis_id
+                    # filepath here, the metadata is the one of the analysis
+                    # of this artifact
                     artifact_id = val
-                    ainfo = qclient.get(
-                        "/qiita_db/artifacts/%s/" % artifact_id)
+                    ainfo = prefetch.artifact(artifact_id).result()
                     if ainfo['analysis'] is None:
                         msg = ('Artifact "%s" is not an analysis '
                                'artifact.' % val)
                         return False, None, msg
-                    analysis_id = ainfo['analysis']
                     # at this stage in qiita we only have 2 types of artifacts:
                     # biom / plain_text
                     dt = method_inputs[key].qiime_type
@@ -232,6 +720,9 @@ def call_qiime2(qclient, job_id, parameters, out_dir):
                         if 'plain_text' in ainfo['files']:
                             tree_fp = ainfo['files']['plain_text'][0]
                         biom_fp = fpath
+                        # the parsed table is shared by the taxonomy and the
+                        # output tables
+                        input_table = InputTable(biom_fp)
                     else:
                         fpath = ainfo['files']['plain_text'][0]
 
@@ -243,6 +734,15 @@ def call_qiime2(qclient, job_id, parameters, out_dir):
                            "'%s'" % k[label_len:])
                     return False, None, msg
                 q2inputs['metadata'] = (val, val)
+            elif key == fanout:
+                if isinstance(val, str):
+                    val = [val]
+                if not val:
+                    msg = "Error: You didn't select any value in '%s'" % (
+                        k[label_len:])
+                    return False, None, msg
+                q2params[key] = [RENAME_COMMANDS[(q2method, key)][v]
+                                 for v in val]
             else:
                 if val in ('', 'None'):
                     continue
@@ -287,105 +787,612 @@ def call_qiime2(qclient, job_id, parameters, out_dir):
     if tree_fp_check:
         q2inputs['phylogeny'] = (tree_fp, q2inputs['phylogeny'][1])
 
+    # the results of deterministic jobs are reused if an identical job ran
+    # before, see results_cache_enabled
+    q2Metadata = None
+    results_cache = None
+    results_key = None
+    if results_cache_enabled() and _is_deterministic(
+            q2plugin, q2method, method, q2params):
+        results_cache = get_cache('results')
+    if results_cache is not None:
+        profile.start('lookup')
+        if 'metadata' in q2inputs:
+            q2Metadata = prefetch.metadata(
+                artifact_id, q2inputs['metadata'][0]).result()
+        results_key = _results_key(
+            results_cache, q2plugin, q2method, q2params, q2inputs, q2Metadata)
+        cached = restore_results(results_cache, results_key, out_dir)
+        profile.info['cached'] = cached is not None
+        if cached is not None:
+            return True, [ArtifactInfo(*ai) for ai in cached], ""
+
+    if _can_filter_out_of_core(q2plugin, q2method, method, q2inputs, fanout,
+                               biom_fp):
+        qclient.update_job_step(
+            job_id, "Step 3 of 4: Running '%s %s'" % (q2plugin, q2method))
+        profile.start('run', out_of_core=True)
+        if 'metadata' in q2inputs and q2Metadata is None:
+            q2Metadata = prefetch.metadata(artifact_id).result()
+        try:
+            success, ainfo, msg = _filter_out_of_core(
+                q2method, method, q2params, q2Metadata, out_dir, biom_fp,
+                tree_fp, artifact_id)
+        except Exception as e:
+            return False, None, 'Error running: %s' % str(e)
+        _store_results(results_cache, results_key, out_dir, profile, success,
+                       ainfo)
+        return success, ainfo, msg
+
+    # failing early if the table has no taxonomy to generate it from, if the
+    # job needs more memory or time than it has or if the inputs can't be
+    # processed in the scratch space
+    if 'taxonomy' in q2inputs and (
+            input_table is None or not input_table.has_taxonomy()):
+        return False, None, TAXONOMY_ERROR
+    estimate, msg = _estimate_job(q2plugin, q2method, method, q2params,
+                                  q2inputs, fanout, input_table, profile)
+    if msg:
+        return False, None, msg
+    # the estimate is shown to the user while the method runs
+    eta = '' if estimate is None else ' (%s)' % format_estimate(estimate)
+    msg = scratch.check_space([fpath for k, (fpath, _) in q2inputs.items()
+                               if k not in ('metadata', 'taxonomy')])
+    if msg:
+        return False, None, msg
+
     # let's process/import inputs
     qclient.update_job_step(
         job_id, "Step 2 of 4: Converting Qiita artifacts to Q2 artifact")
+    profile.start('import')
     for k, (fpath, dt) in q2inputs.items():
-        if k == 'metadata':
-            metadata = qclient.get(
-                "/qiita_db/analysis/%s/metadata/" % str(analysis_id))
-            metadata = pd.DataFrame.from_dict(metadata, orient='index')
-            # the reason we need to save and load the mapping file is
-            # so Qiime2 assings the expected data types to the columns
-            metadata_fp = join(out_dir, 'metadata.txt')
-            metadata.to_csv(metadata_fp, index_label='#SampleID', na_rep='',
-                            sep='\t', encoding='utf-8')
-            q2Metadata = qiime2.Metadata.load(metadata_fp)
-            if fpath:
-                q2params[k] = q2Metadata.get_column(fpath)
+        with profile.phase('import:%s' % k, fp=fpath):
+            if k == 'metadata':
+                if q2Metadata is None:
+                    # if we only need a column there is no need to load the
+                    # rest; note that the data types of the columns are
+                    # assigned the same way Qiime2 does when loading a mapping
+                    # file
+                    q2Metadata = prefetch.metadata(
+                        artifact_id, fpath).result()
+                if fpath:
+                    q2params[k] = q2Metadata.get_column(fpath)
+                else:
+                    q2params[k] = q2Metadata
+            elif k == 'taxonomy':
+                try:
+                    qza = qiime2.Artifact.import_data(
+                        'FeatureData[Taxonomy]', input_table.taxonomy())
+                except Exception:
+                    return False, None, TAXONOMY_ERROR
+                scratch.track(qza)
+                q2params['taxonomy'] = qza
             else:
-                q2params[k] = q2Metadata
-        elif k == 'taxonomy':
-            try:
-                qza = qiime2.Artifact.import_data(
-                    'FeatureData[Taxonomy]', biom_fp, 'BIOMV210Format')
-            except Exception:
-                return False, None, ('Error generating taxonomy. Are you '
-                                     'sure this artifact has taxonomy?')
-            q2params['taxonomy'] = qza
+                try:
+                    if k == 'phylogeny' and input_table is not None:
+                        qza = import_tree(dt, fpath, input_table.feature_ids())
+                    else:
+                        qza = import_artifact(dt, fpath)
+                except Exception as e:
+                    return False, None, 'Error converting "%s": %s' % (
+                        str(dt), str(e))
+                scratch.track(qza)
+                q2params[k] = qza
+
+    if fanout is not None:
+        # every request to Qiita is done by now, and the threads that made
+        # them must be gone before the runs are forked, see _run_fanout
+        prefetch.close(wait=True)
+        values = q2params.pop(fanout)
+        qclient.update_job_step(
+            job_id, "Step 3 of 4: Running '%s %s' for %d values of %s" % (
+                q2plugin, q2method, len(values), fanout) + eta)
+        profile.start('run', fanout=fanout)
+        success, ainfo, msg = _run_fanout(
+            method, q2params, fanout, values, out_dir, biom_fp, tree_fp,
+            artifact_id, profile)
+        scratch.sample()
+    else:
+        scratch.sample()
+        qclient.update_job_step(
+            job_id, "Step 3 of 4: Running '%s %s'" % (
+                q2plugin, q2method) + eta)
+        profile.start('run')
+        # the numerical libraries are already capped to the CPUs of the job
+        # by start_qiime2 or the worker, see limit_threads
+        set_parallelism(method, q2params, get_cpu_count())
+        try:
+            results = method(**q2params)
+        except Exception as e:
+            return False, None, 'Error running: %s' % str(e)
+        for result in results:
+            scratch.track(result)
+        scratch.sample()
+
+        qclient.update_job_step(job_id, "Step 4 of 4: Processing results")
+        profile.start('post-process')
+        success, ainfo, msg = _process_results(
+            results, out_dir, biom_fp, tree_fp, artifact_id, profile)
+
+    _store_results(results_cache, results_key, out_dir, profile, success,
+                   ainfo)
+    return success, ainfo, msg
+
+
+def _estimate_job(q2plugin, q2method, method, q2params, q2inputs, fanout,
+                  input_table, profile):
+    """Estimates the resources of a job and checks that it has them
+
+    Parameters
+    ----------
+    q2plugin, q2method : str
+        The Q2 plugin and method
+    method : qiime2.sdk.Action
+        The Q2 method
+    q2params, q2inputs : dict
+        The parameters and inputs of the job, see _call_qiime2
+    fanout : str or None
+        The parameter with a value per run of the method
+    input_table : tables.InputTable or None
+        The input table
+    profile : profiling.JobProfile
+        The profile of the job, where the size of the inputs is recorded,
+        so the job becomes part of the history of the method, and the
+        estimate
+
+    Returns
+    -------
+    dict or None, str
+        The estimate, see estimates.estimate_resources, and the error if
+        the job needs more memory or time than it has, or an empty string
+    """
+    if input_table is None:
+        return None, ''
+    tree_fp = q2inputs['phylogeny'][0] if 'phylogeny' in q2inputs else None
+    dims = input_dimensions(input_table, tree_fp)
+    profile.info['inputs'] = dims
+
+    processes = 1
+    if fanout is not None:
+        values = q2params[fanout]
+        metrics = values if fanout == 'metric' else [None] * len(values)
+        processes = _fanout_processes(values)
+    else:
+        metric = q2params.get('metric')
+        if isinstance(metric, str):
+            profile.info['metric'] = metric
         else:
-            try:
-                qza = qiime2.Artifact.import_data(dt, fpath)
-            except Exception as e:
-                return False, None, 'Error converting "%s": %s' % (
-                    str(dt), str(e))
-            q2params[k] = qza
+            metric = None
+        metrics = [metric]
+    pairwise = any(spec.qiime_type <= DistanceMatrix
+                   for spec in method.signature.outputs.values())
+
+    estimate = estimate_resources(q2plugin, q2method, metrics, dims,
+                                  pairwise, processes)
+    if estimate is None:
+        return None, ''
+    profile.info['estimate'] = estimate
+    return estimate, check_estimate(estimate)
+
+
+def _store_results(results_cache, results_key, out_dir, profile, success,
+                   ainfo):
+    """Stores the results of a successful job if the cache is enabled"""
+    if success and results_cache is not None:
+        profile.start('store')
+        # the cache is an optimization so it should never make a job fail
+        try:
+            store_results(results_cache, results_key, out_dir, ainfo)
+        except OSError:
+            pass
 
-    qclient.update_job_step(
-        job_id, "Step 3 of 4: Running '%s %s'" % (q2plugin, q2method))
-    try:
-        results = method(**q2params)
-    except Exception as e:
-        return False, None, 'Error running: %s' % str(e)
 
-    qclient.update_job_step(job_id, "Step 4 of 4: Processing results")
+def _can_filter_out_of_core(q2plugin, q2method, method, q2inputs, fanout,
+                            biom_fp):
+    """Checks if a job can run with _filter_out_of_core"""
+    if (q2plugin != 'feature-table' or q2method not in OUT_OF_CORE_FILTERS or
+            fanout is not None or biom_fp is None):
+        return False
+    # only the whole metadata, not a column, can be used to filter
+    if set(q2inputs) - {'table', 'metadata'} or q2inputs.get(
+            'metadata', ('', ))[0]:
+        return False
+    # making sure that we support all the parameters of the installed version
+    _, min_name, max_name, empty_name = OUT_OF_CORE_FILTERS[q2method]
+    supported = OUT_OF_CORE_FILTER_PARAMETERS | {min_name, max_name,
+                                                 empty_name}
+    return set(method.signature.inputs).union(
+        method.signature.parameters).issubset(supported)
+
+
+def _filter_out_of_core(q2method, method, q2params, metadata, out_dir,
+                        biom_fp, tree_fp, artifact_id):
+    """Runs filter_samples or filter_features on the BIOM file
+
+    Parameters
+    ----------
+    q2method : str
+        The method, one of OUT_OF_CORE_FILTERS
+    method : qiime2.sdk.Action
+        The Q2 method
+    q2params : dict
+        The parameters of the job
+    metadata : qiime2.Metadata or None
+        The metadata of the job
+    out_dir, biom_fp, tree_fp, artifact_id
+        See _process_results
+
+    Returns
+    -------
+    boolean, list, str
+        The results of the job
+
+    Raises
+    ------
+    ValueError
+        If the parameters are not valid, with the same messages as
+        q2-feature-table
+
+    Notes
+    -----
+    The selection is evaluated and the filtered table written by
+    tables.filter_table, which streams the BIOM file in chunks instead of
+    loading the table in memory twice (as a Q2 artifact and to add the
+    observation metadata) like running the method does.
+    """
+    axis, min_name, max_name, empty_name = OUT_OF_CORE_FILTERS[q2method]
+    params = {k: spec.default
+              for k, spec in method.signature.parameters.items()
+              if spec.has_default()}
+    params.update(q2params)
+    where = params.get('where')
+    exclude_ids = params.get('exclude_ids', False)
+
+    if (params.get('min_frequency', 0) == 0 and
+            params.get('max_frequency') is None and
+            params.get(min_name, 0) == 0 and
+            params.get(max_name) is None and metadata is None and
+            where is None and not exclude_ids):
+        raise ValueError('No filtering was requested.')
+    if metadata is None and where is not None:
+        raise ValueError("Metadata must be provided if 'where' is "
+                         "specified.")
+    if metadata is None and exclude_ids:
+        raise ValueError("Metadata must be provided if 'exclude_ids' "
+                         "is True.")
+    ids_to_keep = None
+    if metadata is not None:
+        ids_to_keep = metadata.get_ids(where=where)
+
+    aname = list(method.signature.outputs)[0]
+    aout = join(out_dir, aname)
+    mkdir(aout)
+    fp = join(aout, 'feature-table.biom')
+    shape = filter_table(
+        biom_fp, fp, axis, ids_to_keep,
+        min_frequency=params.get('min_frequency', 0),
+        max_frequency=params.get('max_frequency'),
+        min_nonzero=params.get(min_name, 0),
+        max_nonzero=params.get(max_name),
+        remove_empty=params.get(empty_name, False),
+        exclude_ids=exclude_ids)
+
+    if not params.get('allow_empty_table', True) and 0 in shape:
+        raise ValueError('The resulting table is empty.')
+    # making sure that the resulting biom is not empty, see _process_results
+    if shape == (0, 0):
+        return False, None, ('The resulting table is empty, please review '
+                             'your parameters')
+    return True, [_biom_artifact(aname, aout, fp, tree_fp, artifact_id)], ""
+
+
+def _process_results(results, out_dir, biom_fp, tree_fp, artifact_id,
+                     profile, suffix=''):
+    """Converts the results of a Q2 method to Qiita artifacts
+
+    Parameters
+    ----------
+    results : qiime2.sdk.Results
+        The results of the method
+    out_dir : str
+        The path where to store the files of the artifacts
+    biom_fp : str or None
+        The input BIOM table, to copy its observation metadata to the output
+        tables
+    tree_fp : str or None
+        The tree of the input artifact, to add it to the output tables
+    artifact_id : str
+        The id of the input artifact
+    profile : profiling.JobProfile
+        Where to record the resources used exporting each output
+    suffix : str, optional
+        The suffix added to the output names
+
+    Returns
+    -------
+    boolean, list, str
+        The results of the job
+    """
     ainfo = []
     for aname, q2artifact in zip(results._fields, results):
-        aout = join(out_dir, aname)
-        if isinstance(q2artifact, qiime2.Visualization):
-            qzv_fp = q2artifact.save(aout)
-            ainfo.append(
-                ArtifactInfo(aname, 'q2_visualization', [(qzv_fp, 'qzv')]))
-        else:
-            q2artifact.export_data(output_dir=aout)
-            files = listdir(aout)
-            if len(files) != 1:
-                msg = ('Error processing results: There are some unexpected '
-                       'files: "%s"' % ', '.join(files))
-                return False, None, msg
-            fp = join(aout, files[0])
-            # making sure the newly created file comes with the correct
-            # permissions for nginx
-            chmod(fp, 0o664)
-
-            if q2artifact.type.name == 'FeatureTable':
-                # Let's read the observation metadata if exists in the input
-                if biom_fp is not None:
-                    fin = load_table(biom_fp)
-                    fout = load_table(fp)
-
-                    # making sure that the resulting biom is not empty
-                    if fout.shape == (0, 0):
-                        msg = ('The resulting table is empty, please review '
-                               'your parameters')
-                        return False, None, msg
+        aname = aname + suffix
+        with profile.phase('export:%s' % aname):
+            success, ai, msg = export_result(
+                aname, q2artifact, out_dir, biom_fp, tree_fp, artifact_id)
+        if not success:
+            return False, None, msg
+        ainfo.append(ai)
 
-                    metadata = {
-                        i: fin.metadata(i, axis='observation')
-                        for i in fout.ids(axis='observation')}
-                    fout.add_metadata(metadata, axis='observation')
-                    with biom_open(fp, 'w') as bf:
-                        fout.to_hdf5(bf, "Qiita's Qiime2 plugin with "
-                                     "observation metadata")
-
-                # if there is a tree, let's copy it and then add it to
-                # the new artifact
-                if tree_fp is not None:
-                    bn = basename(tree_fp)
-                    new_tree_fp = join(
-                        out_dir, aout, 'from_%s_%s' % (artifact_id, bn))
-                    copyfile(tree_fp, new_tree_fp)
-                    ai = ArtifactInfo(aname, 'BIOM', [
-                        (fp, 'biom'),
-                        (new_tree_fp, 'plain_text')])
-                else:
-                    ai = ArtifactInfo(aname, 'BIOM', [(fp, 'biom')])
+    return True, ainfo, ""
 
-            else:
-                atype = Q2_QIITA_SEMANTIC_TYPE[q2artifact.type]
-                if atype.startswith('phylogenetic_'):
-                    atype = atype[len('phylogenetic_'):]
-                ai = ArtifactInfo(aname, atype, [(fp, 'plain_text')])
-            ainfo.append(ai)
 
+def qiita_type(q2artifact):
+    """Finds the Qiita type of a Q2 result
+
+    Parameters
+    ----------
+    q2artifact : qiime2.Artifact or qiime2.Visualization
+        The result
+
+    Returns
+    -------
+    str
+        The Qiita artifact type
+
+    Raises
+    ------
+    KeyError
+        If the semantic type of the result doesn't exist in Qiita
+    """
+    if isinstance(q2artifact, qiime2.Visualization):
+        return 'q2_visualization'
+    if q2artifact.type.name == 'FeatureTable':
+        return 'BIOM'
+    atype = Q2_QIITA_SEMANTIC_TYPE[q2artifact.type]
+    if atype.startswith('phylogenetic_'):
+        atype = atype[len('phylogenetic_'):]
+    return atype
+
+
+def export_result(aname, q2artifact, out_dir, biom_fp, tree_fp, artifact_id):
+    """Converts a Q2 result to a Qiita artifact
+
+    Parameters
+    ----------
+    aname : str
+        The output name
+    q2artifact : qiime2.Artifact or qiime2.Visualization
+        The result
+    out_dir, biom_fp, tree_fp, artifact_id
+        See _process_results
+
+    Returns
+    -------
+    boolean, ArtifactInfo, str
+        Whether the result could be converted, the artifact and the error
+    """
+    aout = join(out_dir, aname)
+    atype = qiita_type(q2artifact)
+    if atype == 'q2_visualization':
+        qzv_fp = q2artifact.save(aout)
+        return True, ArtifactInfo(aname, atype, [(qzv_fp, 'qzv')]), ""
+
+    if atype == 'BIOM':
+        # the file of the table in the artifact, the table is never loaded
+        fout = str(q2artifact.view(BIOMV210Format))
+
+        # making sure that the resulting biom is not empty
+        probe = probe_table(fout)
+        if probe['samples'] == 0 and probe['features'] == 0:
+            msg = ('The resulting table is empty, please review '
+                   'your parameters')
+            return False, None, msg
+
+        # instead of exporting the table, loading it, adding the observation
+        # metadata of the input (if exists) and writing it again, we copy
+        # the file and add the metadata to the copy
+        mkdir(aout)
+        fp = join(aout, 'feature-table.biom')
+        copy_table(fout, fp, biom_fp)
+        return True, _biom_artifact(aname, aout, fp, tree_fp, artifact_id), ""
+
+    files = _export_data(q2artifact, aout)
+    if len(files) != 1:
+        msg = ('Error processing results: There are some '
+               'unexpected files: "%s"' % ', '.join(
+                   basename(f) for f in files))
+        return False, None, msg
+    fp = files[0]
+    return True, ArtifactInfo(aname, atype, [(fp, 'plain_text')]), ""
+
+
+def _biom_artifact(aname, aout, fp, tree_fp, artifact_id):
+    """Generates the ArtifactInfo of an output BIOM table
+
+    Parameters
+    ----------
+    aname : str
+        The output name
+    aout : str
+        The folder of the artifact files
+    fp : str
+        The filepath of the table, in aout
+    tree_fp : str or None
+        The tree of the input artifact, to add it to the output
+    artifact_id : str
+        The id of the input artifact
+
+    Returns
+    -------
+    ArtifactInfo
+    """
+    # making sure the newly created file comes with the correct
+    # permissions for nginx; fp is always a new file, written by the job
+    chmod(fp, 0o664)
+
+    # if there is a tree, let's share it (hardlink when possible, as it is
+    # never modified) and then add it to the new artifact
+    if tree_fp is not None:
+        bn = basename(tree_fp)
+        new_tree_fp = join(aout, 'from_%s_%s' % (artifact_id, bn))
+        link_or_copy(tree_fp, new_tree_fp)
+        return ArtifactInfo(aname, 'BIOM', [
+            (fp, 'biom'), (new_tree_fp, 'plain_text')])
+    return ArtifactInfo(aname, 'BIOM', [(fp, 'biom')])
+
+
+def _export_data(q2artifact, aout):
+    """Exports the data of an artifact
+
+    Parameters
+    ----------
+    q2artifact : qiime2.Artifact
+        The artifact to export
+    aout : str
+        The folder where to export the data, it must not exist
+
+    Returns
+    -------
+    list of str
+        The filepaths of the exported files
+
+    Notes
+    -----
+    When the data is a single file, which is the case of all the Qiita
+    artifact types, the file in the artifact is staged with
+    staging.link_or_copy in its final path instead of going through
+    export_data. The exported files get the permissions that nginx needs,
+    and the file in the artifact is only hardlinked if that doesn't change
+    the permissions of another file.
+    """
+    data_file = getattr(q2artifact.format, 'file', None)
+    if not isinstance(data_file, File):
+        q2artifact.export_data(output_dir=aout)
+        files = [join(aout, f) for f in listdir(aout)]
+        for fp in files:
+            if isfile(fp):
+                chmod(fp, 0o664)
+        return files
+
+    view = q2artifact.view(q2artifact.format)
+    mkdir(aout)
+    fp = join(aout, data_file.pathspec)
+    link_or_copy(join(str(view.path), data_file.pathspec), fp, mode=0o664)
+    return [fp]
+
+
+# the fan-out runs are executed in forked processes that inherit the method
+# and its inputs, so we don't need to serialize Q2 artifacts; the global is
+# only set in the processes of the pool, see _run_fanout
+_FANOUT_JOB = None
+
+
+def _fanout_processes(values):
+    """The number of processes of the fan-out runs, see _run_fanout"""
+    if threaded_jobs():
+        return 1
+    return min(len(values), get_cpu_count())
+
+
+def _init_fanout(job):
+    global _FANOUT_JOB
+    _FANOUT_JOB = job
+
+
+def _fanout_worker(value, job=None):
+    if job is None:
+        job = _FANOUT_JOB
+    (method, q2params, fanout, out_dir, biom_fp, tree_fp, artifact_id,
+     threads) = job
+    params = dict(q2params)
+    params[fanout] = value
+    # the records of the forked processes are sent back to the parent
+    profile = JobProfile()
+    try:
+        with profile.phase('run:%s' % value), thread_limits(threads):
+            results = method(**params)
+    except Exception as e:
+        return (False, None, 'Error running %s: %s' % (value, str(e)),
+                profile.records)
+    finally:
+        # the processes of the pool only run this job, so the high-water
+        # mark of their RSS is the peak of its runs, see JobProfile
+        for record in profile.records:
+            record['peak_rss'] = profile.peak_rss
+    # the exceptions can't reach the job from the processes of the pool
+    try:
+        success, ainfo, msg = _process_results(
+            results, out_dir, biom_fp, tree_fp, artifact_id, profile,
+            suffix='_%s' % value)
+    except Exception as e:
+        return (False, None, 'Error processing the results of %s: %s' % (
+            value, str(e)), profile.records)
+    finally:
+        # the processes of the pool never remove the data of the results
+        remove_data(results)
+    return success, ainfo, msg, profile.records
+
+
+def _run_fanout(method, q2params, fanout, values, out_dir, biom_fp, tree_fp,
+                artifact_id, profile):
+    """Runs a Q2 method once per value of one of its parameters
+
+    Parameters
+    ----------
+    method : qiime2.sdk.Action
+        The Q2 method
+    q2params : dict
+        The inputs and parameters of the method, except fanout
+    fanout : str
+        The name of the parameter with multiple values
+    values : list
+        The values of the parameter
+    out_dir, biom_fp, tree_fp, artifact_id, profile
+        See _process_results
+
+    Returns
+    -------
+    boolean, list, str
+        The results of the job, the name of each output gets the value used
+        to generate it as a suffix, like alpha_diversity_shannon
+
+    Notes
+    -----
+    The runs are executed in parallel in a pool of forked processes, sized
+    to the number of CPUs the job can use, which are split between them.
+    Forking a process while other threads run can leave the children with
+    locks that are never released, so the processes that run jobs in
+    threads (see executor.threaded_jobs) execute the runs one after the
+    other in the thread of the job, with all its CPUs, and the threads of
+    the prefetch.QiitaPrefetcher of the job are stopped before calling this
+    function. The only other thread, the heartbeat of qiita_client, only
+    holds the locks of its requests to Qiita, which the children don't do.
+    """
+    cpus = get_cpu_count()
+    processes = _fanout_processes(values)
+    q2params = dict(q2params)
+    threads = set_parallelism(method, q2params, max(1, cpus // processes))
+    # the processes of the pool only run this job so they can limit the
+    # threads of the numerical libraries, already loaded, to their share;
+    # this process can be running other jobs, see thread_limits
+    job = (method, q2params, fanout, out_dir, biom_fp, tree_fp, artifact_id,
+           threads if processes > 1 else None)
+    if processes <= 1:
+        results = [_fanout_worker(v, job) for v in values]
+    else:
+        with get_context('fork').Pool(
+                processes, initializer=_init_fanout,
+                initargs=(job, )) as pool:
+            results = pool.map(_fanout_worker, values)
+
+    ainfo = []
+    errors = []
+    for success, ai, msg, records in results:
+        profile.records.extend(records)
+        if success:
+            ainfo.extend(ai)
+        else:
+            errors.append(msg)
+    if errors:
+        return False, None, '\n'.join(errors)
     return True, ainfo, ""
@@ -0,0 +1,215 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from os import cpu_count, environ, sysconf
+from os.path import join
+from contextlib import ExitStack
+
+from threadpoolctl import threadpool_limits
+
+
+# the environment variables that size the thread pools of the numerical
+# libraries (OpenMP, MKL, OpenBLAS and numexpr)
+THREAD_VARIABLES = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS',
+                    'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+# the suffixes of the sizes in the environment variables, like 16G
+SIZE_SUFFIXES = {'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30, 'T': 2 ** 40}
+
+
+def get_cgroup_cpus(root='/sys/fs/cgroup'):
+    """Returns the CPUs of the cgroup CPU quota of the process
+
+    Parameters
+    ----------
+    root : str, optional
+        Where the cgroup filesystem is mounted
+
+    Returns
+    -------
+    float or None
+        The quota divided by the period, from cpu.max (cgroup v2) or
+        cpu/cpu.cfs_quota_us and cpu/cpu.cfs_period_us (cgroup v1), or None
+        if there is no quota
+    """
+    try:
+        with open(join(root, 'cpu.max')) as f:
+            quota, period = f.read().split()[:2]
+        return None if quota == 'max' else int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+
+    try:
+        with open(join(root, 'cpu', 'cpu.cfs_quota_us')) as f:
+            quota = int(f.read())
+        with open(join(root, 'cpu', 'cpu.cfs_period_us')) as f:
+            period = int(f.read())
+    except (OSError, ValueError):
+        return None
+    # the quota is -1 if there is no limit
+    return quota / period if quota > 0 and period > 0 else None
+
+
+def get_cpu_count():
+    """Returns the number of CPUs the job can use
+
+    Returns
+    -------
+    int
+        The value of the QP_QIIME2_CPUS environment variable, if set;
+        otherwise the number of CPUs in the affinity mask of the process (or
+        all the CPUs of the node if the platform doesn't support affinity
+        masks) capped by the cgroup CPU quota, see get_cgroup_cpus
+    """
+    cpus = environ.get('QP_QIIME2_CPUS')
+    if cpus:
+        return max(1, int(cpus))
+
+    try:
+        from os import sched_getaffinity
+        cpus = len(sched_getaffinity(0))
+    except ImportError:
+        cpus = cpu_count() or 1
+    quota = get_cgroup_cpus()
+    if quota is not None:
+        # rounding down so the job is not throttled
+        cpus = min(cpus, max(1, int(quota)))
+    return cpus
+
+
+def parse_size(size):
+    """Parses a size in bytes
+
+    Parameters
+    ----------
+    size : str
+        The size, in bytes or with one of the SIZE_SUFFIXES, like 16G
+
+    Returns
+    -------
+    int
+        The size in bytes
+
+    Raises
+    ------
+    ValueError
+        If size is not a valid size
+    """
+    size = size.strip().upper().rstrip('B')
+    factor = SIZE_SUFFIXES.get(size[-1:], 1)
+    if factor > 1:
+        size = size[:-1]
+    return int(float(size) * factor)
+
+
+def get_cgroup_memory(root='/sys/fs/cgroup'):
+    """Returns the memory limit of the cgroup of the process
+
+    Parameters
+    ----------
+    root : str, optional
+        Where the cgroup filesystem is mounted
+
+    Returns
+    -------
+    int or None
+        The limit in bytes, from memory.max (cgroup v2) or
+        memory/memory.limit_in_bytes (cgroup v1), or None if there is no
+        limit
+    """
+    for fp in ('memory.max', join('memory', 'memory.limit_in_bytes')):
+        try:
+            with open(join(root, fp)) as f:
+                limit = f.read().strip()
+        except OSError:
+            continue
+        if limit == 'max':
+            return None
+        try:
+            return int(limit)
+        except ValueError:
+            return None
+    return None
+
+
+def get_memory_limit():
+    """Returns the memory the job can use
+
+    Returns
+    -------
+    int or None
+        The value of the QP_QIIME2_MEMORY_LIMIT environment variable, if set
+        (see parse_size); otherwise the memory of the node capped by the
+        cgroup memory limit, see get_cgroup_memory. None if it is unknown
+    """
+    limit = environ.get('QP_QIIME2_MEMORY_LIMIT')
+    if limit:
+        return parse_size(limit)
+
+    try:
+        limit = sysconf('SC_PHYS_PAGES') * sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        limit = None
+    cgroup = get_cgroup_memory()
+    # cgroup v1 reports a huge number when there is no limit
+    if cgroup is not None and (limit is None or cgroup < limit):
+        limit = cgroup
+    return limit
+
+
+def limit_threads(n_threads):
+    """Caps the threads of the numerical libraries
+
+    Parameters
+    ----------
+    n_threads : int
+        The maximum number of threads
+
+    Notes
+    -----
+    Sets the THREAD_VARIABLES to n_threads, unless they are already set to
+    less, which caps the libraries loaded afterwards, including by the
+    processes started from this one, and caps the libraries already loaded,
+    like the ones of numpy, with threadpoolctl to the lowest of them. The
+    limit is process wide and permanent, so it is set once per process, see
+    scripts/start_qiime2 and worker.serve.
+    """
+    limits = []
+    for name in THREAD_VARIABLES:
+        try:
+            current = int(environ.get(name, ''))
+        except ValueError:
+            current = None
+        if current is None or current > n_threads:
+            environ[name] = str(n_threads)
+            current = n_threads
+        limits.append(current)
+    threadpool_limits(limits=max(1, min(limits)))
+
+
+def thread_limits(n_threads):
+    """Limits the threads of the numerical libraries already loaded
+
+    Parameters
+    ----------
+    n_threads : int or None
+        The maximum number of threads, None to not limit them
+
+    Returns
+    -------
+    context manager
+        The limit, from threadpoolctl
+
+    Notes
+    -----
+    The limit is process wide, so it should only be used in processes that
+    run a single job, like the processes of the fan-out runs.
+    """
+    if n_threads is None:
+        return ExitStack()
+    return threadpool_limits(limits=n_threads)
@@ -0,0 +1,95 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from os import makedirs, listdir, rename
+from os.path import join, dirname, relpath
+from shutil import rmtree
+from tempfile import mkdtemp
+from json import dump, load
+
+from .staging import link_or_copy
+
+
+RESULTS_FILENAME = 'results.json'
+
+
+def store_results(cache, key, out_dir, ainfo):
+    """Stores the results of a job in the results cache
+
+    Parameters
+    ----------
+    cache : cache.DiskCache
+        The results cache
+    key : str
+        The key of the job
+    out_dir : str
+        The folder with the files of the results
+    ainfo : list of (str, str, list of (str, str))
+        The output name, artifact type and files (filepath, filepath type)
+        of each output artifact, all the filepaths inside out_dir
+    """
+    with cache.put(key) as entry_fp:
+        results = []
+        for output_name, artifact_type, files in ainfo:
+            rfiles = []
+            for fp, fp_type in files:
+                rfp = relpath(fp, out_dir)
+                makedirs(dirname(join(entry_fp, rfp)), exist_ok=True)
+                link_or_copy(fp, join(entry_fp, rfp), hardlink=False)
+                rfiles.append((rfp, fp_type))
+            results.append((output_name, artifact_type, rfiles))
+        with open(join(entry_fp, RESULTS_FILENAME), 'w') as f:
+            dump(results, f)
+
+
+def restore_results(cache, key, out_dir):
+    """Restores the results of a job from the results cache
+
+    Parameters
+    ----------
+    cache : cache.DiskCache
+        The results cache
+    key : str
+        The key of the job
+    out_dir : str
+        The folder where to stage the files of the results, it must not have
+        files with the same names
+
+    Returns
+    -------
+    list of (str, str, list of (str, str)) or None
+        The results, see store_results, with the filepaths in out_dir; None
+        if they are not cached
+    """
+    entry_fp = cache.get(key)
+    if entry_fp is None:
+        return None
+
+    # the files are staged in a temporary folder and moved in place once all
+    # of them are restored, so a corrupted entry doesn't leave files behind
+    tmpdir = mkdtemp(prefix='.tmp', dir=out_dir)
+    try:
+        with open(join(entry_fp, RESULTS_FILENAME)) as f:
+            results = load(f)
+        ainfo = []
+        for output_name, artifact_type, rfiles in results:
+            files = []
+            for rfp, fp_type in rfiles:
+                makedirs(dirname(join(tmpdir, rfp)), exist_ok=True)
+                link_or_copy(join(entry_fp, rfp), join(tmpdir, rfp),
+                             hardlink=False)
+                files.append((join(out_dir, rfp), fp_type))
+            ainfo.append((output_name, artifact_type, files))
+        for name in listdir(tmpdir):
+            rename(join(tmpdir, name), join(out_dir, name))
+    except (OSError, ValueError):
+        # the entry was evicted or is corrupted so we run the job
+        return None
+    finally:
+        rmtree(tmpdir, ignore_errors=True)
+    return ainfo
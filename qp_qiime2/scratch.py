@@ -0,0 +1,219 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+import tempfile
+from os import environ, walk, lstat, makedirs
+from os.path import join, getsize, isfile
+from shutil import rmtree, disk_usage
+
+
+# the scratch space a job needs, as a multiple of the size of its inputs: the
+# inputs staged in the artifacts (when they can't be hardlinked), their
+# extraction when loaded from the caches and the results of the method
+SCRATCH_FACTOR = 3
+
+
+def get_scratch_dir():
+    """Returns the folder where the jobs create their scratch space
+
+    Returns
+    -------
+    str
+        The value of the QP_QIIME2_SCRATCH_DIR environment variable, if set,
+        or the system temporary folder
+    """
+    return environ.get('QP_QIIME2_SCRATCH_DIR') or tempfile.gettempdir()
+
+
+def use_scratch_dir():
+    """Routes the temporary files of the process to the scratch folder
+
+    Notes
+    -----
+    qiime2 writes the data of the Q2 artifacts to the temporary folder of the
+    process, which can't be set per job, so the entry points set it once to
+    get_scratch_dir (tempfile.tempdir and TMPDIR, which is inherited by the
+    forked processes) before running any job; see JobScratch.track.
+    """
+    path = get_scratch_dir()
+    makedirs(path, exist_ok=True)
+    tempfile.tempdir = path
+    environ['TMPDIR'] = path
+
+
+def _data_path(result):
+    """The folder of the data of a Q2 result, None if it isn't one"""
+    archiver = getattr(result, '_archiver', None)
+    return str(archiver.path) if archiver is not None else None
+
+
+def remove_data(results):
+    """Removes the data of Q2 results
+
+    Parameters
+    ----------
+    results : iterable
+        The Q2 artifacts or visualizations, anything else is ignored
+
+    Notes
+    -----
+    qiime2 only removes the data of a result when it is garbage collected,
+    which never happens in the processes that exit without cleaning up, like
+    the forked processes of a multiprocessing pool, so the results are
+    removed explicitly when they are no longer used.
+    """
+    for result in results:
+        path = _data_path(result)
+        if path is not None:
+            rmtree(path, ignore_errors=True)
+
+
+def _format_bytes(nbytes):
+    for unit in ('bytes', 'KiB', 'MiB', 'GiB'):
+        if nbytes < 1024:
+            return '%.1f %s' % (nbytes, unit)
+        nbytes /= 1024
+    return '%.1f TiB' % nbytes
+
+
+class JobScratch(object):
+    """The scratch space of a job
+
+    A context manager that creates a folder for the job, where the job
+    writes its temporary files, and removes it, and the data of the results
+    tracked by the job, at the end of the job, whether it succeeded or not.
+
+    Parameters
+    ----------
+    job_id : str, optional
+        The job id, used in the name of the folder
+    base_dir : str, optional
+        Where to create the folder, defaults to get_scratch_dir
+
+    Attributes
+    ----------
+    path : str
+        The folder of the job, while the job runs
+    peak_bytes : int
+        The maximum disk usage of the folder and the tracked results seen by
+        sample
+
+    Notes
+    -----
+    The folder is only used by the job, and the process wide temporary
+    folder is not changed, so the jobs running at the same time in the
+    threads of a process have their own folders and usage. The data of the
+    Q2 artifacts is written by qiime2 to the temporary folder of the process
+    instead, see use_scratch_dir, so the job tracks the artifacts it creates
+    to count them in its usage and remove them, see track.
+    """
+
+    def __init__(self, job_id=None, base_dir=None):
+        self.job_id = job_id
+        self.base_dir = base_dir if base_dir is not None else \
+            get_scratch_dir()
+        self.path = None
+        self.peak_bytes = 0
+        self._tracked = []
+
+    def __enter__(self):
+        makedirs(self.base_dir, exist_ok=True)
+        prefix = 'qp-qiime2-%s-' % self.job_id if self.job_id else \
+            'qp-qiime2-'
+        self.path = tempfile.mkdtemp(prefix=prefix, dir=self.base_dir)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.sample()
+        rmtree(self.path, ignore_errors=True)
+        # the results of the job are exported by now, see remove_data
+        for path in self._tracked:
+            rmtree(path, ignore_errors=True)
+        self.path = None
+        self._tracked = []
+
+    def track(self, result):
+        """Counts the data of a Q2 result in the usage of the job
+
+        Parameters
+        ----------
+        result : object
+            The Q2 artifact or visualization, anything else (like the
+            metadata) is ignored
+
+        Notes
+        -----
+        The data of the result is removed at the end of the job, so the
+        result can't be used after it.
+        """
+        path = _data_path(result)
+        if path is not None:
+            self._tracked.append(path)
+
+    def usage(self):
+        """Returns the bytes used by the files in the scratch space
+
+        Returns
+        -------
+        int
+            The disk usage of the files in the folder of the job and in the
+            data of the tracked results, counting once the files hardlinked
+            several times
+        """
+        seen = set()
+        nbytes = 0
+        for path in [self.path] + self._tracked:
+            # the data of the results is removed when they are released
+            for root, dirs, files in walk(path):
+                for name in files:
+                    try:
+                        st = lstat(join(root, name))
+                    except OSError:
+                        # removed while walking
+                        continue
+                    if (st.st_dev, st.st_ino) not in seen:
+                        seen.add((st.st_dev, st.st_ino))
+                        nbytes += st.st_blocks * 512
+        return nbytes
+
+    def sample(self):
+        """Updates peak_bytes with the current usage
+
+        Returns
+        -------
+        int
+            The current usage
+        """
+        nbytes = self.usage() if self.path is not None else 0
+        self.peak_bytes = max(self.peak_bytes, nbytes)
+        return nbytes
+
+    def check_space(self, fps):
+        """Checks that there is space for a job
+
+        Parameters
+        ----------
+        fps : list of str
+            The input files of the job, the ones that don't exist are
+            ignored as they fail later with a clearer error
+
+        Returns
+        -------
+        str
+            The error, if the free space is less than SCRATCH_FACTOR times
+            the size of the inputs, or an empty string
+        """
+        needed = SCRATCH_FACTOR * sum(
+            getsize(fp) for fp in fps if fp and isfile(fp))
+        free = disk_usage(self.path).free
+        if needed > free:
+            return ('Not enough scratch space in %s: the job needs about %s '
+                    'and there are %s free' % (
+                        self.base_dir, _format_bytes(needed),
+                        _format_bytes(free)))
+        return ''
@@ -0,0 +1,102 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from os import link, walk, stat, chmod
+from os.path import join, relpath
+from shutil import copyfile
+from fcntl import ioctl
+from stat import S_IMODE
+from zipfile import ZipFile, ZIP_STORED
+
+
+# linux ioctl to share the blocks of a file (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+
+def link_or_copy(src, dst, mode=None, hardlink=True):
+    """Stages a file without copying its contents when possible
+
+    Parameters
+    ----------
+    src : str
+        The filepath to stage
+    dst : str
+        The filepath where to stage it, it must not exist
+    mode : int, optional
+        The permissions of the staged file, the ones of a new file if not set
+    hardlink : bool, optional
+        Whether src can be hardlinked, it can't if either of them may be
+        modified
+
+    Returns
+    -------
+    str
+        How the file was staged: 'hardlink', if src and dst are in the same
+        filesystem; 'reflink', if the filesystem supports copy on write
+        clones; or 'copy' otherwise
+
+    Notes
+    -----
+    A hardlink shares the file with src, including its permissions, so the
+    staged file must not be modified, which is the case of the data of Q2
+    artifacts, and src is only hardlinked to set its permissions if it
+    already has them, or if it has no other links, like the data of a Q2
+    result that is only used by the job.
+    """
+    if hardlink and mode is not None:
+        st = stat(src)
+        hardlink = S_IMODE(st.st_mode) == mode or st.st_nlink == 1
+    how = None
+    if hardlink:
+        try:
+            link(src, dst)
+            how = 'hardlink'
+        except OSError:
+            pass
+
+    if how is None:
+        try:
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            how = 'reflink'
+        except OSError:
+            copyfile(src, dst)
+            how = 'copy'
+
+    if mode is not None:
+        chmod(dst, mode)
+    return how
+
+
+def save_uncompressed(result, fp):
+    """Saves a Q2 result as an uncompressed archive
+
+    Parameters
+    ----------
+    result : qiime2.Artifact or qiime2.Visualization
+        The result to save
+    fp : str
+        The filepath of the archive
+
+    Notes
+    -----
+    qiime2 compresses the archives it saves, which is wasted time for the
+    archives that never leave the node, like the cached imports. The
+    archive has the same layout as the ones saved by qiime2, skipping the
+    hidden files and folders, so it can be loaded with qiime2.Artifact.load.
+    """
+    root = str(result._archiver.path)
+    with ZipFile(fp, mode='w', compression=ZIP_STORED,
+                 allowZip64=True) as zf:
+        for dirpath, dirnames, filenames in walk(root):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            for f in filenames:
+                if f.startswith('.'):
+                    continue
+                abspath = join(dirpath, f)
+                zf.write(abspath, arcname=relpath(abspath, root))
@@ -0,0 +1,440 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from datetime import datetime
+from shutil import copyfile
+
+import h5py
+import numpy as np
+import pandas as pd
+
+
+# the number of values of the BIOM matrices processed at a time when
+# filtering a table out of core, see filter_table
+CHUNK_SIZE = 2 ** 22
+
+
+class InputTable(object):
+    """The BIOM table used as input of a job
+
+    Parameters
+    ----------
+    fp : str
+        The filepath of the BIOM table
+
+    Notes
+    -----
+    The table is never parsed: its size, whether it has taxonomy, the ids of
+    the features and the taxonomy are read from the HDF5 file, see
+    probe_table.
+    """
+    def __init__(self, fp):
+        self.fp = fp
+        self._probe = None
+
+    def feature_ids(self):
+        """The ids of the features of the table
+
+        Returns
+        -------
+        list of str
+            The ids, read from the HDF5 file without parsing the table
+        """
+        with h5py.File(self.fp, 'r') as h5:
+            return list(_observation_ids(h5))
+
+    def probe(self):
+        """The size of the table and whether it has taxonomy
+
+        Returns
+        -------
+        dict
+            See probe_table, read once from the HDF5 file
+        """
+        if self._probe is None:
+            self._probe = probe_table(self.fp)
+        return self._probe
+
+    def dimensions(self):
+        """The size of the table
+
+        Returns
+        -------
+        dict of {str: int}
+            The number of samples, features and non zero values (nnz) of the
+            table, see probe_table
+        """
+        probe = self.probe()
+        return {k: probe[k] for k in ('samples', 'features', 'nnz')}
+
+    def has_taxonomy(self):
+        """Whether the features of the table have taxonomy
+
+        Returns
+        -------
+        bool
+            See probe_table
+        """
+        return self.probe()['taxonomy']
+
+    def taxonomy(self):
+        """Generates the taxonomy of the features from the table metadata
+
+        Returns
+        -------
+        pd.DataFrame
+            The taxonomy of each feature in the Taxon column, indexed by
+            'Feature ID' as expected by FeatureData[Taxonomy]
+
+        Raises
+        ------
+        ValueError
+            If the table doesn't have taxonomy for all its features
+
+        Notes
+        -----
+        Only the ids and the observation/metadata/taxonomy dataset are read,
+        not the counts. The dataset has a row per feature with a column per
+        level, padded with empty strings, which are dropped the same way
+        biom does when it parses the table.
+        """
+        with h5py.File(self.fp, 'r') as h5:
+            ids = _observation_ids(h5)
+            metadata = h5.get('observation/metadata')
+            if metadata is None or 'taxonomy' not in metadata:
+                raise ValueError('The table has no taxonomy')
+            data = metadata['taxonomy'][()]
+
+        taxonomy = []
+        for oid, levels in zip(ids, data):
+            # a single string per feature, as some writers store it
+            if data.ndim == 1:
+                levels = [levels]
+            levels = [v.decode('utf-8') if isinstance(v, bytes) else v
+                      for v in levels if v]
+            if not levels:
+                raise ValueError(
+                    'Observation %s does not contain taxonomy' % oid)
+            taxonomy.append('; '.join(levels))
+
+        return pd.DataFrame({'Taxon': taxonomy},
+                            index=pd.Index(ids, name='Feature ID'))
+
+
+def probe_table(fp):
+    """Reads the size of a BIOM table without loading it
+
+    Parameters
+    ----------
+    fp : str
+        The filepath of the BIOM table
+
+    Returns
+    -------
+    dict
+        The number of 'samples' and 'features', the length of their ids
+        datasets, the number of non zero values, 'nnz', and whether the
+        observation metadata has a 'taxonomy' entry for each feature
+
+    Raises
+    ------
+    OSError
+        If fp is not an HDF5 file
+    KeyError
+        If fp is not a BIOM table, as it lacks the ids of the samples or
+        features
+
+    Notes
+    -----
+    Only the attributes of the file and the shape of its datasets are read,
+    so it takes the same time for any table.
+    """
+    with h5py.File(fp, 'r') as h5:
+        samples = len(h5['sample/ids'])
+        features = len(h5['observation/ids'])
+        if 'nnz' in h5.attrs:
+            nnz = int(h5.attrs['nnz'])
+        else:
+            nnz = len(h5['observation/matrix/data'])
+        metadata = h5.get('observation/metadata')
+        taxonomy = (metadata is not None and 'taxonomy' in metadata and
+                    len(metadata['taxonomy']) == features)
+    return {'samples': samples, 'features': features, 'nnz': nnz,
+            'taxonomy': taxonomy}
+
+
+def _ids(h5, axis):
+    """Reads the sample or observation ids of an open BIOM HDF5 file as str"""
+    ids = h5['%s/ids' % axis][()]
+    if len(ids) and isinstance(ids[0], bytes):
+        ids = np.char.decode(ids.astype(bytes), 'utf-8')
+    return ids
+
+
+def _observation_ids(h5):
+    """Reads the observation ids of an open BIOM HDF5 file as str"""
+    return _ids(h5, 'observation')
+
+
+def copy_observation_metadata(source, target):
+    """Copies the observation metadata between BIOM HDF5 files
+
+    Parameters
+    ----------
+    source : h5py.File
+        The BIOM file with the observation metadata
+    target : h5py.File
+        The BIOM file, open for writing, where to add the observation
+        metadata of its features
+
+    Notes
+    -----
+    Each of the metadata datasets of source, like taxonomy, is copied as an
+    array: the rows of the target features are selected with a single
+    indexing operation, instead of going feature by feature. Features that
+    are not in source get empty metadata.
+    """
+    src = source['observation/metadata']
+    if not len(src):
+        return
+
+    idx = pd.Index(_observation_ids(source)).get_indexer(
+        _observation_ids(target))
+    missing = idx < 0
+    dst = target['observation/metadata']
+    for key, ds in src.items():
+        data = ds[()]
+        if len(data):
+            values = data[np.where(missing, 0, idx)]
+        else:
+            values = np.zeros((len(idx), ) + data.shape[1:], dtype=data.dtype)
+        if missing.any():
+            values[missing] = b'' if values.dtype == object else 0
+        if key in dst:
+            del dst[key]
+        dst.create_dataset(key, data=values, dtype=ds.dtype,
+                           compression=ds.compression)
+
+
+def copy_table(in_fp, out_fp, metadata_fp=None):
+    """Copies a BIOM table adding the observation metadata of another table
+
+    Parameters
+    ----------
+    in_fp : str
+        The filepath of the BIOM table to copy
+    out_fp : str
+        The filepath where to write the table
+    metadata_fp : str, optional
+        The filepath of the BIOM table with the observation metadata
+
+    Notes
+    -----
+    The table is never loaded: the file is copied and the observation
+    metadata added to the copy, see copy_observation_metadata.
+    """
+    copyfile(in_fp, out_fp)
+    with h5py.File(out_fp, 'r+') as target:
+        target.attrs['generated-by'] = (
+            "Qiita's Qiime2 plugin with observation metadata")
+        if metadata_fp is not None:
+            target.require_group('observation/metadata')
+            with h5py.File(metadata_fp, 'r') as source:
+                copy_observation_metadata(source, target)
+
+
+def _row_chunks(indptr, chunk_size):
+    """Splits the rows of a CSR matrix in blocks of about chunk_size values"""
+    n = len(indptr) - 1
+    start = 0
+    while start < n:
+        end = np.searchsorted(
+            indptr, indptr[start] + chunk_size, side='right') - 1
+        end = min(max(end, start + 1), n)
+        yield start, end
+        start = end
+
+
+def _read_chunk(matrix, indptr, start, end):
+    """Reads the values of some rows of a BIOM matrix and their row"""
+    data = matrix['data'][indptr[start]:indptr[end]]
+    indices = matrix['indices'][indptr[start]:indptr[end]]
+    rows = np.repeat(np.arange(end - start), np.diff(indptr[start:end + 1]))
+    return data, indices, rows
+
+
+def _row_stats(matrix, chunk_size):
+    """The sum and number of values > 0 of each row of a BIOM matrix"""
+    indptr = matrix['indptr'][()]
+    n = len(indptr) - 1
+    sums = np.zeros(n)
+    nonzero = np.zeros(n, dtype=np.int64)
+    for start, end in _row_chunks(indptr, chunk_size):
+        data, _, rows = _read_chunk(matrix, indptr, start, end)
+        sums[start:end] = np.bincount(rows, weights=data,
+                                      minlength=end - start)
+        nonzero[start:end] = np.bincount(rows[data > 0],
+                                         minlength=end - start)
+    return sums, nonzero
+
+
+def _present_columns(matrix, row_mask, n_columns, chunk_size):
+    """Finds the columns with values > 0 in the selected rows"""
+    indptr = matrix['indptr'][()]
+    present = np.zeros(n_columns, dtype=bool)
+    for start, end in _row_chunks(indptr, chunk_size):
+        if not row_mask[start:end].any():
+            continue
+        data, indices, rows = _read_chunk(matrix, indptr, start, end)
+        present[indices[row_mask[start:end][rows] & (data > 0)]] = True
+    return present
+
+
+def _create_like(group, name, source, shape=(0, )):
+    """Creates a resizable dataset like another one"""
+    return group.create_dataset(
+        name, shape=shape, maxshape=(None, ) + shape[1:], dtype=source.dtype,
+        chunks=True, compression=source.compression)
+
+
+def _write_matrix(source, target, row_mask, column_map, chunk_size):
+    """Writes the selected rows and columns of a BIOM matrix
+
+    The rows are streamed in chunks; column_map has the new index of each
+    column, -1 for the ones that are removed.
+    """
+    indptr = source['indptr'][()]
+    data_ds = _create_like(target, 'data', source['data'])
+    indices_ds = _create_like(target, 'indices', source['indices'])
+    new_indptr = [np.zeros(1, dtype=indptr.dtype)]
+    nnz = 0
+    for start, end in _row_chunks(indptr, chunk_size):
+        keep_rows = row_mask[start:end]
+        if not keep_rows.any():
+            continue
+        data, indices, rows = _read_chunk(source, indptr, start, end)
+        keep = keep_rows[rows] & (column_map[indices] >= 0)
+        data = data[keep]
+        indices = column_map[indices[keep]]
+        counts = np.bincount(rows[keep], minlength=end - start)[keep_rows]
+        new_indptr.append(nnz + np.cumsum(counts).astype(indptr.dtype))
+
+        data_ds.resize((nnz + len(data), ))
+        data_ds[nnz:] = data
+        indices_ds.resize((nnz + len(data), ))
+        indices_ds[nnz:] = indices.astype(indices_ds.dtype)
+        nnz += len(data)
+
+    target.create_dataset(
+        'indptr', data=np.concatenate(new_indptr),
+        compression=source['indptr'].compression)
+    return nnz
+
+
+def _write_axis(source, target, axis, mask, column_map, chunk_size):
+    """Writes the ids, metadata and matrix of an axis of a BIOM file"""
+    src = source[axis]
+    dst = target.create_group(axis)
+    ids = src['ids']
+    dst.create_dataset('ids', data=ids[()][mask], dtype=ids.dtype,
+                       compression=ids.compression)
+
+    metadata = dst.create_group('metadata')
+    for key, ds in src['metadata'].items():
+        metadata.create_dataset(key, data=ds[()][mask], dtype=ds.dtype,
+                                compression=ds.compression)
+    source.copy(src['group-metadata'], dst, name='group-metadata')
+
+    return _write_matrix(src['matrix'], dst.create_group('matrix'), mask,
+                         column_map, chunk_size)
+
+
+def filter_table(in_fp, out_fp, axis, ids_to_keep=None, min_frequency=0,
+                 max_frequency=None, min_nonzero=0, max_nonzero=None,
+                 remove_empty=True, exclude_ids=False, chunk_size=CHUNK_SIZE):
+    """Filters a BIOM table without loading it in memory
+
+    Parameters
+    ----------
+    in_fp : str
+        The filepath of the BIOM table
+    out_fp : str
+        The filepath where to write the filtered table
+    axis : {'sample', 'observation'}
+        The axis to filter
+    ids_to_keep : iterable of str, optional
+        The ids that can be kept, all of them by default
+    min_frequency, max_frequency : float, optional
+        The range of the total frequency of the kept ids
+    min_nonzero, max_nonzero : int, optional
+        The range of the number of non zero values of the kept ids
+    remove_empty : bool, optional
+        Whether to remove the ids of the other axis left without counts
+    exclude_ids : bool, optional
+        Whether to invert the whole filter, removing the ids that would be
+        kept, as q2-feature-table does
+    chunk_size : int, optional
+        The number of values of the matrices processed at a time
+
+    Returns
+    -------
+    tuple of int
+        The shape of the filtered table, (observations, samples)
+
+    Notes
+    -----
+    The selection is the same as the one done by q2-feature-table's
+    filter_samples and filter_features. The statistics of each id are
+    computed from the matrix of its axis, both the sample and observation
+    matrices of the file are streamed in chunks into the filtered table and
+    the metadata of the kept ids, like the taxonomy, is copied, so the
+    memory used is bounded by the chunk size and the number of ids.
+    """
+    other = 'observation' if axis == 'sample' else 'sample'
+    with h5py.File(in_fp, 'r') as source:
+        ids = _ids(source, axis)
+        sums, nonzero = _row_stats(source[axis]['matrix'], chunk_size)
+        mask = ((sums >= min_frequency) & (nonzero >= min_nonzero))
+        if max_frequency is not None:
+            mask &= sums <= max_frequency
+        if max_nonzero is not None:
+            mask &= nonzero <= max_nonzero
+        if ids_to_keep is not None:
+            mask &= np.isin(ids, list(ids_to_keep))
+        if exclude_ids:
+            mask = ~mask
+
+        n_other = len(source[other]['ids'])
+        if remove_empty:
+            other_mask = _present_columns(
+                source[axis]['matrix'], mask, n_other, chunk_size)
+        else:
+            other_mask = np.ones(n_other, dtype=bool)
+
+        masks = {axis: mask, other: other_mask}
+        maps = {}
+        for ax, m in masks.items():
+            maps[ax] = np.full(len(m), -1, dtype=np.int64)
+            maps[ax][m] = np.arange(m.sum())
+
+        shape = (int(masks['observation'].sum()),
+                 int(masks['sample'].sum()))
+        with h5py.File(out_fp, 'w') as target:
+            for key, value in source.attrs.items():
+                target.attrs[key] = value
+            target.attrs['generated-by'] = (
+                "Qiita's Qiime2 plugin with observation metadata")
+            target.attrs['creation-date'] = datetime.now().isoformat()
+            target.attrs['shape'] = shape
+            nnz = 0
+            for ax in ('observation', 'sample'):
+                nnz = _write_axis(source, target, ax, masks[ax],
+                                  maps['sample' if ax == 'observation'
+                                       else 'observation'], chunk_size)
+            target.attrs['nnz'] = nnz
+    return shape
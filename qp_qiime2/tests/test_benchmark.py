@@ -0,0 +1,136 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from json import dumps
+
+from qp_qiime2.benchmark import (
+    generate_table, generate_tree, generate_distance_matrix,
+    generate_metadata, build_parameters, find_command, compare)
+
+
+class GenerateTests(TestCase):
+    def test_generate_table(self):
+        table = generate_table(20, 50, 0.1, seed=0)
+        self.assertEqual(table.shape, (50, 20))
+        # no empty samples
+        self.assertTrue((table.sum(axis='sample') > 0).all())
+        self.assertEqual(
+            table.metadata('F0', axis='observation')['taxonomy'],
+            ['k__Bacteria', 'p__P0', 'c__C0'])
+        # deterministic given the seed
+        self.assertEqual(table, generate_table(20, 50, 0.1, seed=0))
+
+    def test_generate_tree(self):
+        tree = generate_tree(['F0', 'F1', 'F2'], seed=0)
+        self.assertTrue(tree.endswith(';'))
+        for f in ['F0', 'F1', 'F2']:
+            self.assertEqual(tree.count(f + ':'), 1)
+        self.assertEqual(tree.count('('), 2)
+        self.assertEqual(tree.count(')'), 2)
+
+    def test_generate_distance_matrix(self):
+        lines = generate_distance_matrix(['S1', 'S2'], seed=0).splitlines()
+        self.assertEqual(lines[0], '\tS1\tS2')
+        self.assertTrue(lines[1].startswith('S1\t0.000000\t'))
+        self.assertEqual(lines[1].split('\t')[2], lines[2].split('\t')[1])
+        self.assertTrue(lines[2].endswith('\t0.000000'))
+
+    def test_generate_metadata(self):
+        md = generate_metadata(['S1', 'S2'], n_columns=2, seed=0)
+        self.assertEqual(set(md), {'S1', 'S2'})
+        self.assertEqual(set(md['S1']),
+                         {'env', 'categorical_0', 'numeric_1'})
+        self.assertEqual(md['S1']['env'], 'soil')
+        self.assertEqual(md['S2']['env'], 'water')
+
+
+class ParametersTests(TestCase):
+    def setUp(self):
+        self.command = {
+            'name': 'Rarefy table',
+            'req_params': {
+                'qp-hide-plugin': ('string', 'feature-table'),
+                'qp-hide-method': ('string', 'rarefy'),
+                'qp-hide-paramThe feature table': ('string', 'table'),
+                'The feature table': ('artifact', ['BIOM']),
+                'qp-hide-paramSampling depth': ('string', 'sampling_depth'),
+                'Sampling depth': ('integer', None)},
+            'opt_params': {
+                'qp-hide-paramWith replacement': ('string',
+                                                  'with_replacement'),
+                'With replacement': ('boolean', 'False'),
+                'qp-hide-paramRandom seed': ('string', 'random_seed'),
+                'Random seed': ('integer', None)}}
+
+    def test_build_parameters(self):
+        obs = build_parameters(self.command,
+                               {'table': '5', 'sampling_depth': '100'})
+        exp = {'qp-hide-plugin': 'feature-table',
+               'qp-hide-method': 'rarefy',
+               'qp-hide-paramThe feature table': 'table',
+               'The feature table': '5',
+               'qp-hide-paramSampling depth': 'sampling_depth',
+               'Sampling depth': '100',
+               'qp-hide-paramWith replacement': 'with_replacement',
+               'With replacement': 'False',
+               'qp-hide-paramRandom seed': 'random_seed',
+               'Random seed': 'None'}
+        self.assertEqual(obs, exp)
+
+    def test_find_command(self):
+        fanout = {'req_params': {
+            'qp-hide-plugin': ('string', 'feature-table'),
+            'qp-hide-method': ('string', 'rarefy'),
+            'qp-hide-fanout': ('string', 'sampling_depth')}}
+        commands = [fanout, self.command]
+        self.assertEqual(find_command('feature-table', 'rarefy', commands),
+                         self.command)
+        with self.assertRaises(ValueError):
+            find_command('diversity', 'alpha', commands)
+
+
+class CompareTests(TestCase):
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self.history_fp = join(self.tmpdir, 'history.jsonl')
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def _result(self, name, wall_time, timestamp, success=True, samples=10):
+        return {'benchmark': name, 'wall_time': wall_time,
+                'timestamp': timestamp, 'success': success,
+                'n_samples': samples, 'n_features': 20, 'density': 0.1,
+                'seed': 0}
+
+    def test_compare(self):
+        with open(self.history_fp, 'w') as f:
+            for r in [self._result('alpha', 3.0, 1),
+                      self._result('alpha', 2.0, 2),
+                      self._result('alpha', 1.0, 3, success=False),
+                      self._result('alpha', 9.0, 4, samples=50)]:
+                f.write(dumps(r) + '\n')
+            f.write('not json\n')
+
+        results = [self._result('alpha', 2.5, 10),
+                   self._result('rarefy', 1.0, 10)]
+        self.assertEqual(compare(results, self.history_fp),
+                         [('alpha', 2.5, 2.0), ('rarefy', 1.0, None)])
+
+    def test_compare_no_history(self):
+        self.assertEqual(compare([self._result('alpha', 2.5, 10)],
+                                 self.history_fp),
+                         [('alpha', 2.5, None)])
+
+
+if __name__ == '__main__':
+    main()
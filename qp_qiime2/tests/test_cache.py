@@ -0,0 +1,109 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from os import environ, utime, makedirs
+from os.path import join, exists
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from qp_qiime2.cache import DiskCache, get_cache, hash_file
+
+
+class DiskCacheTests(TestCase):
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self.cache = DiskCache(join(self.tmpdir, 'cache'), 10, suffix='.txt')
+        self._old_env = environ.get('QP_QIIME2_CACHE_DIR')
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+        if self._old_env is None:
+            environ.pop('QP_QIIME2_CACHE_DIR', None)
+        else:
+            environ['QP_QIIME2_CACHE_DIR'] = self._old_env
+
+    def _put(self, key, contents):
+        with self.cache.put(key) as fp:
+            with open(fp, 'w') as f:
+                f.write(contents)
+
+    def test_hash_file(self):
+        fp = join(self.tmpdir, 'file.txt')
+        with open(fp, 'w') as f:
+            f.write('qiime2')
+        exp = ('62e5f2edc1afd06ad3b176242cef8a04410a4186ab5a47a74ef292f6ca1287'
+               'a0')
+        self.assertEqual(hash_file(fp), exp)
+        self.assertEqual(hash_file(fp, block_size=2), exp)
+
+    def test_key(self):
+        self.assertEqual(DiskCache.key('a', 'b'), DiskCache.key('a', 'b'))
+        self.assertNotEqual(DiskCache.key('a', 'b'), DiskCache.key('ab'))
+
+    def test_get_put(self):
+        self.assertIsNone(self.cache.get('a'))
+        self._put('a', 'abcd')
+        fp = self.cache.get('a')
+        self.assertEqual(fp, join(self.tmpdir, 'cache', 'a.txt'))
+        with open(fp) as f:
+            self.assertEqual(f.read(), 'abcd')
+
+    def test_put_overwrite(self):
+        self._put('a', 'abcd')
+        self._put('a', 'efgh')
+        with open(self.cache.get('a')) as f:
+            self.assertEqual(f.read(), 'abcd')
+
+        with self.cache.put('a', overwrite=True) as fp:
+            with open(fp, 'w') as f:
+                f.write('efgh')
+        with open(self.cache.get('a')) as f:
+            self.assertEqual(f.read(), 'efgh')
+
+    def test_put_folder(self):
+        with self.cache.put('a') as fp:
+            makedirs(fp)
+            with open(join(fp, 'x'), 'w') as f:
+                f.write('abcd')
+        fp = self.cache.get('a')
+        self.assertTrue(exists(join(fp, 'x')))
+
+    def test_put_error(self):
+        with self.assertRaises(ValueError):
+            with self.cache.put('a'):
+                raise ValueError('Failed generating the entry')
+        self.assertIsNone(self.cache.get('a'))
+
+    def test_eviction(self):
+        self._put('a', 'abcd')
+        self._put('b', 'abcd')
+        # making sure that 'a' is the least recently used
+        utime(self.cache.get('a'), (0, 0))
+        self._put('c', 'abcd')
+        self.assertIsNone(self.cache.get('a'))
+        self.assertIsNotNone(self.cache.get('b'))
+        self.assertIsNotNone(self.cache.get('c'))
+
+    def test_get_cache(self):
+        environ.pop('QP_QIIME2_CACHE_DIR', None)
+        self.assertIsNone(get_cache('artifacts'))
+
+        environ['QP_QIIME2_CACHE_DIR'] = self.tmpdir
+        environ['QP_QIIME2_ARTIFACTS_CACHE_SIZE'] = '100'
+        try:
+            obs = get_cache('artifacts', suffix='.qza')
+        finally:
+            environ.pop('QP_QIIME2_ARTIFACTS_CACHE_SIZE')
+        self.assertEqual(obs.directory, join(self.tmpdir, 'artifacts'))
+        self.assertEqual(obs.max_size, 100)
+        self.assertEqual(obs.suffix, '.qza')
+
+
+if __name__ == '__main__':
+    main()
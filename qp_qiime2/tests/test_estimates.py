@@ -0,0 +1,211 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from unittest.mock import patch
+from os import environ
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from json import dumps
+
+from qp_qiime2.estimates import (
+    get_history_fp, count_tips, job_size, read_history, estimate_resources,
+    format_estimate, check_estimate, _read_backwards)
+
+
+class EstimatesTests(TestCase):
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self.history_fp = join(self.tmpdir, 'history.jsonl')
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def _profile(self, nnz, peak_rss, wall_time, metric=None, **info):
+        profile = {
+            'job_id': 'job', 'plugin': 'diversity', 'method': 'alpha',
+            'success': True, 'peak_rss': peak_rss, 'concurrent_jobs': 0,
+            'inputs': {'samples': 10, 'features': 20, 'nnz': nnz, 'tips': 0},
+            'records': [
+                {'name': 'import', 'rss_growth': 1, 'wall_time': 1},
+                {'name': 'run', 'rss_growth': 1, 'wall_time': wall_time}]}
+        if metric is not None:
+            profile['metric'] = metric
+        profile.update(info)
+        return profile
+
+    def test_get_history_fp(self):
+        with patch.dict(environ, {'QP_QIIME2_JOB_HISTORY': '',
+                                  'QP_QIIME2_METRICS_SINK': ''}):
+            self.assertIsNone(get_history_fp())
+            environ['QP_QIIME2_METRICS_SINK'] = 'udp://localhost:8125'
+            self.assertIsNone(get_history_fp())
+            environ['QP_QIIME2_METRICS_SINK'] = self.history_fp
+            self.assertEqual(get_history_fp(), self.history_fp)
+            environ['QP_QIIME2_JOB_HISTORY'] = 'other.jsonl'
+            self.assertEqual(get_history_fp(), 'other.jsonl')
+
+    def test_count_tips(self):
+        fp = join(self.tmpdir, 'tree.tre')
+        with open(fp, 'w') as f:
+            f.write('((a:1,b:2)c:1,(d:1,e:1,f:1):2,g:1);\n')
+        self.assertEqual(count_tips(fp), 6)
+        self.assertEqual(count_tips(fp, chunk_size=3), 6)
+
+    def test_job_size(self):
+        dims = {'samples': 10, 'features': 20, 'nnz': 100, 'tips': 30}
+        self.assertEqual(job_size(dims, False), 130)
+        self.assertEqual(job_size(dims, True), 530)
+
+    def test_read_history(self):
+        no_inputs = self._profile(300, 3000, 30, metric='shannon')
+        del no_inputs['inputs']
+        profiles = [
+            self._profile(100, 1000, 10, metric='shannon'),
+            self._profile(200, 2000, 20, metric='shannon'),
+            self._profile(100, 500, 5, metric='observed_features'),
+            # failed, without inputs, concurrent or of other methods
+            self._profile(300, 3000, 30, metric='shannon', success=False),
+            no_inputs,
+            self._profile(300, 3000, 30, metric='shannon',
+                          concurrent_jobs=2),
+            self._profile(300, 3000, 30, method='beta')]
+        with open(self.history_fp, 'w') as f:
+            for profile in profiles:
+                f.write(dumps(profile) + '\n')
+            f.write('not json\n')
+        obs = read_history('diversity', 'alpha', self.history_fp)
+        self.assertEqual(sorted(obs), ['observed_features', 'shannon'])
+        self.assertEqual([(d['nnz'], p, w) for d, p, w in obs['shannon']],
+                         [(100, 1000, 10), (200, 2000, 20)])
+        self.assertEqual(read_history('diversity', 'alpha', 'missing'), {})
+
+    def test_read_history_process(self):
+        profiles = [
+            self._profile(100, 1000, 10),
+            self._profile(200, 2000, 20, process='standalone'),
+            self._profile(300, 3500, 30, process='worker'),
+            self._profile(400, 4500, 40, process='threaded')]
+        with open(self.history_fp, 'w') as f:
+            for profile in profiles:
+                f.write(dumps(profile) + '\n')
+        # the profiles without a process model ran standalone
+        obs = read_history('diversity', 'alpha', self.history_fp)
+        self.assertEqual([d['nnz'] for d, p, w in obs[None]], [100, 200])
+        obs = read_history('diversity', 'alpha', self.history_fp,
+                           process='worker')
+        self.assertEqual([d['nnz'] for d, p, w in obs[None]], [300])
+        # defaults to the model of this process
+        with patch('qp_qiime2.profiling._PROCESS_MODEL', 'threaded'):
+            obs = read_history('diversity', 'alpha', self.history_fp)
+        self.assertEqual([d['nnz'] for d, p, w in obs[None]], [400])
+
+    def test_read_history_last(self):
+        with open(self.history_fp, 'w') as f:
+            for i in range(1, 6):
+                f.write(dumps(self._profile(100 * i, 1000 * i, 10 * i)) + '\n')
+        # the last runs, from the oldest to the newest
+        with patch('qp_qiime2.estimates.HISTORY_RUNS', 2):
+            obs = read_history('diversity', 'alpha', self.history_fp)
+        self.assertEqual([d['nnz'] for d, p, w in obs[None]], [400, 500])
+        # of the last jobs
+        with patch('qp_qiime2.estimates.HISTORY_JOBS', 3):
+            obs = read_history('diversity', 'alpha', self.history_fp)
+        self.assertEqual([d['nnz'] for d, p, w in obs[None]],
+                         [300, 400, 500])
+
+    def test_read_backwards(self):
+        with open(self.history_fp, 'w') as f:
+            f.write('first\nsecond line\n\nlast')
+        for block_size in (1, 4, 2 ** 16):
+            self.assertEqual(
+                list(_read_backwards(self.history_fp, block_size)),
+                ['last', '', 'second line', 'first'])
+
+    def test_read_history_fanout(self):
+        profile = {
+            'plugin': 'diversity', 'method': 'beta', 'success': True,
+            'peak_rss': 9, 'concurrent_jobs': 0,
+            'inputs': {'samples': 10, 'features': 20, 'nnz': 100},
+            'records': [
+                {'name': 'run', 'fanout': 'metric', 'wall_time': 9},
+                {'name': 'run:braycurtis', 'peak_rss': 1, 'wall_time': 2},
+                {'name': 'run:jaccard', 'peak_rss': 3, 'wall_time': 4}]}
+        with open(self.history_fp, 'w') as f:
+            f.write(dumps(profile) + '\n')
+        obs = read_history('diversity', 'beta', self.history_fp)
+        self.assertEqual(sorted(obs), ['braycurtis', 'jaccard'])
+        self.assertEqual(obs['jaccard'][0][1:], (3, 4))
+
+    def test_estimate_resources(self):
+        dims = {'samples': 10, 'features': 20, 'nnz': 100, 'tips': 0}
+        history = {
+            'shannon': [(dict(dims, nnz=100), 1000, 10),
+                        (dict(dims, nnz=200), 2100, 20),
+                        (dict(dims, nnz=300), 2900, 30)],
+            'chao1': [(dict(dims, nnz=100), 400, 4)]}
+
+        # the fit leaves all the previous runs below it
+        obs = estimate_resources('diversity', 'alpha', ['shannon'],
+                                 dict(dims, nnz=400), False, history=history)
+        self.assertEqual(obs['runs'], 3)
+        self.assertEqual(obs['peak_rss'], 4000)
+        self.assertAlmostEqual(obs['wall_time'], 40)
+
+        # a single run, or runs of a single size, don't scale with the size
+        obs = estimate_resources('diversity', 'alpha', ['chao1'],
+                                 dict(dims, nnz=2000), False, history=history)
+        self.assertEqual(obs['peak_rss'], 400)
+        self.assertAlmostEqual(obs['wall_time'], 4)
+        history['chao1'].append((dict(dims, nnz=100), 500, 5))
+        obs = estimate_resources('diversity', 'alpha', ['chao1'],
+                                 dict(dims, nnz=2000), False, history=history)
+        self.assertEqual(obs['peak_rss'], 500)
+        self.assertAlmostEqual(obs['wall_time'], 5)
+        history['chao1'].pop()
+
+        # the baseline is never negative
+        obs = estimate_resources(
+            'diversity', 'alpha', ['simpson'], dict(dims, nnz=300), False,
+            history={'simpson': [(dict(dims, nnz=100), 100, 1),
+                                 (dict(dims, nnz=200), 300, 3)]})
+        self.assertEqual(obs['peak_rss'], 600)
+        self.assertAlmostEqual(obs['wall_time'], 6)
+
+        # the runs in their own processes add their peaks
+        obs = estimate_resources('diversity', 'alpha', ['shannon', 'chao1'],
+                                 dims, False, processes=2, history=history)
+        self.assertEqual(obs['peak_rss'], 1150 + 400)
+        self.assertAlmostEqual(obs['wall_time'], 10)
+        obs = estimate_resources('diversity', 'alpha', ['shannon', 'chao1'],
+                                 dims, False, history=history)
+        self.assertEqual(obs['peak_rss'], 1150)
+        self.assertAlmostEqual(obs['wall_time'], 14)
+
+        # no history for one of the metrics
+        self.assertIsNone(estimate_resources(
+            'diversity', 'alpha', ['shannon', 'faith_pd'], dims, False,
+            history=history))
+
+    def test_check_estimate(self):
+        estimate = {'peak_rss': 3 * 2 ** 30, 'wall_time': 3600, 'runs': 5}
+        self.assertEqual(format_estimate(estimate),
+                         'about 3.0 GiB of memory and 1:00:00')
+        self.assertEqual(check_estimate(estimate, 4 * 2 ** 30, 7200), '')
+        self.assertEqual(
+            check_estimate(estimate, 2 ** 30, 7200),
+            'The job needs about 3.0 GiB of memory but it can use 1.0 GiB '
+            '(estimated from 5 previous runs); please run it with a larger '
+            'allocation or on a smaller table')
+        self.assertIn('and 1:00:00 to run but it can run for 0:30:00',
+                      check_estimate(estimate, 2 ** 30, 1800))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from unittest.mock import patch
+from os import getpid
+from threading import Event, Lock, Thread
+from time import sleep
+
+from qp_qiime2.executor import JobExecutor, threaded_jobs
+
+
+def _pid(value):
+    return value, getpid()
+
+
+class JobExecutorTests(TestCase):
+    def test_threads(self):
+        lock = Lock()
+        running = [0, 0]
+
+        def job(value):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            sleep(0.05)
+            with lock:
+                running[0] -= 1
+            return value * 2
+
+        with JobExecutor(2) as executor:
+            obs = executor.map(job, range(6))
+        self.assertEqual(obs, [0, 2, 4, 6, 8, 10])
+        # never more than max_jobs at the same time
+        self.assertEqual(running[1], 2)
+
+    def test_threaded_jobs(self):
+        with patch('qp_qiime2.executor._THREADED_JOBS', False):
+            with JobExecutor(2, processes=True):
+                self.assertFalse(threaded_jobs())
+            with JobExecutor(2):
+                self.assertTrue(threaded_jobs())
+
+    def test_processes(self):
+        with JobExecutor(2, processes=True) as executor:
+            obs = executor.map(_pid, range(4))
+        self.assertEqual([v for v, _ in obs], [0, 1, 2, 3])
+        self.assertNotIn(getpid(), [pid for _, pid in obs])
+
+    def test_bounded(self):
+        release = Event()
+        executor = JobExecutor(1, max_pending=1)
+        executor.submit(release.wait)
+        executor.submit(release.wait)
+
+        # the third job waits until there is a free slot
+        submitted = Event()
+
+        def submit():
+            executor.submit(release.wait)
+            submitted.set()
+
+        thread = Thread(target=submit)
+        thread.start()
+        self.assertFalse(submitted.wait(0.1))
+        release.set()
+        self.assertTrue(submitted.wait(5))
+        thread.join()
+        executor.shutdown()
+
+    def test_error(self):
+        def job(value):
+            raise ValueError('Job %d failed' % value)
+
+        with JobExecutor(1) as executor:
+            future = executor.submit(job, 1)
+            with self.assertRaisesRegex(ValueError, 'Job 1 failed'):
+                future.result()
+            # the slot of the failed job is released
+            self.assertEqual(executor.submit(abs, -1).result(), 1)
+
+
+if __name__ == '__main__':
+    main()
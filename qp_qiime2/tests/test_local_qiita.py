@@ -0,0 +1,118 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from collections import namedtuple
+from json import dumps
+from time import time
+
+from qp_qiime2.local_qiita import LocalQiita, write_fixtures
+
+
+ArtifactInfo = namedtuple('ArtifactInfo',
+                          ['output_name', 'artifact_type', 'files'])
+
+
+class LocalQiitaTests(TestCase):
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self.fixtures = {
+            'artifacts': {
+                '1': {'type': 'BIOM', 'analysis': 1,
+                      'files': {'biom': ['table.biom'],
+                                'plain_text': ['/abs/tree.tre']}},
+                '2': {'type': 'BIOM', 'analysis': None,
+                      'files': {'biom': ['other.biom']}}},
+            'analyses': {
+                '1': {'metadata': {'S1': {'env': 'soil'}}}},
+            'jobs': {
+                'job-1': {'command': ['qiime2', '2019.1', 'Rarefy table'],
+                          'parameters': {'depth': '10'}}}}
+        write_fixtures(self.tmpdir, self.fixtures)
+        self.qclient = LocalQiita.from_directory(self.tmpdir)
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def test_get_artifact(self):
+        obs = self.qclient.get('/qiita_db/artifacts/1/')
+        self.assertEqual(obs['analysis'], 1)
+        self.assertEqual(obs['type'], 'BIOM')
+        self.assertEqual(obs['files'],
+                         {'biom': [join(self.tmpdir, 'table.biom')],
+                          'plain_text': ['/abs/tree.tre']})
+        self.assertIsNone(self.qclient.get('/qiita_db/artifacts/2')[
+            'analysis'])
+
+    def test_get_metadata(self):
+        self.assertEqual(self.qclient.get('/qiita_db/analysis/1/metadata/'),
+                         {'S1': {'env': 'soil'}})
+
+    def test_not_found(self):
+        with self.assertRaisesRegex(RuntimeError, 'Status code: 404'):
+            self.qclient.get('/qiita_db/artifacts/3/')
+        with self.assertRaisesRegex(RuntimeError, 'Status code: 404'):
+            self.qclient.get('/qiita_db/unknown/')
+        self.qclient.update_job_step('job-2', 'step', ignore_error=True)
+
+    def test_job(self):
+        self.assertEqual(self.qclient.get_job_info('job-1'), {
+            'command': ['qiime2', '2019.1', 'Rarefy table'],
+            'parameters': {'depth': '10'}, 'status': 'queued', 'msg': ''})
+
+        self.qclient.start_heartbeat('job-1')
+        self.qclient.update_job_step('job-1', 'Step 1 of 4')
+        self.qclient.complete_job(
+            'job-1', True, artifacts_info=[
+                ArtifactInfo('rarefied_table', 'BIOM', [('t.biom', 'biom')])])
+        job = self.qclient.jobs['job-1']
+        self.assertEqual(job['status'], 'success')
+        self.assertEqual(job['steps'], ['Step 1 of 4'])
+        self.assertEqual(job['heartbeats'], 1)
+        self.assertEqual(job['artifacts'], {
+            'rarefied_table': {'filepaths': [('t.biom', 'biom')],
+                               'artifact_type': 'BIOM'}})
+
+        self.qclient.complete_job('job-1', False, error_msg='failed')
+        self.assertEqual(self.qclient.get_job_info('job-1')['status'],
+                         'error')
+        self.assertEqual(self.qclient.get_job_info('job-1')['msg'], 'failed')
+
+    def test_post_job(self):
+        jid = self.qclient.post('/apitest/processing_job/', data={
+            'command': dumps(['qiime2', '2019.1', 'Alpha diversity']),
+            'parameters': dumps({'metric': 'shannon'}),
+            'status': 'queued'})['job']
+        self.assertEqual(self.qclient.get_job_info(jid)['parameters'],
+                         {'metric': 'shannon'})
+
+    def test_register(self):
+        url = '/qiita_db/plugins/qiime2/2019.1/'
+        self.assertEqual(self.qclient.get(url)['commands'], [])
+        self.qclient.post(url + 'commands/',
+                          data={'name': 'Rarefy table', 'description': ''})
+        self.assertEqual(self.qclient.get(url)['commands'], ['Rarefy table'])
+
+    def test_latency(self):
+        qclient = LocalQiita(self.fixtures, latency=0.05, jitter=0.05,
+                             seed=0)
+        start = time()
+        qclient.get('/qiita_db/analysis/1/metadata/')
+        self.assertGreaterEqual(time() - start, 0.05)
+        self.assertEqual(len(qclient.requests), 1)
+        method, url, elapsed = qclient.requests[0]
+        self.assertEqual((method, url),
+                         ('GET', '/qiita_db/analysis/1/metadata/'))
+        self.assertGreaterEqual(elapsed, 0.05)
+
+
+if __name__ == '__main__':
+    main()
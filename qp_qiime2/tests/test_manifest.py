@@ -0,0 +1,88 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from unittest.mock import patch
+from os import environ
+from os.path import join, exists
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from qiime2 import __version__ as qiime2_version
+
+from qp_qiime2 import __version__
+from qp_qiime2.manifest import (
+    get_manifest_fp, get_manifest_key, load_manifest, write_manifest,
+    get_commands, MANIFEST_FORMAT)
+
+
+class ManifestTests(TestCase):
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self.fp = join(self.tmpdir, 'manifest.json')
+        self.key = {'format': MANIFEST_FORMAT, 'qp-qiime2': __version__,
+                    'qiime2': qiime2_version,
+                    'plugins': {'diversity': qiime2_version}}
+        self.commands = [{
+            'name': 'Rarefy table', 'description': 'Rarefy',
+            'req_params': {'qp-hide-plugin': ['string', 'feature-table'],
+                           'qp-hide-method': ['string', 'rarefy']},
+            'opt_params': {}, 'outputs': {'rarefied_table': 'BIOM'}}]
+        self._old_env = environ.get('QP_QIIME2_MANIFEST')
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+        if self._old_env is None:
+            environ.pop('QP_QIIME2_MANIFEST', None)
+        else:
+            environ['QP_QIIME2_MANIFEST'] = self._old_env
+
+    def test_get_manifest_fp(self):
+        environ['QP_QIIME2_MANIFEST'] = self.fp
+        self.assertEqual(get_manifest_fp(), self.fp)
+
+    def test_get_manifest_key(self):
+        key = get_manifest_key()
+        self.assertEqual(key['format'], MANIFEST_FORMAT)
+        self.assertEqual(key['qp-qiime2'], __version__)
+        self.assertEqual(key['qiime2'], qiime2_version)
+        self.assertIn('diversity', key['plugins'])
+
+        # a new version of qp-qiime2 should not reuse the manifest
+        with patch('qp_qiime2.__version__', 'another-version'):
+            self.assertNotEqual(get_manifest_key(), key)
+
+    def test_write_load_manifest(self):
+        self.assertIsNone(load_manifest(self.fp, self.key))
+        write_manifest(self.fp, self.key, self.commands)
+        self.assertEqual(load_manifest(self.fp, self.key), self.commands)
+
+        # a different installation should not reuse the manifest
+        key = dict(self.key)
+        key['plugins'] = {'diversity': 'another-version'}
+        self.assertIsNone(load_manifest(self.fp, key))
+
+    def test_load_manifest_corrupt(self):
+        with open(self.fp, 'w') as f:
+            f.write('{"key": ')
+        self.assertIsNone(load_manifest(self.fp, self.key))
+
+    def test_get_commands(self):
+        environ['QP_QIIME2_MANIFEST'] = self.fp
+        obs = get_commands()
+        self.assertTrue(exists(self.fp))
+        names = {c['name'] for c in obs}
+        self.assertIn('Rarefy table', names)
+        self.assertIn('Beta diversity', names)
+        # the second call should be served from the manifest
+        self.assertEqual(get_commands(), load_manifest(
+            self.fp, get_manifest_key()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from unittest.mock import patch
+from os import environ
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import numpy as np
+import pandas as pd
+
+from qiime2 import Metadata
+
+from qp_qiime2.metadata import metadata_dataframe, get_analysis_metadata
+
+
+class FakeClient(object):
+    """Returns the same metadata for every analysis and counts the calls"""
+    _server_url = 'https://localhost:21174'
+
+    def __init__(self, metadata):
+        self.metadata = metadata
+        self.calls = 0
+
+    def get(self, url):
+        self.calls += 1
+        return self.metadata
+
+
+class MetadataTests(TestCase):
+    def setUp(self):
+        self.metadata = {
+            'S1': {'ph': '7.1', 'depth': 10, 'env': 'soil', 'code': 'nan',
+                   'flag': True, 'empty': '', 'mixed': '1'},
+            'S2': {'ph': '6', 'depth': 5, 'env': ' water ', 'code': '1',
+                   'flag': False, 'empty': None, 'mixed': 'Not applicable'},
+            'S3': {'ph': '', 'depth': 1, 'env': None, 'code': '2',
+                   'flag': True, 'empty': '', 'mixed': '3'}}
+
+    def test_metadata_dataframe(self):
+        obs = metadata_dataframe(self.metadata)
+        self.assertEqual(obs.index.name, '#SampleID')
+        self.assertEqual(list(obs.index), ['S1', 'S2', 'S3'])
+
+        # numeric columns
+        np.testing.assert_array_equal(obs['ph'], [7.1, 6, np.nan])
+        np.testing.assert_array_equal(obs['depth'], [10, 5, 1])
+        self.assertTrue(pd.api.types.is_numeric_dtype(obs['ph']))
+        self.assertTrue(pd.api.types.is_numeric_dtype(obs['depth']))
+        self.assertTrue(pd.api.types.is_numeric_dtype(obs['empty']))
+
+        # categorical columns
+        self.assertEqual(list(obs['env'][:2]), ['soil', 'water'])
+        self.assertTrue(np.isnan(obs['env']['S3']))
+        self.assertEqual(list(obs['code']), ['nan', '1', '2'])
+        self.assertEqual(list(obs['flag']), ['True', 'False', 'True'])
+        self.assertEqual(list(obs['mixed']), ['1', 'Not applicable', '3'])
+
+    def test_metadata_dataframe_same_as_load(self):
+        # the types need to be the same that we get when loading the file
+        # with qiime2
+        tmpdir = mkdtemp()
+        try:
+            fp = join(tmpdir, 'metadata.txt')
+            df = pd.DataFrame.from_dict(self.metadata, orient='index')
+            df.to_csv(fp, index_label='#SampleID', na_rep='', sep='\t',
+                      encoding='utf-8')
+            exp = Metadata.load(fp)
+        finally:
+            rmtree(tmpdir)
+        obs = Metadata(metadata_dataframe(self.metadata))
+        self.assertEqual(obs.columns, exp.columns)
+        self.assertEqual(obs, exp)
+
+    def test_get_analysis_metadata(self):
+        tmpdir = mkdtemp()
+        old_env = {k: environ.get(k) for k in (
+            'QP_QIIME2_CACHE_DIR', 'QP_QIIME2_METADATA_CACHE_TTL')}
+        qclient = FakeClient(self.metadata)
+        try:
+            environ.pop('QP_QIIME2_CACHE_DIR', None)
+            environ.pop('QP_QIIME2_METADATA_CACHE_TTL', None)
+            exp = Metadata(metadata_dataframe(self.metadata))
+            self.assertEqual(get_analysis_metadata(qclient, 1), exp)
+            self.assertEqual(qclient.calls, 1)
+
+            environ['QP_QIIME2_CACHE_DIR'] = tmpdir
+            self.assertEqual(get_analysis_metadata(qclient, 1), exp)
+            self.assertEqual(qclient.calls, 2)
+            # the second time it is downloaded again but parsed from the cache
+            with patch('qp_qiime2.metadata.metadata_dataframe') as mdf:
+                self.assertEqual(get_analysis_metadata(qclient, 1), exp)
+                self.assertEqual(mdf.call_count, 0)
+            self.assertEqual(qclient.calls, 3)
+
+            # only the requested columns
+            obs = get_analysis_metadata(qclient, 1, ['ph', 'env'])
+            self.assertEqual(qclient.calls, 4)
+            self.assertEqual(obs, Metadata(
+                metadata_dataframe(self.metadata)[['ph', 'env']]))
+
+            # the changes in Qiita are always used
+            qclient.metadata = {'S1': {'ph': '7.2'}}
+            self.assertEqual(get_analysis_metadata(qclient, 1), Metadata(
+                metadata_dataframe(qclient.metadata)))
+            self.assertEqual(qclient.calls, 5)
+        finally:
+            for k, v in old_env.items():
+                if v is None:
+                    environ.pop(k, None)
+                else:
+                    environ[k] = v
+            rmtree(tmpdir)
+
+    def test_get_analysis_metadata_ttl(self):
+        tmpdir = mkdtemp()
+        old_env = {k: environ.get(k) for k in (
+            'QP_QIIME2_CACHE_DIR', 'QP_QIIME2_METADATA_CACHE_TTL')}
+        qclient = FakeClient(self.metadata)
+        try:
+            environ['QP_QIIME2_CACHE_DIR'] = tmpdir
+            environ['QP_QIIME2_METADATA_CACHE_TTL'] = '3600'
+            exp = Metadata(metadata_dataframe(self.metadata))
+            self.assertEqual(get_analysis_metadata(qclient, 1), exp)
+            self.assertEqual(qclient.calls, 1)
+            # within the TTL it is not downloaded again
+            self.assertEqual(get_analysis_metadata(qclient, 1), exp)
+            obs = get_analysis_metadata(qclient, 1, ['ph', 'env'])
+            self.assertEqual(qclient.calls, 1)
+            self.assertEqual(obs, Metadata(
+                metadata_dataframe(self.metadata)[['ph', 'env']]))
+
+            # a different analysis is not in the cache
+            get_analysis_metadata(qclient, 2, ['ph'])
+            self.assertEqual(qclient.calls, 2)
+
+            # after the TTL it is checked again
+            environ['QP_QIIME2_METADATA_CACHE_TTL'] = '0'
+            get_analysis_metadata(qclient, 1)
+            self.assertEqual(qclient.calls, 3)
+        finally:
+            for k, v in old_env.items():
+                if v is None:
+                    environ.pop(k, None)
+                else:
+                    environ[k] = v
+            rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from json import dumps
+from threading import Event
+
+from qp_qiime2.pipeline import parse_pipeline, run_dag, dag_width
+
+
+class ParsePipelineTests(TestCase):
+    def setUp(self):
+        self.pipeline = {
+            'steps': {
+                'rarefied': {
+                    'action': 'feature-table.rarefy',
+                    'inputs': {'table': 'table'},
+                    'parameters': {'sampling_depth': 100}},
+                'beta': {
+                    'action': 'diversity.beta',
+                    'inputs': {'table': 'rarefied.rarefied_table'},
+                    'parameters': {'metric': 'braycurtis'}},
+                'alpha': {
+                    'action': 'diversity.alpha',
+                    'inputs': {'table': 'rarefied.rarefied_table'},
+                    'parameters': {'metric': 'shannon'}},
+                'pcoa': {
+                    'action': 'diversity.pcoa',
+                    'inputs': {'distance_matrix': 'beta.distance_matrix'}},
+                'emperor': {
+                    'action': 'emperor.plot',
+                    'inputs': {'pcoa': 'pcoa.pcoa', 'metadata': 'metadata'}}},
+            'outputs': ['beta.distance_matrix', 'emperor.visualization']}
+
+    def test_parse_pipeline(self):
+        steps, dependencies, outputs = parse_pipeline(dumps(self.pipeline))
+        # alpha is not used by the outputs
+        self.assertEqual(dependencies, {
+            'rarefied': set(), 'beta': {'rarefied'}, 'pcoa': {'beta'},
+            'emperor': {'pcoa'}})
+        self.assertEqual(steps['rarefied'], {
+            'plugin': 'feature-table', 'method': 'rarefy',
+            'inputs': {'table': 'table'},
+            'parameters': {'sampling_depth': 100}})
+        self.assertEqual(outputs, [('beta', 'distance_matrix'),
+                                   ('emperor', 'visualization')])
+
+    def test_parse_pipeline_errors(self):
+        with self.assertRaisesRegex(ValueError, 'not valid JSON'):
+            parse_pipeline('{')
+        with self.assertRaisesRegex(ValueError, 'no steps'):
+            parse_pipeline({'outputs': ['a.b']})
+        with self.assertRaisesRegex(ValueError, 'no outputs'):
+            parse_pipeline({'steps': self.pipeline['steps']})
+
+        self.pipeline['steps']['beta']['action'] = 'beta'
+        with self.assertRaisesRegex(ValueError, 'no valid action'):
+            parse_pipeline(self.pipeline)
+        self.pipeline['steps']['beta']['action'] = 'diversity.beta'
+
+        self.pipeline['steps']['pcoa']['inputs']['distance_matrix'] = 'dm'
+        with self.assertRaisesRegex(ValueError, 'Invalid source: "dm"'):
+            parse_pipeline(self.pipeline)
+
+        self.pipeline['steps']['pcoa']['inputs']['distance_matrix'] = \
+            'other.distance_matrix'
+        with self.assertRaisesRegex(ValueError, '"other", which is not'):
+            parse_pipeline(self.pipeline)
+
+        self.pipeline['steps']['pcoa']['inputs']['distance_matrix'] = \
+            'beta.distance_matrix'
+        self.pipeline['outputs'] = ['other.distance_matrix']
+        with self.assertRaisesRegex(ValueError, 'not the output of a step'):
+            parse_pipeline(self.pipeline)
+
+    def test_parse_pipeline_cycle(self):
+        self.pipeline['steps']['rarefied']['inputs']['table'] = \
+            'emperor.visualization'
+        with self.assertRaisesRegex(
+                ValueError, '"beta", "emperor", "pcoa", "rarefied" depend'):
+            parse_pipeline(self.pipeline)
+
+
+class RunDagTests(TestCase):
+    def test_run_dag(self):
+        dependencies = {'a': set(), 'b': {'a'}, 'c': {'a'}, 'd': {'b', 'c'}}
+
+        def run_step(step, results):
+            self.assertTrue(dependencies[step].issubset(results))
+            return ''.join(sorted(results[d] for d in dependencies[step])) + \
+                step
+
+        obs = run_dag(dependencies, run_step, max_workers=2)
+        self.assertEqual(obs, {'a': 'a', 'b': 'ab', 'c': 'ac', 'd': 'abacd'})
+
+    def test_run_dag_concurrent(self):
+        # b and c only finish if they run at the same time
+        events = {'b': Event(), 'c': Event()}
+
+        def run_step(step, results):
+            if step in events:
+                events[step].set()
+                other = events['c' if step == 'b' else 'b']
+                if not other.wait(5):
+                    raise RuntimeError('%s ran alone' % step)
+            return step
+
+        obs = run_dag({'a': set(), 'b': {'a'}, 'c': {'a'}}, run_step,
+                      max_workers=2)
+        self.assertEqual(obs, {'a': 'a', 'b': 'b', 'c': 'c'})
+
+    def test_run_dag_error(self):
+        ran = []
+
+        def run_step(step, results):
+            ran.append(step)
+            if step == 'a':
+                raise RuntimeError('Error running step "a"')
+            return step
+
+        with self.assertRaisesRegex(RuntimeError, 'step "a"'):
+            run_dag({'a': set(), 'b': {'a'}}, run_step)
+        self.assertEqual(ran, ['a'])
+
+    def test_dag_width(self):
+        self.assertEqual(dag_width({}), 1)
+        self.assertEqual(dag_width({'a': set(), 'b': {'a'}}), 1)
+        self.assertEqual(dag_width(
+            {'a': set(), 'b': {'a'}, 'c': {'a'}, 'd': {'a'}, 'e': {'b'}}), 3)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from os import environ
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time, sleep
+
+from qp_qiime2.local_qiita import LocalQiita
+from qp_qiime2.manifest import get_manifest_key, write_manifest
+from qp_qiime2.prefetch import QiitaPrefetcher, job_requests
+
+
+class QiitaPrefetcherTests(TestCase):
+    def setUp(self):
+        self.qclient = LocalQiita({
+            'artifacts': {
+                '1': {'analysis': 1, 'files': {'biom': ['/t1.biom']}},
+                '2': {'analysis': 1, 'files': {'biom': ['/t2.biom']}}},
+            'analyses': {
+                '1': {'metadata': {'S1': {'env': 'soil', 'ph': '7.1'},
+                                   'S2': {'env': 'water', 'ph': '6.5'}}}}},
+            latency=0.2)
+
+    def test_artifact(self):
+        start = time()
+        with QiitaPrefetcher(self.qclient) as prefetch:
+            f1 = prefetch.artifact('1')
+            f2 = prefetch.artifact(2)
+            # the same request is only sent once
+            self.assertIs(prefetch.artifact(1), f1)
+            self.assertEqual(f1.result()['files'], {'biom': ['/t1.biom']})
+            self.assertEqual(f2.result()['files'], {'biom': ['/t2.biom']})
+        # both requests were sent at the same time
+        self.assertLess(time() - start, 0.4)
+        self.assertEqual(len(self.qclient.requests), 2)
+
+    def test_metadata(self):
+        with QiitaPrefetcher(self.qclient, max_workers=1) as prefetch:
+            md = prefetch.metadata('1', 'env').result()
+            self.assertEqual(list(md.columns), ['env'])
+            self.assertEqual(md.get_column('env').get_value('S2'), 'water')
+        self.assertEqual(
+            [r[1] for r in self.qclient.requests],
+            ['/qiita_db/artifacts/1/', '/qiita_db/analysis/1/metadata/'])
+
+    def test_errors(self):
+        with QiitaPrefetcher(self.qclient) as prefetch:
+            with self.assertRaises(RuntimeError):
+                prefetch.artifact('3').result()
+
+    def test_close(self):
+        prefetch = QiitaPrefetcher(self.qclient, max_workers=1)
+        f1 = prefetch.artifact('1')
+        f2 = prefetch.artifact('2')
+        while not f1.running():
+            sleep(0.01)
+        prefetch.close(wait=True)
+        # the running request finished, the pending one was cancelled and
+        # the threads exited
+        self.assertEqual(f1.result()['files'], {'biom': ['/t1.biom']})
+        self.assertTrue(f2.cancelled())
+        self.assertFalse(
+            any(t.is_alive() for t in prefetch._executor._threads))
+
+
+class JobRequestsTests(TestCase):
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self._old_env = environ.get('QP_QIIME2_MANIFEST')
+        environ['QP_QIIME2_MANIFEST'] = join(self.tmpdir, 'manifest.json')
+        self.parameters = {
+            'qp-hide-paramThe distance matrix': 'distance_matrix',
+            'The distance matrix': '5',
+            'qp-hide-paramThe PCoA': 'pcoa',
+            'The PCoA': '7',
+            'qp-hide-paramNumber of permutations': 'permutations',
+            'Number of permutations': '999',
+            'qp-hide-paramMetadata column': 'qp-hide-metadata-field',
+            'Metadata column': 'env'}
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+        if self._old_env is None:
+            environ.pop('QP_QIIME2_MANIFEST', None)
+        else:
+            environ['QP_QIIME2_MANIFEST'] = self._old_env
+
+    def test_job_requests(self):
+        write_manifest(environ['QP_QIIME2_MANIFEST'], get_manifest_key(), [{
+            'name': 'Group significance', 'description': '',
+            'req_params': {
+                'qp-hide-plugin': ['string', 'diversity'],
+                'qp-hide-method': ['string', 'beta-group-significance'],
+                'The distance matrix': ['artifact', ['distance_matrix']],
+                'The PCoA': ['artifact', ['ordination_results']],
+                'Number of permutations': ['integer', 999]},
+            'opt_params': {}, 'outputs': {}}])
+        self.assertEqual(
+            job_requests('diversity', 'beta_group_significance',
+                         self.parameters),
+            (['5', '7'], True, 'env'))
+
+    def test_job_requests_no_manifest(self):
+        del self.parameters['qp-hide-paramMetadata column']
+        self.parameters['qp-hide-metadata'] = 'metadata'
+        self.assertEqual(
+            job_requests('diversity', 'beta_group_significance',
+                         self.parameters),
+            ([], True, None))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from unittest.mock import patch
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from json import load, loads
+
+from qp_qiime2.profiling import (
+    JobProfile, set_process_model, get_process_model)
+
+
+class JobProfileTests(TestCase):
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def test_phase(self):
+        profile = JobProfile('job-id')
+        with profile.phase('import:table', fp='table.biom'):
+            with open(join(self.tmpdir, 'data.txt'), 'w') as f:
+                f.write('x' * 1000)
+        obs = profile.records[0]
+        self.assertEqual(obs['name'], 'import:table')
+        self.assertEqual(obs['fp'], 'table.biom')
+        for k in ('start', 'wall_time', 'cpu_time', 'rss_growth',
+                  'read_bytes', 'write_bytes'):
+            self.assertIn(k, obs)
+        self.assertGreaterEqual(obs['write_bytes'], 1000)
+        self.assertGreaterEqual(obs['rss_growth'], 0)
+        self.assertGreater(profile.peak_rss, 0)
+
+    def test_phase_error(self):
+        profile = JobProfile('job-id')
+        with self.assertRaises(ValueError):
+            with profile.phase('run'):
+                raise ValueError('Failed')
+        self.assertEqual([r['name'] for r in profile.records], ['run'])
+
+    def test_concurrent_jobs(self):
+        job1, job2, job3 = JobProfile('1'), JobProfile('2'), JobProfile('3')
+        fanout = JobProfile()
+        with job1.phase('job'):
+            with job2.phase('job'):
+                with fanout.phase('run:shannon'):
+                    pass
+            with job3.phase('job'):
+                pass
+        self.assertEqual(
+            [job1.concurrent_jobs, job2.concurrent_jobs,
+             job3.concurrent_jobs], [1, 1, 1])
+        with job1.phase('job'):
+            pass
+        # the profiles that are part of another job are not counted
+        self.assertEqual(fanout.concurrent_jobs, 0)
+        self.assertEqual(job1.to_dict()['concurrent_jobs'], 1)
+        self.assertEqual(JobProfile('4').to_dict()['concurrent_jobs'], 0)
+
+    def test_process_model(self):
+        self.assertEqual(JobProfile('1').to_dict()['process'], 'standalone')
+        with patch('qp_qiime2.profiling._PROCESS_MODEL', 'standalone'):
+            set_process_model('worker')
+            self.assertEqual(get_process_model(), 'worker')
+            self.assertEqual(JobProfile('2').to_dict()['process'], 'worker')
+
+    def test_start_stop(self):
+        profile = JobProfile('job-id')
+        profile.start('collect')
+        profile.start('import')
+        with profile.phase('import:table'):
+            pass
+        profile.stop()
+        profile.stop()
+        self.assertEqual([r['name'] for r in profile.records],
+                         ['collect', 'import:table', 'import'])
+
+    def test_write_emit(self):
+        profile = JobProfile('job-id')
+        profile.info['method'] = 'rarefy'
+        with profile.phase('run'):
+            pass
+
+        fp = join(self.tmpdir, 'profile.json')
+        profile.write(fp)
+        with open(fp) as f:
+            obs = load(f)
+        self.assertEqual(obs['job_id'], 'job-id')
+        self.assertEqual(obs['method'], 'rarefy')
+        self.assertEqual(len(obs['records']), 1)
+
+        sink = join(self.tmpdir, 'sink.jsonl')
+        profile.emit(sink)
+        profile.emit(sink)
+        with open(sink) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(loads(lines[0]), obs)
+
+        # errors are ignored
+        profile.emit(join(self.tmpdir, 'missing', 'sink.jsonl'))
+
+
+if __name__ == '__main__':
+    main()
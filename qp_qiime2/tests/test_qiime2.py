@@ -7,10 +7,11 @@
 # -----------------------------------------------------------------------------
 
 from unittest import main
-from os import remove, stat
+from unittest.mock import patch
+from os import remove, stat, environ
 from shutil import rmtree
 from tempfile import mkdtemp
-from json import dumps
+from json import dumps, load
 from os.path import exists, isdir, join, realpath, dirname
 from biom import load_table
 
@@ -20,10 +21,15 @@ from qiime2 import __version__ as qiime2_version
 from qiime2.sdk import PluginManager
 
 from qp_qiime2 import plugin, call_qiime2
+from qp_qiime2.executor import JobExecutor
+from qp_qiime2.pipeline import (
+    call_pipeline, INPUT_PARAMETER, PIPELINE_PARAMETER, PIPELINE_COMMAND)
 from qp_qiime2.qp_qiime2 import (
     ALPHA_DIVERSITY_METRICS_PHYLOGENETIC, ALPHA_DIVERSITY_METRICS,
     BETA_DIVERSITY_METRICS, BETA_DIVERSITY_METRICS_PHYLOGENETIC,
-    CORRELATION_METHODS, BETA_GROUP_SIG_METHODS)
+    CORRELATION_METHODS, BETA_GROUP_SIG_METHODS, _results_key, load_action,
+    stage_artifact)
+from qp_qiime2.cache import DiskCache
 
 
 class qiime2Tests(PluginTestCase):
@@ -48,6 +54,76 @@ class qiime2Tests(PluginTestCase):
                 else:
                     remove(fp)
 
+    def test_results_key_missing_inputs(self):
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        cache = DiskCache(join(out_dir, 'cache'), 1024 ** 2)
+        biom_fp = join(out_dir, 'table.biom')
+        with open(biom_fp, 'w') as f:
+            f.write('table')
+        params = {'metric': 'faith_pd'}
+        exp = _results_key(cache, 'diversity', 'alpha_phylogenetic', params,
+                           {'table': (biom_fp, 'FeatureTable[Frequency]')},
+                           None)
+        # the optional inputs that are missing are skipped
+        for tree_fp in (None, '', 'None'):
+            obs = _results_key(
+                cache, 'diversity', 'alpha_phylogenetic', params,
+                {'table': (biom_fp, 'FeatureTable[Frequency]'),
+                 'phylogeny': (tree_fp, 'Phylogeny[Rooted]')}, None)
+            self.assertEqual(obs, exp)
+
+    def test_load_action_lazy(self):
+        # the PluginManager is a singleton with every plugin loaded by the
+        # registration in setUp, so it is removed to load it lazily
+        with patch('qp_qiime2.qp_qiime2._LAZY_PLUGINS', None):
+            PluginManager._PluginManager__instance = None
+            try:
+                action = load_action('feature-table', 'rarefy', lazy=True)
+                self.assertEqual(action.id, 'rarefy')
+                self.assertEqual(set(PluginManager().plugins),
+                                 {'types', 'feature-table'})
+
+                # the plugins already loaded are reused
+                action = load_action('feature-table', 'filter_samples',
+                                     lazy=True)
+                self.assertEqual(action.id, 'filter_samples')
+                self.assertEqual(set(PluginManager().plugins),
+                                 {'types', 'feature-table'})
+            finally:
+                PluginManager._PluginManager__instance = None
+
+    def test_load_action_lazy_other_plugin(self):
+        with patch('qp_qiime2.qp_qiime2._LAZY_PLUGINS', None):
+            PluginManager._PluginManager__instance = None
+            try:
+                load_action('feature-table', 'rarefy', lazy=True)
+                # a plugin that wasn't loaded replaces the PluginManager by
+                # one with every plugin
+                action = load_action('diversity', 'beta', lazy=True)
+                self.assertEqual(action.id, 'beta')
+                plugins = set(PluginManager().plugins)
+                self.assertIn('diversity', plugins)
+                self.assertIn('emperor', plugins)
+            finally:
+                PluginManager._PluginManager__instance = None
+
+    def test_stage_artifact(self):
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        tree_fp = join(out_dir, 'tree.tre')
+        with open(tree_fp, 'w') as f:
+            f.write('((a:1,b:2):1,c:3);\n')
+
+        # the files of Qiita are not shared with the artifact data
+        qza = stage_artifact('Phylogeny[Rooted]', tree_fp)
+        self.assertEqual(str(qza.type), 'Phylogeny[Rooted]')
+        self.assertEqual(stat(tree_fp).st_nlink, 1)
+
+        # unless the caller owns the file
+        qza = stage_artifact('Phylogeny[Rooted]', tree_fp, hardlink=True)
+        self.assertEqual(stat(tree_fp).st_nlink, 2)
+
     def test_not_analysis_artifact(self):
         params = {
             'The feature table to be rarefied.': '5',
@@ -100,9 +176,12 @@ class qiime2Tests(PluginTestCase):
         out_dir = mkdtemp()
         self._clean_up_files.append(out_dir)
 
+        original = dict(params)
         success, ainfo, msg = call_qiime2(self.qclient, jid, params, out_dir)
         self.assertTrue(success)
         self.assertEqual(msg, '')
+        # the parameters of the caller are not modified
+        self.assertEqual(params, original)
         obs_fp = join(out_dir, 'rarefy', 'rarefied_table',
                       'feature-table.biom')
         self.assertEqual(ainfo[0].files, [(obs_fp, 'biom')])
@@ -117,6 +196,138 @@ class qiime2Tests(PluginTestCase):
         obs_metadata = b.metadata(obs_id, axis='observation')
         self.assertEqual(obs_metadata['taxonomy'][0], 'k__Bacteria')
 
+        # and that the profile of the job was recorded
+        with open(join(out_dir, 'qp-qiime2-profile.json')) as f:
+            profile = load(f)
+        self.assertEqual(profile['job_id'], jid)
+        self.assertTrue(profile['success'])
+        names = [r['name'] for r in profile['records']]
+        for name in ('collect', 'import', 'import:table', 'run',
+                     'post-process', 'export:rarefied_table', 'job'):
+            self.assertIn(name, names)
+
+    def test_pipeline(self):
+        pipeline = {
+            'steps': {
+                'rarefied': {
+                    'action': 'feature-table.rarefy',
+                    'inputs': {'table': 'table'},
+                    'parameters': {'sampling_depth': 2}},
+                'beta': {
+                    'action': 'diversity.beta',
+                    'inputs': {'table': 'rarefied.rarefied_table'},
+                    'parameters': {'metric': 'Bray-Curtis dissimilarity'}},
+                'pcoa': {
+                    'action': 'diversity.pcoa',
+                    'inputs': {'distance_matrix': 'beta.distance_matrix'}},
+                'emperor': {
+                    'action': 'emperor.plot',
+                    'inputs': {'pcoa': 'pcoa.pcoa', 'metadata': 'metadata'}}},
+            'outputs': ['beta.distance_matrix', 'emperor.visualization']}
+        params = {INPUT_PARAMETER: '8', PIPELINE_PARAMETER: dumps(pipeline)}
+        self.data['command'] = dumps(
+            ['qiime2', qiime2_version, PIPELINE_COMMAND['name']])
+        self.data['parameters'] = dumps(params)
+
+        jid = self.qclient.post(
+            '/apitest/processing_job/', data=self.data)['job']
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+
+        success, ainfo, msg = call_pipeline(self.qclient, jid, params, out_dir)
+        self.assertEqual(msg, '')
+        self.assertTrue(success)
+        self.assertEqual([(ai.output_name, ai.artifact_type) for ai in ainfo],
+                         [('distance_matrix', 'distance_matrix'),
+                          ('q2_visualization', 'q2_visualization')])
+        self.assertEqual(ainfo[0].files, [(
+            join(out_dir, 'pipeline', 'distance_matrix',
+                 'distance-matrix.tsv'), 'plain_text')])
+
+        with open(join(out_dir, 'qp-qiime2-profile.json')) as f:
+            profile = load(f)
+        names = [r['name'] for r in profile['records']]
+        for name in ('import:table', 'run:rarefied', 'run:beta', 'run:pcoa',
+                     'run:emperor', 'export:distance_matrix'):
+            self.assertIn(name, names)
+
+    def test_pipeline_error(self):
+        pipeline = {
+            'steps': {
+                'beta': {
+                    'action': 'diversity.beta',
+                    'inputs': {'table': 'table'},
+                    'parameters': {'metric': 'braycurtis', 'other': 1}}},
+            'outputs': ['beta.distance_matrix']}
+        params = {INPUT_PARAMETER: '8', PIPELINE_PARAMETER: dumps(pipeline)}
+        self.data['command'] = dumps(
+            ['qiime2', qiime2_version, PIPELINE_COMMAND['name']])
+        self.data['parameters'] = dumps(params)
+
+        jid = self.qclient.post(
+            '/apitest/processing_job/', data=self.data)['job']
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+
+        success, ainfo, msg = call_pipeline(self.qclient, jid, params, out_dir)
+        self.assertFalse(success)
+        self.assertEqual(msg, 'Error in the pipeline: step "beta" has no '
+                              'input or parameter "other"')
+
+        # a parameter that can't be decoded fails the job
+        pipeline = {
+            'steps': {
+                'rarefied': {
+                    'action': 'feature-table.rarefy',
+                    'inputs': {'table': 'table'},
+                    'parameters': {'sampling_depth': 'lots'}}},
+            'outputs': ['rarefied.rarefied_table']}
+        params[PIPELINE_PARAMETER] = dumps(pipeline)
+        success, ainfo, msg = call_pipeline(self.qclient, jid, params, out_dir)
+        self.assertFalse(success)
+        self.assertRegex(msg, '^Error in the parameter "sampling_depth" of '
+                              'step "rarefied": ')
+
+    def test_concurrent_jobs(self):
+        params = {
+            'The feature table to be rarefied.': '8',
+            'The total frequency that each sample should be rarefied to. '
+            'Samples where the sum of frequencies is less than the sampling '
+            'depth will be not be included in the resulting table unless '
+            'subsampling is performed with replacement. (sampling_depth)': '2',
+            'qp-hide-method': 'rarefy',
+            'qp-hide-paramThe total frequency that each sample should be '
+            'rarefied to. Samples where the sum of frequencies is less than '
+            'the sampling depth will be not be included in the resulting '
+            'table unless subsampling is performed with '
+            'replacement. (sampling_depth)': 'sampling_depth',
+            'qp-hide-paramThe feature table to be rarefied.': 'table',
+            'qp-hide-plugin': 'feature-table'}
+        self.data['command'] = dumps(
+            ['qiime2', qiime2_version, 'Rarefy table'])
+        self.data['parameters'] = dumps(params)
+
+        jobs = []
+        for _ in range(4):
+            jid = self.qclient.post(
+                '/apitest/processing_job/', data=self.data)['job']
+            out_dir = mkdtemp()
+            self._clean_up_files.append(out_dir)
+            jobs.append((jid, out_dir))
+
+        # the jobs share the parameters and run in threads of this process
+        with JobExecutor(4) as executor:
+            futures = [executor.submit(call_qiime2, self.qclient, jid,
+                                       params, out_dir)
+                       for jid, out_dir in jobs]
+            results = [f.result() for f in futures]
+        for (jid, out_dir), (success, ainfo, msg) in zip(jobs, results):
+            self.assertEqual(msg, '')
+            self.assertTrue(success)
+            self.assertEqual(ainfo[0].files, [(join(
+                out_dir, 'rarefy', 'rarefied_table', 'feature-table.biom'),
+                'biom')])
+
     def test_rarefy_error(self):
         params = {
             'The feature table to be rarefied.': '8',
@@ -186,6 +397,59 @@ class qiime2Tests(PluginTestCase):
         self.assertEqual(ainfo[0].artifact_type, 'distance_matrix')
         self.assertEqual(ainfo[0].output_name, 'distance_matrix')
 
+    def test_beta_estimate(self):
+        params = {
+            'The beta diversity metric to be '
+            'computed. (metric)': "Rogers-Tanimoto distance",
+            'The feature table containing the samples over which beta '
+            'diversity should be computed.': '8',
+            'qp-hide-method': 'beta',
+            'qp-hide-paramThe beta diversity metric to be computed. '
+            '(metric)': 'metric',
+            'qp-hide-paramThe feature table containing the samples over '
+            'which beta diversity should be computed.': 'table',
+            'qp-hide-plugin': 'diversity'}
+        self.data['command'] = dumps(
+            ['qiime2', qiime2_version, 'Beta diversity'])
+        self.data['parameters'] = dumps(params)
+
+        jid = self.qclient.post(
+            '/apitest/processing_job/', data=self.data)['job']
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        # previous runs on tables of 1 to 4 samples, all below the memory
+        # limit but growing with the pairs of samples, see estimates.job_size
+        history_fp = join(out_dir, 'history.jsonl')
+        with open(history_fp, 'w') as f:
+            for samples in range(1, 5):
+                size = samples + samples * samples
+                f.write(dumps({
+                    'plugin': 'diversity', 'method': 'beta', 'success': True,
+                    'metric': 'rogerstanimoto',
+                    'peak_rss': 2 ** 28 + size * 2 ** 24,
+                    'concurrent_jobs': 0,
+                    'inputs': {'samples': samples, 'features': 1,
+                               'nnz': samples, 'tips': 0},
+                    'records': [{'name': 'run', 'wall_time': size}]}) + '\n')
+
+        # the job fails before importing the table, as the previous runs say
+        # it needs more memory than it has
+        with patch.dict(environ, {'QP_QIIME2_JOB_HISTORY': history_fp,
+                                  'QP_QIIME2_MEMORY_LIMIT': '1G'}):
+            success, ainfo, msg = call_qiime2(
+                self.qclient, jid, params, out_dir)
+        self.assertFalse(success)
+        self.assertRegex(msg, r'^The job needs about [\d.]+ [GT]iB of memory '
+                              r'but it can use 1.0 GiB \(estimated from 4 '
+                              r'previous runs\)')
+        with open(join(out_dir, 'qp-qiime2-profile.json')) as f:
+            profile = load(f)
+        self.assertGreater(profile['estimate']['peak_rss'], 2 ** 30)
+        self.assertEqual(profile['metric'], 'rogerstanimoto')
+        self.assertGreater(profile['inputs']['nnz'], 1)
+        self.assertEqual([r['name'] for r in profile['records']],
+                         ['collect', 'job'])
+
     def test_beta_phylogenetic(self):
         params = {
             'In a bifurcating tree, the tips make up about 50% of the nodes '
@@ -606,6 +870,39 @@ class qiime2Tests(PluginTestCase):
         obs = oct(stat(exp_fp).st_mode)[-3:]
         self.assertEqual(obs, '664')
 
+    def test_alpha_multiple_metrics(self):
+        params = {
+            'The alpha diversity metric to be computed. '
+            '(metric)': ["Simpson's index", "Shannon's index"],
+            'The feature table containing the samples for which alpha '
+            'diversity should be computed.': '8',
+            'qp-hide-method': 'alpha',
+            'qp-hide-fanout': 'metric',
+            'qp-hide-paramThe alpha diversity metric to be '
+            'computed. (metric)': 'metric',
+            'qp-hide-paramThe feature table containing the samples for '
+            'which alpha diversity should be computed.': 'table',
+            'qp-hide-plugin': 'diversity'}
+        self.data['command'] = dumps(
+            ['qiime2', qiime2_version, 'Alpha diversity (multiple metrics)'])
+        self.data['parameters'] = dumps(params)
+
+        jid = self.qclient.post(
+            '/apitest/processing_job/', data=self.data)['job']
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+
+        success, ainfo, msg = call_qiime2(self.qclient, jid, params, out_dir)
+        self.assertEqual(msg, '')
+        self.assertTrue(success)
+        self.assertEqual(len(ainfo), 2)
+        for ai, metric in zip(ainfo, ['simpson', 'shannon']):
+            aname = 'alpha_diversity_%s' % metric
+            exp_fp = join(out_dir, 'alpha', aname, 'alpha-diversity.tsv')
+            self.assertEqual(ai.files, [(exp_fp, 'plain_text')])
+            self.assertEqual(ai.artifact_type, 'alpha_vector')
+            self.assertEqual(ai.output_name, aname)
+
     def test_alpha_phylogenetic(self):
         params = {
             'Phylogenetic tree': join(
@@ -724,6 +1021,18 @@ class qiime2Tests(PluginTestCase):
         self.assertEqual(ainfo[0].files, exp)
         self.assertEqual(ainfo[0].artifact_type, 'q2_visualization')
 
+        # a table without taxonomy fails before importing it
+        with patch('qp_qiime2.tables.InputTable.has_taxonomy',
+                   return_value=False):
+            success, ainfo, msg = call_qiime2(
+                self.qclient, jid, params, out_dir)
+        self.assertFalse(success)
+        self.assertEqual(msg, 'Error generating taxonomy. Are you sure this '
+                              'artifact has taxonomy?')
+        with open(join(out_dir, 'qp-qiime2-profile.json')) as f:
+            profile = load(f)
+        self.assertNotIn('import', [r['name'] for r in profile['records']])
+
     def test_filter_samples(self):
         # let's test a failure
         params = {
@@ -0,0 +1,112 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from unittest.mock import patch
+from os import environ, mkdir
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from qp_qiime2.resources import (
+    THREAD_VARIABLES, get_cgroup_cpus, get_cpu_count, limit_threads,
+    thread_limits, parse_size, get_cgroup_memory, get_memory_limit)
+
+
+class ResourcesTests(TestCase):
+    def setUp(self):
+        self.root = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.root)
+
+    def _write(self, fp, contents):
+        with open(join(self.root, fp), 'w') as f:
+            f.write(contents)
+
+    def test_get_cgroup_cpus(self):
+        # no cgroup files
+        self.assertIsNone(get_cgroup_cpus(self.root))
+
+        # cgroup v1
+        mkdir(join(self.root, 'cpu'))
+        self._write(join('cpu', 'cpu.cfs_quota_us'), '-1\n')
+        self._write(join('cpu', 'cpu.cfs_period_us'), '100000\n')
+        self.assertIsNone(get_cgroup_cpus(self.root))
+        self._write(join('cpu', 'cpu.cfs_quota_us'), '250000\n')
+        self.assertEqual(get_cgroup_cpus(self.root), 2.5)
+
+        # cgroup v2 takes precedence
+        self._write('cpu.max', '150000 100000\n')
+        self.assertEqual(get_cgroup_cpus(self.root), 1.5)
+        self._write('cpu.max', 'max 100000\n')
+        self.assertIsNone(get_cgroup_cpus(self.root))
+
+    def test_get_cpu_count(self):
+        with patch.dict(environ, {'QP_QIIME2_CPUS': '3'}):
+            self.assertEqual(get_cpu_count(), 3)
+        with patch.dict(environ, {'QP_QIIME2_CPUS': '0'}):
+            self.assertEqual(get_cpu_count(), 1)
+        with patch.dict(environ, {'QP_QIIME2_CPUS': ''}):
+            self.assertGreaterEqual(get_cpu_count(), 1)
+            with patch('qp_qiime2.resources.get_cgroup_cpus',
+                       return_value=0.5):
+                self.assertEqual(get_cpu_count(), 1)
+
+    def test_parse_size(self):
+        self.assertEqual(parse_size('1024'), 1024)
+        self.assertEqual(parse_size('16G'), 16 * 2 ** 30)
+        self.assertEqual(parse_size('1.5mb'), 3 * 2 ** 19)
+        with self.assertRaises(ValueError):
+            parse_size('lots')
+
+    def test_get_cgroup_memory(self):
+        self.assertIsNone(get_cgroup_memory(self.root))
+
+        # cgroup v1
+        mkdir(join(self.root, 'memory'))
+        self._write(join('memory', 'memory.limit_in_bytes'), '4096\n')
+        self.assertEqual(get_cgroup_memory(self.root), 4096)
+
+        # cgroup v2 takes precedence
+        self._write('memory.max', 'max\n')
+        self.assertIsNone(get_cgroup_memory(self.root))
+        self._write('memory.max', '2048\n')
+        self.assertEqual(get_cgroup_memory(self.root), 2048)
+
+    def test_get_memory_limit(self):
+        with patch.dict(environ, {'QP_QIIME2_MEMORY_LIMIT': '2G'}):
+            self.assertEqual(get_memory_limit(), 2 * 2 ** 30)
+        with patch.dict(environ, {'QP_QIIME2_MEMORY_LIMIT': ''}):
+            with patch('qp_qiime2.resources.get_cgroup_memory',
+                       return_value=4096):
+                self.assertEqual(get_memory_limit(), 4096)
+            with patch('qp_qiime2.resources.get_cgroup_memory',
+                       return_value=2 ** 62):
+                self.assertLess(get_memory_limit(), 2 ** 62)
+
+    def test_limit_threads(self):
+        with patch.dict(environ, {'OMP_NUM_THREADS': '1',
+                                  'MKL_NUM_THREADS': '16',
+                                  'OPENBLAS_NUM_THREADS': 'x'}):
+            environ.pop('NUMEXPR_NUM_THREADS', None)
+            with patch('qp_qiime2.resources.threadpool_limits') as limits:
+                limit_threads(4)
+            self.assertEqual([environ[k] for k in THREAD_VARIABLES],
+                             ['1', '4', '4', '4'])
+            # the libraries already loaded get the lowest limit
+            limits.assert_called_once_with(limits=1)
+
+    def test_thread_limits(self):
+        # no limit
+        with thread_limits(None):
+            pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from os import makedirs, listdir, remove, stat
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from qp_qiime2.cache import DiskCache
+from qp_qiime2.results import store_results, restore_results
+
+
+class ResultsTests(TestCase):
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self.cache = DiskCache(join(self.tmpdir, 'cache'), 1024 ** 2)
+        self.out_dir = join(self.tmpdir, 'job1', 'beta')
+        makedirs(join(self.out_dir, 'distance_matrix'))
+        makedirs(join(self.out_dir, 'rarefied_table'))
+        self.files = {
+            join('distance_matrix', 'distance-matrix.tsv'): 'dm',
+            join('rarefied_table', 'feature-table.biom'): 'table',
+            join('rarefied_table', 'from_5_tree.tre'): 'tree'}
+        for fp, contents in self.files.items():
+            with open(join(self.out_dir, fp), 'w') as f:
+                f.write(contents)
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def _ainfo(self, out_dir):
+        return [
+            ('distance_matrix', 'distance_matrix', [
+                (join(out_dir, 'distance_matrix', 'distance-matrix.tsv'),
+                 'plain_text')]),
+            ('rarefied_table', 'BIOM', [
+                (join(out_dir, 'rarefied_table', 'feature-table.biom'),
+                 'biom'),
+                (join(out_dir, 'rarefied_table', 'from_5_tree.tre'),
+                 'plain_text')])]
+
+    def test_store_restore(self):
+        self.assertIsNone(restore_results(self.cache, 'key', self.out_dir))
+        store_results(self.cache, 'key', self.out_dir,
+                      self._ainfo(self.out_dir))
+
+        out_dir = join(self.tmpdir, 'job2', 'beta')
+        makedirs(out_dir)
+        obs = restore_results(self.cache, 'key', out_dir)
+        self.assertEqual(obs, self._ainfo(out_dir))
+        for fp, contents in self.files.items():
+            with open(join(out_dir, fp)) as f:
+                self.assertEqual(f.read(), contents)
+            # the jobs don't share their files
+            self.assertEqual(stat(join(out_dir, fp)).st_nlink, 1)
+            self.assertEqual(stat(join(self.out_dir, fp)).st_nlink, 1)
+        self.assertCountEqual(listdir(out_dir),
+                              ['distance_matrix', 'rarefied_table'])
+
+    def test_restore_corrupted(self):
+        store_results(self.cache, 'key', self.out_dir,
+                      self._ainfo(self.out_dir))
+        remove(join(self.cache.get('key'), 'distance_matrix',
+                    'distance-matrix.tsv'))
+
+        out_dir = join(self.tmpdir, 'job2', 'beta')
+        makedirs(out_dir)
+        self.assertIsNone(restore_results(self.cache, 'key', out_dir))
+        # nothing is left behind
+        self.assertEqual(listdir(out_dir), [])
+
+
+if __name__ == '__main__':
+    main()
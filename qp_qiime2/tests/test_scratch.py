@@ -0,0 +1,132 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+import tempfile
+from unittest import TestCase, main
+from unittest.mock import patch
+from os import environ, link
+from os.path import join, exists, dirname
+from shutil import rmtree
+from types import SimpleNamespace
+
+from qp_qiime2.scratch import (
+    JobScratch, get_scratch_dir, use_scratch_dir, remove_data)
+
+
+class JobScratchTests(TestCase):
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.base_dir)
+
+    def test_get_scratch_dir(self):
+        with patch.dict(environ, {'QP_QIIME2_SCRATCH_DIR': self.base_dir}):
+            self.assertEqual(get_scratch_dir(), self.base_dir)
+        with patch.dict(environ, {'QP_QIIME2_SCRATCH_DIR': ''}):
+            self.assertEqual(get_scratch_dir(), tempfile.gettempdir())
+
+    def test_use_scratch_dir(self):
+        tempdir, tmpdir = tempfile.tempdir, environ.get('TMPDIR')
+        base_dir = join(self.base_dir, 'scratch')
+        try:
+            with patch.dict(environ, {'QP_QIIME2_SCRATCH_DIR': base_dir}):
+                use_scratch_dir()
+                self.assertEqual(environ['TMPDIR'], base_dir)
+            self.assertEqual(tempfile.gettempdir(), base_dir)
+        finally:
+            tempfile.tempdir = tempdir
+            if tmpdir is None:
+                environ.pop('TMPDIR', None)
+            else:
+                environ['TMPDIR'] = tmpdir
+
+    def test_scratch(self):
+        tempdir = tempfile.gettempdir()
+        with JobScratch('job-1', self.base_dir) as scratch:
+            path = scratch.path
+            self.assertEqual(dirname(path), self.base_dir)
+            self.assertIn('job-1', path)
+            # the temporary folder of the process is not changed
+            self.assertEqual(tempfile.gettempdir(), tempdir)
+            fp = join(path, 'data')
+            with open(fp, 'wb') as f:
+                f.write(b'x' * 8192)
+            link(fp, fp + '.link')
+            self.assertGreaterEqual(scratch.sample(), 8192)
+            # the hardlinks are only counted once
+            self.assertLess(scratch.usage(), 2 * 8192)
+        self.assertFalse(exists(path))
+        self.assertGreaterEqual(scratch.peak_bytes, 8192)
+
+    def test_scratch_jobs(self):
+        # the jobs running at the same time have their own folders and usage
+        with JobScratch('job-1', self.base_dir) as scratch1, \
+                JobScratch('job-2', self.base_dir) as scratch2:
+            self.assertNotEqual(scratch1.path, scratch2.path)
+            with open(join(scratch1.path, 'data'), 'wb') as f:
+                f.write(b'x' * 8192)
+            self.assertGreaterEqual(scratch1.sample(), 8192)
+            self.assertEqual(scratch2.sample(), 0)
+            path = scratch2.path
+        self.assertFalse(exists(path))
+
+    def test_track(self):
+        data_dir = tempfile.mkdtemp(dir=self.base_dir)
+        with open(join(data_dir, 'feature-table.biom'), 'wb') as f:
+            f.write(b'x' * 8192)
+        result = SimpleNamespace(_archiver=SimpleNamespace(path=data_dir))
+        with JobScratch(base_dir=self.base_dir) as scratch:
+            self.assertEqual(scratch.usage(), 0)
+            scratch.track(result)
+            # anything but the Q2 results is ignored
+            scratch.track('metadata')
+            self.assertGreaterEqual(scratch.usage(), 8192)
+            # the data of the results is removed when they are released
+            rmtree(data_dir)
+            self.assertEqual(scratch.usage(), 0)
+
+        # or at the end of the job
+        data_dir = tempfile.mkdtemp(dir=self.base_dir)
+        result = SimpleNamespace(_archiver=SimpleNamespace(path=data_dir))
+        with JobScratch(base_dir=self.base_dir) as scratch:
+            scratch.track(result)
+        self.assertFalse(exists(data_dir))
+
+    def test_remove_data(self):
+        data_dir = tempfile.mkdtemp(dir=self.base_dir)
+        with open(join(data_dir, 'feature-table.biom'), 'wb') as f:
+            f.write(b'x' * 8192)
+        result = SimpleNamespace(_archiver=SimpleNamespace(path=data_dir))
+        remove_data([result, 'metadata'])
+        self.assertFalse(exists(data_dir))
+        # the results already removed are ignored
+        remove_data([result])
+
+    def test_scratch_error(self):
+        with self.assertRaises(ValueError):
+            with JobScratch(base_dir=self.base_dir) as scratch:
+                path = scratch.path
+                raise ValueError()
+        self.assertFalse(exists(path))
+
+    def test_check_space(self):
+        fp = join(self.base_dir, 'input.biom')
+        with open(fp, 'wb') as f:
+            f.write(b'x' * 1024)
+        with JobScratch(base_dir=self.base_dir) as scratch:
+            self.assertEqual(scratch.check_space([fp, None, 'missing']), '')
+            with patch('qp_qiime2.scratch.SCRATCH_FACTOR', 2 ** 60):
+                msg = scratch.check_space([fp])
+        self.assertRegex(msg, r'^Not enough scratch space in %s: the job '
+                              r'needs about [\d.]+ TiB and there are ' %
+                         self.base_dir)
+
+
+if __name__ == '__main__':
+    main()
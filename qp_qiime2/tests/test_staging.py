@@ -0,0 +1,102 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from os import makedirs, stat, chmod
+from os.path import join
+from stat import S_IMODE
+from shutil import rmtree
+from tempfile import mkdtemp
+from types import SimpleNamespace
+from zipfile import ZipFile, ZIP_STORED
+
+from qp_qiime2.staging import link_or_copy, save_uncompressed
+
+
+class StagingTests(TestCase):
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self.src = join(self.tmpdir, 'table.biom')
+        with open(self.src, 'w') as f:
+            f.write('table contents')
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def test_link_or_copy(self):
+        dst = join(self.tmpdir, 'staged.biom')
+        # same folder, so the same filesystem
+        self.assertEqual(link_or_copy(self.src, dst), 'hardlink')
+        self.assertEqual(stat(self.src).st_ino, stat(dst).st_ino)
+        with open(dst) as f:
+            self.assertEqual(f.read(), 'table contents')
+
+    def test_link_or_copy_exists(self):
+        dst = join(self.tmpdir, 'staged.biom')
+        with open(dst, 'w') as f:
+            f.write('other')
+        # the link fails but the file is still staged
+        self.assertIn(link_or_copy(self.src, dst), ('reflink', 'copy'))
+        with open(dst) as f:
+            self.assertEqual(f.read(), 'table contents')
+
+    def test_link_or_copy_mode(self):
+        chmod(self.src, 0o600)
+        dst = join(self.tmpdir, 'staged.biom')
+        # no other file shares src, so it is hardlinked and both get the mode
+        self.assertEqual(link_or_copy(self.src, dst, mode=0o664), 'hardlink')
+        self.assertEqual(S_IMODE(stat(dst).st_mode), 0o664)
+
+        # src is shared with dst now, so changing its permissions copies it
+        other = join(self.tmpdir, 'other.biom')
+        self.assertIn(link_or_copy(self.src, other, mode=0o644),
+                      ('reflink', 'copy'))
+        self.assertEqual(S_IMODE(stat(other).st_mode), 0o644)
+        self.assertEqual(S_IMODE(stat(self.src).st_mode), 0o664)
+        with open(other) as f:
+            self.assertEqual(f.read(), 'table contents')
+
+        # unless it already has them
+        other = join(self.tmpdir, 'same.biom')
+        self.assertEqual(link_or_copy(self.src, other, mode=0o664),
+                         'hardlink')
+
+    def test_link_or_copy_no_hardlink(self):
+        dst = join(self.tmpdir, 'staged.biom')
+        self.assertIn(link_or_copy(self.src, dst, hardlink=False),
+                      ('reflink', 'copy'))
+        self.assertNotEqual(stat(self.src).st_ino, stat(dst).st_ino)
+        with open(dst) as f:
+            self.assertEqual(f.read(), 'table contents')
+
+    def test_save_uncompressed(self):
+        root = join(self.tmpdir, 'archive')
+        makedirs(join(root, 'uuid', 'data'))
+        makedirs(join(root, 'uuid', '.hidden'))
+        for fp in [join('uuid', 'metadata.yaml'),
+                   join('uuid', 'data', 'feature-table.biom'),
+                   join('uuid', '.hidden', 'file'),
+                   join('uuid', '.hidden_file')]:
+            with open(join(root, fp), 'w') as f:
+                f.write(fp)
+        result = SimpleNamespace(_archiver=SimpleNamespace(path=root))
+
+        fp = join(self.tmpdir, 'artifact.qza')
+        save_uncompressed(result, fp)
+        with ZipFile(fp) as zf:
+            infos = zf.infolist()
+            self.assertCountEqual(
+                [i.filename for i in infos],
+                ['uuid/metadata.yaml', 'uuid/data/feature-table.biom'])
+            self.assertTrue(all(i.compress_type == ZIP_STORED for i in infos))
+            self.assertEqual(zf.read('uuid/data/feature-table.biom'),
+                             b'uuid/data/feature-table.biom')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import numpy as np
+import pandas as pd
+from biom import Table, load_table
+from biom.util import biom_open
+
+from qp_qiime2.tables import (
+    InputTable, probe_table, copy_table, filter_table)
+
+
+class InputTableTests(TestCase):
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self.table = Table(
+            np.array([[0, 1, 3], [1, 1, 2], [5, 0, 0]]),
+            ['O1', 'O2', 'O3'], ['S1', 'S2', 'S3'],
+            [{'taxonomy': ['k__Bacteria', 'p__Firmicutes']},
+             {'taxonomy': ['k__Bacteria', 'p__Bacteroidetes']},
+             {'taxonomy': ['k__Archaea']}])
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def _write(self, table):
+        fp = join(self.tmpdir, 'table.biom')
+        with biom_open(fp, 'w') as f:
+            table.to_hdf5(f, 'test')
+        return fp
+
+    def test_dimensions(self):
+        obs = InputTable(self._write(self.table))
+        self.assertEqual(obs.dimensions(),
+                         {'samples': 3, 'features': 3, 'nnz': 6})
+        # the header is only read once
+        self.assertIs(obs.probe(), obs.probe())
+
+    def test_has_taxonomy(self):
+        self.assertTrue(InputTable(self._write(self.table)).has_taxonomy())
+        table = Table(np.array([[0, 1], [1, 1]]), ['O1', 'O2'], ['S1', 'S2'])
+        self.assertFalse(InputTable(self._write(table)).has_taxonomy())
+
+    def test_probe_table(self):
+        self.assertEqual(probe_table(self._write(self.table)), {
+            'samples': 3, 'features': 3, 'nnz': 6, 'taxonomy': True})
+        table = Table(np.zeros((0, 0)), [], [])
+        self.assertEqual(probe_table(self._write(table)), {
+            'samples': 0, 'features': 0, 'nnz': 0, 'taxonomy': False})
+        fp = join(self.tmpdir, 'table.txt')
+        with open(fp, 'w') as f:
+            f.write('#OTU ID\tS1\n')
+        with self.assertRaises(OSError):
+            probe_table(fp)
+
+    def test_feature_ids(self):
+        obs = InputTable(self._write(self.table))
+        self.assertEqual(obs.feature_ids(),
+                         list(self.table.ids(axis='observation')))
+
+    def test_taxonomy(self):
+        obs = InputTable(self._write(self.table)).taxonomy()
+        exp = pd.DataFrame(
+            {'Taxon': ['k__Bacteria; p__Firmicutes',
+                       'k__Bacteria; p__Bacteroidetes', 'k__Archaea']},
+            index=pd.Index(['O1', 'O2', 'O3'], name='Feature ID'))
+        pd.testing.assert_frame_equal(obs, exp)
+
+    def test_taxonomy_error(self):
+        table = Table(np.array([[0, 1], [1, 1]]), ['O1', 'O2'], ['S1', 'S2'])
+        with self.assertRaisesRegex(ValueError, 'no taxonomy'):
+            InputTable(self._write(table)).taxonomy()
+
+        # O4 gets empty taxonomy when the metadata of the table is copied
+        table = Table(np.array([[2, 0], [1, 1]]), ['O3', 'O4'], ['S1', 'S3'])
+        fp = join(self.tmpdir, 'result.biom')
+        with biom_open(fp, 'w') as f:
+            table.to_hdf5(f, 'test')
+        out_fp = join(self.tmpdir, 'output.biom')
+        copy_table(fp, out_fp, self._write(self.table))
+        with self.assertRaisesRegex(ValueError, 'O4 does not contain'):
+            InputTable(out_fp).taxonomy()
+
+
+class CopyTableTests(TestCase):
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self.input_fp = join(self.tmpdir, 'input.biom')
+        table = Table(
+            np.array([[0, 1, 3], [1, 1, 2], [5, 0, 0]]),
+            ['O1', 'O2', 'O3'], ['S1', 'S2', 'S3'],
+            [{'taxonomy': ['k__Bacteria', 'p__Firmicutes']},
+             {'taxonomy': ['k__Bacteria', 'p__Bacteroidetes']},
+             {'taxonomy': ['k__Archaea']}])
+        with biom_open(self.input_fp, 'w') as f:
+            table.to_hdf5(f, 'test')
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def _copy(self, table, metadata_fp=None):
+        in_fp = join(self.tmpdir, 'result.biom')
+        with biom_open(in_fp, 'w') as f:
+            table.to_hdf5(f, 'test')
+        fp = join(self.tmpdir, 'output.biom')
+        copy_table(in_fp, fp, metadata_fp)
+        return fp
+
+    def test_copy_table(self):
+        table = Table(np.array([[2, 0], [1, 1]]), ['O3', 'O1'], ['S1', 'S3'])
+        fp = self._copy(table, self.input_fp)
+        obs = load_table(fp)
+        self.assertEqual(list(obs.ids(axis='observation')), ['O3', 'O1'])
+        self.assertEqual(obs.metadata('O3', axis='observation'),
+                         {'taxonomy': ['k__Archaea']})
+        self.assertEqual(obs.metadata('O1', axis='observation'),
+                         {'taxonomy': ['k__Bacteria', 'p__Firmicutes']})
+        np.testing.assert_array_equal(
+            obs.matrix_data.toarray(), [[2, 0], [1, 1]])
+
+    def test_copy_table_missing_features(self):
+        table = Table(np.array([[2, 0], [1, 1]]), ['O3', 'O4'], ['S1', 'S3'])
+        fp = self._copy(table, self.input_fp)
+        obs = load_table(fp)
+        self.assertEqual(obs.metadata('O3', axis='observation'),
+                         {'taxonomy': ['k__Archaea']})
+        self.assertEqual(dict(obs.metadata('O4', axis='observation')),
+                         {'taxonomy': None})
+
+    def test_copy_table_no_metadata(self):
+        table = Table(np.array([[2, 0], [1, 1]]), ['O3', 'O1'], ['S1', 'S3'])
+        fp = self._copy(table)
+        self.assertEqual(load_table(fp), table)
+
+
+class FilterTableTests(TestCase):
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self.input_fp = join(self.tmpdir, 'input.biom')
+        self.output_fp = join(self.tmpdir, 'output.biom')
+        self.table = Table(
+            np.array([[0, 1, 3, 0], [1, 1, 2, 0], [5, 0, 0, 0],
+                      [0, 0, 0, 0]]),
+            ['O1', 'O2', 'O3', 'O4'], ['S1', 'S2', 'S3', 'S4'],
+            [{'taxonomy': ['k__Bacteria', 'p__Firmicutes']},
+             {'taxonomy': ['k__Bacteria', 'p__Bacteroidetes']},
+             {'taxonomy': ['k__Archaea']},
+             {'taxonomy': ['k__Bacteria']}])
+        with biom_open(self.input_fp, 'w') as f:
+            self.table.to_hdf5(f, 'test')
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def _filter(self, axis, **kwargs):
+        # a small chunk size so the table is read in several chunks
+        shape = filter_table(self.input_fp, self.output_fp, axis,
+                             chunk_size=2, **kwargs)
+        obs = load_table(self.output_fp)
+        self.assertEqual(shape, obs.shape)
+        return obs
+
+    def _expected(self, axis, function, remove_empty=True):
+        exp = self.table.filter(function, axis=axis, inplace=False)
+        if remove_empty:
+            other = 'observation' if axis == 'sample' else 'sample'
+            exp.remove_empty(axis=other, inplace=True)
+        return exp
+
+    def test_filter_table_samples(self):
+        obs = self._filter('sample', min_frequency=4)
+        exp = self._expected('sample', lambda v, i, m: v.sum() >= 4)
+        self.assertEqual(obs, exp)
+        self.assertEqual(obs.metadata('O3', axis='observation'),
+                         {'taxonomy': ['k__Archaea']})
+
+    def test_filter_table_ids(self):
+        obs = self._filter('sample', ids_to_keep={'S2', 'S3'},
+                           remove_empty=False)
+        exp = self._expected(
+            'sample', lambda v, i, m: i in {'S2', 'S3'}, False)
+        self.assertEqual(obs, exp)
+
+        obs = self._filter('sample', ids_to_keep={'S2', 'S3'},
+                           exclude_ids=True)
+        exp = self._expected('sample', lambda v, i, m: i in {'S1', 'S4'})
+        self.assertEqual(obs, exp)
+
+    def test_filter_table_exclude_ids(self):
+        # the whole filter is inverted, ids and frequencies, like the
+        # invert=exclude_ids of q2-feature-table
+        obs = self._filter('sample', ids_to_keep={'S1', 'S2'},
+                           min_frequency=3, exclude_ids=True)
+        exp = self.table.filter(
+            lambda v, i, m: i in {'S1', 'S2'} and v.sum() >= 3,
+            axis='sample', invert=True, inplace=False)
+        exp.remove_empty(axis='observation', inplace=True)
+        self.assertEqual(obs, exp)
+        self.assertEqual(list(obs.ids()), ['S2', 'S3', 'S4'])
+
+    def test_filter_table_features(self):
+        obs = self._filter('observation', min_nonzero=2, max_frequency=5)
+        exp = self._expected(
+            'observation', lambda v, i, m: (v > 0).sum() >= 2 and
+            v.sum() <= 5)
+        self.assertEqual(obs, exp)
+
+    def test_filter_table_empty(self):
+        self.assertEqual(filter_table(self.input_fp, self.output_fp, 'sample',
+                                      min_frequency=100), (0, 0))
+
+
+if __name__ == '__main__':
+    main()
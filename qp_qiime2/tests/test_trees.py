@@ -0,0 +1,60 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from qp_qiime2.trees import prune_tree, feature_set_hash
+
+
+class TreesTests(TestCase):
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self.fp = join(self.tmpdir, 'tree.tre')
+        with open(self.fp, 'w') as f:
+            f.write('(((O1:1,O2:2)n1:3,(O3:4,O4_x:5)n2:6)n3:7,O5:8)root;\n')
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def _tip_distances(self, tree):
+        return {t.name: t.distance(tree) for t in tree.tips()}
+
+    def test_prune_tree(self):
+        tree = prune_tree(self.fp, ['O1', 'O2', 'O4_x'])
+        self.assertEqual(sorted(t.name for t in tree.tips()),
+                         ['O1', 'O2', 'O4_x'])
+        # the path from each tip to the root doesn't change
+        self.assertEqual(self._tip_distances(tree),
+                         {'O1': 11, 'O2': 12, 'O4_x': 18})
+        # n2 was merged with O4_x
+        self.assertEqual(tree.find('O4_x').length, 11)
+        # and the root kept its single child
+        self.assertEqual(len(tree.children), 1)
+        self.assertEqual(tree.children[0].name, 'n3')
+        self.assertEqual(tree.children[0].length, 7)
+
+    def test_prune_tree_keeps_all(self):
+        tree = prune_tree(self.fp, ['O1', 'O2', 'O3', 'O4_x', 'O5'])
+        self.assertEqual(self._tip_distances(tree), {
+            'O1': 11, 'O2': 12, 'O3': 17, 'O4_x': 18, 'O5': 8})
+
+    def test_prune_tree_missing_features(self):
+        self.assertIsNone(prune_tree(self.fp, ['O1', 'O6']))
+
+    def test_feature_set_hash(self):
+        self.assertEqual(feature_set_hash(['O1', 'O2']),
+                         feature_set_hash(['O2', 'O1']))
+        self.assertNotEqual(feature_set_hash(['O1', 'O2']),
+                            feature_set_hash(['O1']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from json import dumps, loads
+from socket import socket, AF_UNIX, SOCK_STREAM
+from threading import Thread
+
+from qp_qiime2.worker import WorkerServer, ThreadedWorkerServer
+
+
+def _write_job(url, job_id, output_dir):
+    if job_id == 'fail':
+        raise ValueError('Job failed')
+    with open(join(output_dir, 'job.txt'), 'w') as f:
+        f.write('%s %s' % (url, job_id))
+
+
+class WorkerTests(TestCase):
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self.socket_fp = join(self.tmpdir, 'worker.sock')
+        self.server = WorkerServer(self.socket_fp, function=_write_job)
+
+    def tearDown(self):
+        self.server.server_close()
+        rmtree(self.tmpdir)
+
+    def _submit(self, request):
+        thread = Thread(target=self.server.handle_request)
+        thread.start()
+        with socket(AF_UNIX, SOCK_STREAM) as sock:
+            sock.connect(self.socket_fp)
+            sock.sendall((request + '\n').encode('utf-8'))
+            reply = sock.makefile('rb').readline()
+        thread.join()
+        return loads(reply.decode('utf-8'))
+
+    def test_job(self):
+        request = dumps({'url': 'https://localhost:21174', 'job_id': '1',
+                         'output_dir': self.tmpdir})
+        obs = self._submit(request)
+        self.assertEqual(obs, {'success': True, 'error': ''})
+        with open(join(self.tmpdir, 'job.txt')) as f:
+            self.assertEqual(f.read(), 'https://localhost:21174 1')
+
+    def test_job_error(self):
+        request = dumps({'url': 'https://localhost:21174', 'job_id': 'fail',
+                         'output_dir': self.tmpdir})
+        obs = self._submit(request)
+        self.assertFalse(obs['success'])
+        self.assertIn('ValueError: Job failed', obs['error'])
+
+    def test_invalid_request(self):
+        obs = self._submit(dumps({'url': 'https://localhost:21174'}))
+        self.assertFalse(obs['success'])
+        self.assertTrue(obs['error'].startswith('Invalid request: '))
+
+
+class ThreadedWorkerTests(WorkerTests):
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self.socket_fp = join(self.tmpdir, 'worker.sock')
+        self.server = ThreadedWorkerServer(
+            self.socket_fp, max_jobs=2, function=_write_job)
+
+
+if __name__ == '__main__':
+    main()
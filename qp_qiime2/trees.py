@@ -0,0 +1,75 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from hashlib import sha256
+
+from skbio import TreeNode
+
+
+def feature_set_hash(feature_ids):
+    """Computes the hash of a set of features
+
+    Parameters
+    ----------
+    feature_ids : iterable of str
+        The feature ids
+
+    Returns
+    -------
+    str
+        The hex digest, independent of the order of the ids
+    """
+    return sha256('\n'.join(sorted(feature_ids)).encode('utf-8')).hexdigest()
+
+
+def prune_tree(tree_fp, feature_ids):
+    """Prunes a tree to a set of features
+
+    Parameters
+    ----------
+    tree_fp : str
+        The filepath of the tree, in Newick format
+    feature_ids : iterable of str
+        The features to keep
+
+    Returns
+    -------
+    skbio.TreeNode or None
+        The tree with only the tips in feature_ids, None if some of the
+        features are not in the tree
+
+    Notes
+    -----
+    The tips not in feature_ids are removed, as well as the internal nodes
+    left without descendants, and the internal nodes left with a single
+    child are merged with it, adding their branch lengths. The original root
+    is kept even with a single child, so the branch length from each tip to
+    the root doesn't change and neither do the phylogenetic diversity
+    metrics, like UniFrac or Faith's PD, of the samples.
+    """
+    keep = set(feature_ids)
+    tree = TreeNode.read(tree_fp, format='newick', convert_underscores=False)
+
+    nodes = [(n, n.is_tip()) for n in tree.postorder(include_self=False)]
+    if not keep.issubset(n.name for n, is_tip in nodes if is_tip):
+        return None
+
+    for node, is_tip in nodes:
+        if is_tip:
+            if node.name not in keep:
+                node.parent.remove(node)
+        elif not node.children:
+            node.parent.remove(node)
+        elif len(node.children) == 1:
+            child = node.children[0]
+            if child.length is not None or node.length is not None:
+                child.length = (child.length or 0) + (node.length or 0)
+            parent = node.parent
+            parent.remove(node)
+            parent.append(child)
+    return tree
@@ -0,0 +1,173 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+# The worker keeps an interpreter with qiime2, its plugins and the Qiita
+# commands already loaded and listens on a local unix socket. Each connection
+# is a job: the client (see scripts/start_qiime2) sends a single JSON line
+# with the url, job_id and output_dir of the job; the worker forks a child
+# from the warm parent to run it and replies with a single JSON line with
+# the success of the job and, if it failed, the error. The jobs can also run
+# in threads of the worker instead, see ThreadedWorkerServer.
+
+import socketserver
+from os import environ, remove, chmod
+from os.path import exists
+from json import loads, dumps
+from socket import socket, AF_UNIX, SOCK_STREAM
+from traceback import format_exc
+
+import qiime2
+
+from . import plugin
+from .executor import JobExecutor
+from .profiling import set_process_model
+from .resources import get_cpu_count, limit_threads
+from .scratch import use_scratch_dir
+
+
+def get_worker_socket_fp():
+    """Returns the filepath of the worker socket
+
+    Returns
+    -------
+    str or None
+        The value of the QP_QIIME2_WORKER_SOCKET environment variable
+    """
+    return environ.get('QP_QIIME2_WORKER_SOCKET') or None
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    """Runs a single job, in the child forked by the WorkerServer"""
+
+    def _reply(self, success, error=''):
+        self.wfile.write(
+            (dumps({'success': success, 'error': error}) + '\n').encode(
+                'utf-8'))
+
+    def handle(self):
+        try:
+            request = loads(self.rfile.readline().decode('utf-8'))
+            args = (request['url'], request['job_id'], request['output_dir'])
+        except (ValueError, KeyError, TypeError) as e:
+            self._reply(False, 'Invalid request: %s' % str(e))
+            return
+
+        try:
+            self.server.function(*args)
+        except Exception:
+            self._reply(False, format_exc())
+        else:
+            self._reply(True)
+
+
+class WorkerServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    """Unix socket server that forks a child for each job
+
+    Parameters
+    ----------
+    socket_fp : str
+        The filepath of the unix socket to listen on
+    max_jobs : int, optional
+        The maximum number of jobs running at the same time
+    function : callable, optional
+        The function that runs a job, called with the url, job_id and
+        output_dir. Defaults to the qiime2 Qiita plugin
+    """
+    def __init__(self, socket_fp, max_jobs=None, function=None):
+        if max_jobs is not None:
+            self.max_children = max_jobs
+        self.function = plugin if function is None else function
+        # a socket file left behind by a worker that is not running anymore
+        # would make the bind fail
+        if exists(socket_fp) and not _is_listening(socket_fp):
+            remove(socket_fp)
+        super().__init__(socket_fp, JobHandler)
+        # only the user running the worker can submit jobs
+        chmod(socket_fp, 0o600)
+
+
+class ThreadedWorkerServer(WorkerServer):
+    """Unix socket server that runs each job in a thread
+
+    See WorkerServer. The jobs don't pay the cost of forking the worker,
+    which suits many light jobs, but they share its process; see
+    qp_qiime2.call_qiime2 for what the jobs share.
+    """
+    def __init__(self, socket_fp, max_jobs=None, function=None):
+        super().__init__(socket_fp, max_jobs=max_jobs, function=function)
+        # the executor blocks the accept loop when there are too many jobs
+        # waiting, so the new jobs wait in the socket backlog
+        self.executor = JobExecutor(max_jobs)
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown()
+
+
+def _is_listening(socket_fp):
+    """Checks if there is a process listening on a unix socket"""
+    with socket(AF_UNIX, SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_fp)
+        except OSError:
+            return False
+    return True
+
+
+def warm_up():
+    """Loads all the Q2 plugins so the forked jobs don't have to"""
+    qiime2.sdk.PluginManager()
+
+
+def serve(socket_fp, max_jobs=None, threads=False):
+    """Starts the worker and runs until interrupted
+
+    Parameters
+    ----------
+    socket_fp : str
+        The filepath of the unix socket to listen on
+    max_jobs : int, optional
+        The maximum number of jobs running at the same time; unless the
+        QP_QIIME2_CPUS environment variable is set, the CPUs of the worker
+        are split between them
+    threads : bool, optional
+        Whether to run the jobs in threads instead of forked children
+
+    Notes
+    -----
+    The threads of the numerical libraries are capped to the CPUs of each
+    job before loading the plugins, see limit_threads, and the temporary
+    files are written to the scratch folder, see scratch.use_scratch_dir; the
+    forked children inherit both, and the process model recorded in the
+    profiles of the jobs, see profiling.set_process_model.
+    """
+    if max_jobs is not None and not environ.get('QP_QIIME2_CPUS'):
+        environ['QP_QIIME2_CPUS'] = str(max(1, get_cpu_count() // max_jobs))
+    limit_threads(get_cpu_count())
+    use_scratch_dir()
+    set_process_model('threaded' if threads else 'worker')
+    warm_up()
+    server_class = ThreadedWorkerServer if threads else WorkerServer
+    server = server_class(socket_fp, max_jobs=max_jobs)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if exists(socket_fp):
+            remove(socket_fp)
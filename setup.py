@@ -44,8 +44,10 @@ setup(name='qp-qiime2',
       url='https://github.com/qiita-spots/qp-qiime2',
       test_suite='nose.collector',
       packages=['qp_qiime2'],
-      scripts=['scripts/configure_qiime2', 'scripts/start_qiime2'],
+      scripts=['scripts/configure_qiime2', 'scripts/start_qiime2',
+               'scripts/qiime2_worker', 'scripts/benchmark_qiime2'],
       extras_require={'test': ["nose >= 0.10.1", "pep8"]},
-      install_requires=['click >= 3.3', 'future'],
+      install_requires=['click >= 3.3', 'future', 'threadpoolctl',
+                        'importlib-metadata; python_version < "3.8"'],
       dependency_links=[],
       classifiers=classifiers)